@@ -1,7 +1,6 @@
 # LIBRARIES ------------------------------
 import streamlit as st
 # import streamlit_authenticator as stauth
-from streamlit_gsheets import GSheetsConnection
 from streamlit_option_menu import option_menu
 import yaml
 from yaml.loader import SafeLoader
@@ -9,6 +8,7 @@ import utils
 
 # --- HOME PAGE ------------------------------
 st.set_page_config(layout="wide")
+utils.start_trace('Home') # Time the stages of this rerun if profiling is enabled
 st.title('Personal finance app')
 st.text('Keep track of personal spending. Add transactions and visualize spending.\nBased on a private dataset in GoogleSheets.')
 # Allow users to login
@@ -53,8 +53,7 @@ if 'auth' in st.session_state:
 
         # --- READ DATA FROM GOOGLE SHEETS ---------------------
         # url = st.secrets["public_gsheets_url"] # Used if google sheets is public
-        conn = st.connection("gsheets", type=GSheetsConnection, ttl=0)
-        st.session_state['conn'] = conn # Save connection status to database in session state
+        utils.get_conn() # Connection to the storage backend from the pool of the server process (utils.get_pool()), shared by all the sessions
 
         # --- CHOOSE OPTION ------------------------------
         # if username == 'Lupi':
@@ -62,8 +61,12 @@ if 'auth' in st.session_state:
         selected = utils.sheet_menu()
         gsheet, ncols, currency = utils.get_sheet_and_cols(selected)
 
+        if 'sheets' not in st.session_state: # Read all the sheets in parallel right after login
+            utils.prefetch_sheets('not_other')
+        else:
+            utils.sync_sheets() # Pick up the changes made by other sessions
         if 'data' not in st.session_state: # In case the data was already read before
-            utils.read_data('not_other', gsheet=gsheet, ncols=ncols) # Read the data from the selected sheet
+            utils.select_sheet('not_other', gsheet=gsheet, ncols=ncols) # Take the selected sheet from the per-sheet store
         # utils.read_data('not_other', gsheet=gsheet, ncols=ncols) # Read the data from the selected sheet
 
         #if st.button('Reload data'): # Manually reading data
@@ -77,35 +80,115 @@ if 'auth' in st.session_state:
 
         # --- MONTHLY SPENDING --------------------------------------
         # See the spending of current and previous month
-        st.subheader('Monthly spending')
-        # if username == 'other':
-        #     st.text('For user "other" the data is randomized')
-
-        col1, col2 = st.columns(2) # For filtering data to show
-        recurrent = col1.multiselect('Recurrent',[True,False], default=[True,False])
-        include = col2.multiselect('Include', [True,False], default=[True])
-
-        filtered = utils.monthly_total_spending(st.session_state['data'], currency, recurrent, include)
-
-        # Chart with total spending for all months
-        if filtered is not None:  # filtered is None if there using ghseet "inversiones" -> no need for monthly plot
-            with st.expander('Monthly spending chart'):  
-                utils.monthly_spending_plot(filtered,include,currency)
-
+        @utils.fragment # Changing the filters reruns only this section, not the login and the loading of the sheets
+        def monthly_spending(gsheet, currency):
+            st.subheader('Monthly spending')
+            # if username == 'other':
+            #     st.text('For user "other" the data is randomized')
+
+            col1, col2 = st.columns(2) # For filtering data to show
+            recurrent = col1.multiselect('Recurrent',[True,False], default=[True,False])
+            include = col2.multiselect('Include', [True,False], default=[True])
+
+            totals, filtered = utils.monthly_total_spending(st.session_state['sheets'][gsheet], gsheet, recurrent, include)
+            utils.show_month_totals(totals, currency)
+
+            # Chart with total spending for all months
+            if filtered is not None:  # filtered is None if there using ghseet "inversiones" -> no need for monthly plot
+                with st.expander('Monthly spending chart'):  
+                    utils.monthly_spending_plot(filtered,include,currency,key=(recurrent,include))
+
+        monthly_spending(st.session_state['gsheet'], currency)
+
+        # --- TRENDS AND FORECAST --------------------------------------
+        # Rolling windows updated with every new movement, the figures are rebuilt only when the data or the day change
+        if st.session_state['gsheet'] != 'inversiones':
+            with st.expander('Trends and forecast'):
+                rolling = utils.get_rolling(st.session_state['gsheet'])
+                utils.forecast_panel(rolling, currency, key=())
+                utils.rolling_chart(rolling, currency, key=())
+                utils.rolling_table(rolling, key=())
 
         # --- SHOW RAW DATA --------------------------------------
-        with st.expander('Raw data'):
-            # Create copy of data, modify column types and sort to show first most recent transactions
-            edited_df = utils.show_raw_data(st.session_state['data'], st.session_state['gsheet'], currency)
-            
-        if st.button('Update data'): # apply changes made in edited_df and update sessions_state df as well as gsheets database
-            # if username=='other':
-            #     st.error('You are not authorized to update the data')
-            # else:
-            with st.status('Updating data'):
-                utils.update_data(edited_df, st.session_state['gsheet'])
-            st.success('Data updated')
+        @utils.fragment # Editing a cell or changing the window reruns only the editor
+        def raw_data(gsheet, currency):
+            data = st.session_state['sheets'][gsheet]
+            with st.expander('Raw data'):
+                # Only a page of the most recent movements is sent to the editor, optionally searched or within a date range
+                col1, col2, col3 = st.columns(3)
+                search = col1.text_input('Search')
+                dates = col2.date_input('Dates', value=(), format='YYYY-MM-DD') # Empty range: all the dates
+                left, right = (dates + (None, None))[:2] if len(dates) > 0 else (None, None)
+                rows = utils.raw_window(data, gsheet, search, left, right)
+                pages = max(1, -(-len(rows) // utils.RAW_PAGE))
+                page = col3.number_input(f'Page (of {pages})', min_value=1, max_value=pages, step=1)
+                rows = rows[(page - 1) * utils.RAW_PAGE:page * utils.RAW_PAGE]
+                st.caption(f'Showing {len(rows)} movements, most recent first')
+                # The editor is reset when the window or the version of the sheet changes, so edits always refer to the rows they were made on
+                window = (gsheet, st.session_state['versions'][gsheet], search, left, right, page)
+                edited_df = utils.show_raw_data(data, gsheet, currency, rows=rows, key=f'raw_data_{hash(window)}')
                 
+            if st.button('Update data'): # apply changes made in edited_df and update sessions_state df as well as gsheets database
+                # if username=='other':
+                #     st.error('You are not authorized to update the data')
+                # else:
+                with st.status('Updating data'):
+                    saved = utils.update_data(edited_df, gsheet, rows=rows) # Only the rows of the window are compared and merged
+                if saved:
+                    st.toast('Data updated')
+                    st.rerun() # The totals and charts of the whole page change with the data
+
+        raw_data(st.session_state['gsheet'], currency)
+
+        # --- AUTO-CATEGORISE --------------------------------------
+        @utils.fragment
+        def auto_categorise(gsheet):
+            with st.expander('Auto-categorise'): # Categories given by the rules in category_rules.json
+                overwrite = st.checkbox('Also change movements that already have a category')
+                suggestions = utils.suggest_categories(st.session_state['sheets'][gsheet], gsheet, overwrite=overwrite)
+                st.dataframe(suggestions, column_config={'date':st.column_config.DateColumn('Date')})
+                if len(suggestions) > 0 and st.button(f'Apply to {len(suggestions)} movements'):
+                    if utils.apply_categories(gsheet, overwrite=overwrite):
+                        st.toast('Categories updated')
+                        st.rerun()
+
+        if st.session_state['gsheet'] != 'inversiones':
+            auto_categorise(st.session_state['gsheet'])
+                
+        # --- HISTORY --------------------------------------
+        @utils.fragment
+        def sheet_history(gsheet):
+            with st.expander('History'): # Every write is a version with only the rows it changed, see history.py
+                log = utils.history.log(gsheet)
+                st.dataframe(log, hide_index=True)
+                if len(log) > 0:
+                    latest = int(log['version'].iloc[0])
+                    col1, col2 = st.columns(2)
+                    a = col1.selectbox('From version', range(latest - 1, -1, -1))  # 0 is the sheet before the first saved change
+                    b = col2.selectbox('To version', range(latest, a, -1))
+                    changes = utils.history_changes(gsheet, a, b)
+                    st.dataframe(utils.history.changes_table(changes, list(st.session_state['sheets'][gsheet].columns)), hide_index=True)
+                    col1, col2 = st.columns(2)
+                    if col1.button(f'Undo version {latest}'):
+                        target = latest - 1
+                    elif col2.button(f'Roll back to version {a}'):
+                        target = a
+                    else:
+                        target = None
+                    if target is not None and utils.rollback(gsheet, target):
+                        st.toast(f'Rolled back to version {target}')
+                        st.rerun()
+
+        sheet_history(st.session_state['gsheet'])
+
+        with st.expander('Connections'): # Connection setups, requests, quota retries and waits of the pool shared by all sessions
+            st.write(utils.connections.metrics(utils.get_pool()))
+
+        with st.expander('Memory usage'): # Savings of the typed columns compared to keeping them as strings
+            st.dataframe(utils.memory_report(), column_config={'Saving':st.column_config.NumberColumn('Saving', format='%.2f')})
+
         # --- SIDEBAR ---------------
         # st.sidebar.title(f'Welcome {username}!')
         # authenticator.logout('Logout', 'sidebar')
+
+utils.profiler_panel() # Waterfall of the stages of this rerun in the sidebar
@@ -0,0 +1,212 @@
+# --- LIBRARIES ------------------------------------------
+import contextlib
+import csv
+import io
+import re
+import numpy as np
+import pandas as pd
+
+# --- BANK STATEMENT IMPORT ------------------------------------------
+# Bulk import of CSV and OFX exports of the banks into the italia/colombia/juanis sheets. The file is read in chunks
+# and every chunk is mapped to the columns of the sheet, so memory depends on the chunk size and on the new rows only.
+# Rows already in the sheet are skipped with a hash of (date, amount, description). Identical movements on the same
+# day (two coffees) are told apart by their occurrence number: the k-th copy of a row in the file is new only if
+# the sheet has less than k copies of it.
+
+COLUMNS = ['date', 'amount', 'category', 'description', 'recurrent', 'include']  # Order of the columns in the sheet
+
+# Names used by the banks for each column, compared in lower case
+ALIASES = {'date': ['date', 'fecha', 'data', 'booking date', 'transaction date', 'posting date', 'data operazione',
+                    'data contabile', 'data valuta', 'fecha transacción', 'fecha de la transacción'],
+           'amount': ['amount', 'importo', 'valor', 'monto', 'importe', 'amount (eur)', 'amount (cop)'],
+           'debit': ['debit', 'addebiti', 'uscite', 'cargo', 'débito', 'debito'],
+           'credit': ['credit', 'accrediti', 'entrate', 'abono', 'crédito', 'credito'],
+           'description': ['description', 'descrizione', 'descripción', 'descripcion', 'concepto', 'memo', 'payee',
+                           'causale', 'details', 'referencia'],
+           'category': ['category', 'categoria', 'categoría']}
+
+# --- COLUMN MAPPING ------------------------------------------
+def map_columns(header: list, mapping=None) -> dict:
+    """Column of the file used for each column of the sheet ('debit'/'credit' when there is no single amount column).
+    mapping overrides the names guessed from ALIASES"""
+
+    found = {}
+    lower = {str(name).strip().lower(): name for name in header}
+    for target, names in ALIASES.items():
+        for name in names:
+            if name in lower:
+                found[target] = lower[name]
+                break
+    found.update(mapping or {})
+    if 'date' not in found or not ('amount' in found or 'debit' in found or 'credit' in found):
+        raise ValueError(f'Could not find the date and amount columns in {list(header)}')
+    return found
+
+def parse_amounts(values: pd.Series, decimal='.') -> pd.Series:
+    """Amounts written as text, with thousands separators and the given decimal mark"""
+    thousands = '.' if decimal == ',' else ','
+    table = str.maketrans({thousands: None, decimal: '.', ' ': None})
+    values = values.astype(str)
+    amounts = pd.to_numeric(values.str.translate(table), errors='coerce')  # One pass over the text for the usual formats
+    odd = amounts.isna() & values.str.strip().ne('') & values.ne('nan')
+    if odd.any():  # Currency symbols or other text around the number
+        cleaned = values[odd].str.replace(r'[^\d,.\-+]', '', regex=True).str.translate(table)
+        amounts[odd] = pd.to_numeric(cleaned, errors='coerce')
+    return amounts
+
+def parse_dates(values: pd.Series, dayfirst=True) -> pd.Series:
+    """Dates written as text. A statement has few different days, so each one is parsed once"""
+    unique = pd.Categorical(values)
+    parsed = pd.to_datetime(pd.Series(unique.categories), dayfirst=dayfirst, errors='coerce', infer_datetime_format=True)
+    dates = parsed.to_numpy(dtype='datetime64[ns]').take(unique.codes) if len(parsed) > 0 else np.full(len(values), np.datetime64('NaT', 'ns'))
+    dates[unique.codes == -1] = np.datetime64('NaT')  # Empty cells
+    return pd.Series(dates, index=values.index)
+
+def to_schema(chunk: pd.DataFrame, columns: dict, dayfirst=True, decimal='.', category=None, recurrent=False, include=True) -> pd.DataFrame:
+    """Map a chunk of the file to the columns of the sheet. Rows without a valid date or amount are dropped"""
+
+    if 'amount' in columns:
+        amount = parse_amounts(chunk[columns['amount']], decimal)
+    else:  # Separate columns for money out and money in
+        amount = pd.Series(0.0, index=chunk.index)
+        if 'debit' in columns:
+            amount -= parse_amounts(chunk[columns['debit']], decimal).abs().fillna(0)
+        if 'credit' in columns:
+            amount += parse_amounts(chunk[columns['credit']], decimal).abs().fillna(0)
+    dates = chunk[columns['date']]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = parse_dates(dates, dayfirst)
+    description = chunk[columns['description']].astype(object).fillna('').astype(str).str.strip() if 'description' in columns else ''
+    rows = pd.DataFrame({'date': dates.dt.normalize(),
+                         'amount': amount.round(2),
+                         'category': chunk[columns['category']] if 'category' in columns else category,
+                         'description': description,
+                         'recurrent': recurrent,
+                         'include': include}, index=chunk.index)
+    return rows.dropna(subset=['date', 'amount'])[COLUMNS]
+
+# --- READERS ------------------------------------------
+@contextlib.contextmanager
+def text_stream(file):
+    """Text stream for a path, an open text file or an uploaded (bytes) file. Only a file opened from a path is closed
+    at the end, the file objects of the caller stay open"""
+    if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+        with open(file, encoding='utf-8-sig', newline='') as stream:
+            yield stream
+    elif isinstance(file, io.TextIOBase):
+        yield file
+    else:
+        stream = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        try:
+            yield stream
+        finally:
+            stream.detach()  # Closing (or collecting) the wrapper would close the uploaded file
+
+DELIMITERS = ',;\t|'  # Used by the banks in their CSV exports
+
+def sniff_delimiter(header: str) -> str:
+    """Delimiter of a CSV export from its header line: the most frequent of DELIMITERS outside quoted names, ',' if none"""
+    unquoted = re.sub(r'"[^"]*"', '', header)
+    delimiter = max(DELIMITERS, key=unquoted.count)
+    return delimiter if unquoted.count(delimiter) > 0 else ','
+
+def read_csv_chunks(file, mapping=None, chunksize=100_000, sep=None, dayfirst=True, decimal='.', **defaults):
+    """Yield the rows of a CSV export in chunks with the columns of the sheet. Without sep the delimiter is sniffed once
+    from the header line, so the file is still read by the C parser instead of the much slower python engine"""
+    with text_stream(file) as stream:
+        options = {}
+        if sep is None:
+            header = stream.readline().rstrip('\r\n')
+            sep = sniff_delimiter(header)
+            options = {'header': None, 'names': [name.strip() for name in next(csv.reader([header], delimiter=sep), [])]}
+        reader = pd.read_csv(stream, sep=sep, dtype=str, chunksize=chunksize, skipinitialspace=True, **options)
+        columns = None
+        for chunk in reader:
+            if columns is None:
+                columns = map_columns(chunk.columns, mapping)
+            yield to_schema(chunk, columns, dayfirst=dayfirst, decimal=decimal, **defaults)
+
+OFX_TAG = re.compile(r'<(STMTTRN|/STMTTRN|DTPOSTED|TRNAMT|NAME|MEMO)>([^<\r\n]*)', re.IGNORECASE)
+
+def read_ofx_chunks(file, chunksize=100_000, **defaults):
+    """Yield the transactions (STMTTRN blocks) of an OFX export in chunks, reading the file line by line.
+    Works with the SGML (OFX 1.x, tags without closing) and XML (OFX 2.x) formats"""
+
+    columns = {'date': 'date', 'amount': 'amount', 'description': 'description'}
+    buffer, current = [], None
+    with text_stream(file) as stream:
+        for line in stream:
+            for tag, value in OFX_TAG.findall(line):
+                tag, value = tag.upper(), value.strip()
+                if tag == 'STMTTRN':
+                    current = {'date': None, 'amount': None, 'name': '', 'memo': ''}
+                elif tag == '/STMTTRN' and current is not None:
+                    description = ' - '.join(text for text in (current['name'], current['memo']) if text)
+                    buffer.append((current['date'], current['amount'], description))
+                    current = None
+                elif current is not None:
+                    key = {'DTPOSTED': 'date', 'TRNAMT': 'amount', 'NAME': 'name', 'MEMO': 'memo'}[tag]
+                    current[key] = value[:8] if tag == 'DTPOSTED' else value  # YYYYMMDD[HHMMSS[.XXX][TZ]]
+            if len(buffer) >= chunksize:
+                yield ofx_chunk(buffer, columns, defaults)
+                buffer = []
+        if buffer:
+            yield ofx_chunk(buffer, columns, defaults)
+
+def ofx_chunk(buffer: list, columns: dict, defaults: dict) -> pd.DataFrame:
+    """DataFrame with the columns of the sheet from the parsed OFX transactions"""
+    raw = pd.DataFrame(buffer, columns=['date', 'amount', 'description'])
+    raw['date'] = pd.to_datetime(raw['date'], format='%Y%m%d', errors='coerce')
+    return to_schema(raw, columns, **defaults)
+
+def read_statement(file, name: str, **options):
+    """Yield the rows of a CSV or OFX file in chunks, depending on the extension of its name"""
+    if name.lower().endswith(('.ofx', '.qfx')):
+        options = {key: value for key, value in options.items() if key not in ('mapping', 'sep', 'dayfirst', 'decimal')}
+        return read_ofx_chunks(file, **options)
+    return read_csv_chunks(file, **options)
+
+# --- DE-DUPLICATION ------------------------------------------
+def row_hashes(rows: pd.DataFrame) -> np.ndarray:
+    """64-bit hash of (date, amount, description) of each row"""
+    key = pd.DataFrame({'date': rows['date'].to_numpy(dtype='datetime64[D]').view(np.int64),
+                        'amount': rows['amount'].round(2).fillna(0).astype(float),
+                        'description': rows['description'].astype(object).fillna('').astype(str).str.strip().str.lower()})
+    return pd.util.hash_pandas_object(key, index=False).to_numpy()
+
+def occurrence_keys(hashes: np.ndarray, seen: pd.Series) -> np.ndarray:
+    """Combine each hash with its occurrence number, counting the copies in seen (copies in earlier chunks)"""
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    if len(seen) > 0:
+        occurrence += seen.reindex(hashes).fillna(0).to_numpy(dtype=np.int64)
+    return pd.util.hash_pandas_object(pd.DataFrame({'hash': hashes, 'occurrence': occurrence}), index=False).to_numpy()
+
+def hash_index(data: pd.DataFrame) -> np.ndarray:
+    """Sorted occurrence keys of the rows already in the sheet"""
+    rows = data.dropna(subset=['date'])
+    return np.sort(occurrence_keys(row_hashes(rows), pd.Series(dtype=np.int64)))
+
+def new_rows(chunks, existing: pd.DataFrame):
+    """Yield, for each chunk, the rows not in the existing sheet"""
+    index = hash_index(existing)
+    seen = pd.Series(dtype=np.int64)  # Copies of each hash in the chunks already read
+    for chunk in chunks:
+        hashes = row_hashes(chunk)
+        keys = occurrence_keys(hashes, seen)
+        position = np.searchsorted(index, keys).clip(max=max(len(index) - 1, 0))
+        known = index[position] == keys if len(index) > 0 else np.zeros(len(keys), dtype=bool)
+        seen = seen.add(pd.Series(hashes).value_counts(), fill_value=0)
+        yield chunk[~known]
+
+def import_statement(file, name: str, existing: pd.DataFrame, **options) -> tuple:
+    """Read a statement and return its new rows as one DataFrame, ready for a single batched write, and the number of rows read"""
+    stats = {'read': 0}
+
+    def counted(chunks):
+        for chunk in chunks:
+            stats['read'] += len(chunk)
+            yield chunk
+
+    parts = list(new_rows(counted(read_statement(file, name, **options)), existing))
+    rows = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=COLUMNS)
+    return rows, stats['read']
@@ -0,0 +1,169 @@
+# --- ANALYTICS BENCHMARK SUITE ------------------------------------------
+# Times the analytics and chart functions of utils on synthetic italia/colombia/inversiones sheets, headless: the
+# Streamlit calls that draw something are replaced by no-ops and the session state by a dict. Every run is appended to
+# benchmarks/analytics_results.jsonl and compared with benchmarks/analytics_baseline.json.
+#
+#   python benchmarks/analytics_bench.py                        # 1k, 100k and 1M rows, exit code 1 on a regression
+#   python benchmarks/analytics_bench.py --sizes 1000 100000    # Only some sizes
+#   python benchmarks/analytics_bench.py --update               # Save the medians as the new baseline
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import streamlit as st
+import utils
+from synthetic import synthetic_spending, synthetic_investments
+
+BASELINE = Path(__file__).resolve().parent / 'analytics_baseline.json'
+RESULTS = Path(__file__).resolve().parent / 'analytics_results.jsonl'
+NOISE_MS = 5.0  # Slowdowns smaller than this are never regressions
+
+# --- STREAMLIT STUB ------------------------------------------
+class Stub:
+    """Accepts any call, attribute or 'with' block and does nothing"""
+    def __call__(self, *args, **kwargs):
+        return self
+    def __getattr__(self, name):
+        return self
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+class SessionState(dict):
+    """Session state with attribute access"""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+def stub_streamlit():
+    """Replace the Streamlit functions used by utils with no-ops, keeping a plain dict as session state"""
+    stub = Stub()
+    for name in ['write', 'dataframe', 'plotly_chart', 'expander', 'subheader', 'text', 'metric', 'sidebar', 'warning',
+                 'caption', 'success', 'status']:
+        setattr(st, name, stub)
+    st.columns = lambda spec, **kwargs: [Stub() for _ in range(spec if isinstance(spec, int) else len(spec))]
+    st.session_state = SessionState()
+    st.secrets = {}
+
+def load_session(sheets: dict, gsheet: str):
+    """Session state as after prefetch_sheets() with the given sheet selected"""
+    st.session_state.clear()
+    st.session_state.update({'sheets': sheets, 'versions': {name: 1 for name in sheets}, 'cubes': {},
+                             'gsheet': gsheet, 'data': sheets[gsheet]})
+
+# --- CASES ------------------------------------------
+def spending_cases(data: pd.DataFrame, gsheet: str) -> dict:
+    """Functions of the Home and Visualize pages for a spending sheet. 'cold' cases build the cube, filter index and rolling windows"""
+    categories = list(data['category'].cat.categories[:6])
+    left, right = pd.Timestamp('2019-03-15'), pd.Timestamp('2024-10-20')
+
+    def cold():
+        st.session_state['cubes'] = {}
+        st.session_state['rolling'] = {}
+        utils.get_store()['derived'].clear()  # Filter index shared by the sessions
+
+    def filter_pipeline():
+        return utils.filter_cube(data, gsheet, categories, [True, False], [True], left, right)
+
+    filtered = None
+    def warm_filtered():
+        nonlocal filtered
+        if filtered is None:
+            filtered = filter_pipeline()
+        return filtered
+
+    def rolling_update():  # One movement added and removed again, the windows stay the same between repetitions
+        rolling = utils.get_rolling(gsheet)
+        utils.rolling_stats.update(rolling, data.iloc[-1:])
+        utils.rolling_stats.update(rolling, data.iloc[-1:], sign=-1)
+
+    return {'cube build (cold)': (cold, lambda: utils.get_cube(gsheet)),
+            'filter index build (cold)': (cold, lambda: utils.get_index(gsheet)),
+            'monthly_total_spending': (None, lambda: utils.monthly_total_spending(data, gsheet, recurrent=[True, False], include=[True])),
+            'filter pipeline': (None, filter_pipeline),
+            'monthly_table': (None, lambda: utils.monthly_table(warm_filtered())),
+            'stacked_bar_chart': (None, lambda: utils.stacked_bar_chart(utils.monthly_cube.cube_frame(utils.get_cube(gsheet)), '€')),
+            'get_monthly_heatmap': (None, lambda: utils.get_monthly_heatmap(utils.monthly_table(warm_filtered()), gsheet)),
+            'rolling windows build (cold)': (cold, lambda: utils.get_rolling(gsheet)),
+            'rolling windows update': (None, rolling_update),
+            'forecast_panel': (None, lambda: utils.forecast_panel(utils.get_rolling(gsheet), '€')),
+            'rolling_chart': (None, lambda: utils.rolling_chart(utils.get_rolling(gsheet), '€'))}
+
+def investment_cases(data: pd.DataFrame) -> dict:
+    """Functions of the Visualize page for the inversiones sheet"""
+    return {'monthly_total_spending': (None, lambda: utils.monthly_total_spending(data, 'inversiones')),
+            'process_investments': (None, lambda: utils.process_investments(data))}
+
+def time_case(setup, case, repeat: int) -> float:
+    """Median time of a case in ms. The first call is not timed (lazy imports, caches)"""
+    if setup is not None:
+        setup()
+    case()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        case()
+        times.append(1000 * (time.perf_counter() - start))
+    return round(statistics.median(times), 2)
+
+def run(sizes: list, repeat: int) -> dict:
+    """Time every case at every size: {'gsheet/case/rows': ms}"""
+    results = {}
+    for n in sizes:
+        sheets = {'italia': synthetic_spending(n, 'italia', seed=1),
+                  'colombia': synthetic_spending(n, 'colombia', seed=2),
+                  'inversiones': synthetic_investments(n, seed=3)}
+        for gsheet in ['italia', 'colombia', 'inversiones']:
+            load_session(sheets, gsheet)
+            cases = investment_cases(sheets[gsheet]) if gsheet == 'inversiones' else spending_cases(sheets[gsheet], gsheet)
+            for name, (setup, case) in cases.items():
+                key = f'{gsheet}/{name}/{n}'
+                results[key] = time_case(setup, case, repeat if n < 1_000_000 else max(1, repeat // 2))
+                print(f'{key:55s} {results[key]:10.1f} ms')
+    return results
+
+# --- RESULTS ------------------------------------------
+def regressions(current: dict, baseline: dict, tolerance: float) -> list:
+    """Cases slower than the baseline by more than the tolerance (and more than NOISE_MS)"""
+    return [(key, baseline[key], ms) for key, ms in current.items()
+            if key in baseline and ms > baseline[key] * (1 + tolerance) and ms - baseline[key] > NOISE_MS]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of the utils analytics functions')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown over the baseline (0.25 = 25%%)')
+    parser.add_argument('--update', action='store_true', help='Save the measurement as the new baseline')
+    args = parser.parse_args()
+
+    stub_streamlit()
+    current = run(args.sizes, args.repeat)
+    with open(RESULTS, 'a') as file:
+        file.write(json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                               'pandas': pd.__version__, 'results': current}) + '\n')
+
+    failed = False
+    if args.update:
+        baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+        BASELINE.write_text(json.dumps({**baseline, **current}, indent=2) + '\n')
+        print(f'Baseline saved in {BASELINE.name}')
+    elif BASELINE.exists():
+        slow = regressions(current, json.loads(BASELINE.read_text()), args.tolerance)
+        for key, before, now in slow:
+            print(f'Regression in {key}: {before:.1f} ms -> {now:.1f} ms')
+        failed = len(slow) > 0
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# --- BANK IMPORT BENCHMARK ------------------------------------------
+# Times the streaming import of a synthetic CSV bank export against a sheet that already has part of its rows.
+#
+#   python benchmarks/import_bench.py --rows 1000000
+
+import argparse
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bank_import
+
+def synthetic_statement(n: int, seed=0) -> pd.DataFrame:
+    """Movements of a bank export: dates, amounts with decimal comma and a few thousand different descriptions"""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3650, n), 'D')
+    amounts = np.where(rng.random(n) < 0.9, -rng.lognormal(3, 1, n), rng.lognormal(7, 0.5, n)).round(2)
+    return pd.DataFrame({'Data operazione': dates.strftime('%d/%m/%Y'),
+                         'Descrizione': [f'PAGAMENTO POS {i}' for i in rng.integers(0, 5000, n)],
+                         'Importo': pd.Series(amounts).map('{:.2f}'.format).str.replace('.', ',', regex=False)})
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming bank import benchmark')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--overlap', type=float, default=0.2, help='Share of the rows of the file already in the sheet')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'statement.csv'
+        for i, start in enumerate(range(0, args.rows, args.chunksize)):  # Written in chunks so the file is never in memory
+            part = synthetic_statement(min(args.chunksize, args.rows - start), seed=i)
+            part.to_csv(path, sep=';', index=False, mode='a', header=i == 0)
+        existing = next(bank_import.read_csv_chunks(path, sep=';', decimal=',', chunksize=int(args.rows * args.overlap) or 1))
+        size = path.stat().st_size / 1e6
+
+        start = time.perf_counter()
+        rows, read = bank_import.import_statement(path, path.name, existing, sep=';', decimal=',', chunksize=args.chunksize)
+        elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    print(f'{read} rows read ({size:.0f} MB), {len(existing)} already in the sheet, {len(rows)} new')
+    print(f'{elapsed:.2f} s, {read / elapsed:,.0f} rows/s, peak memory {peak:.0f} MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# --- IMPORT TIME BENCHMARK ------------------------------------------
+# Measures the cold import time of utils (imported by every page) with `python -X importtime`, keeping the
+# median of several runs, and compares it with the baseline saved in benchmarks/import_time_baseline.json.
+#
+#   python benchmarks/import_time.py            # Compare with the baseline, exit code 1 on a regression
+#   python benchmarks/import_time.py --update   # Save the current measurement as the new baseline
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / 'import_time_baseline.json'
+WATCHED = ['streamlit', 'pandas', 'numpy', 'plotly.express', 'matplotlib', 'seaborn', 'streamlit_gsheets', 'streamlit_option_menu']
+FORBIDDEN = ['plotly.express', 'matplotlib', 'seaborn']  # Must not be loaded just by importing utils (streamlit itself loads parts of plotly)
+
+def measure(module='utils') -> dict:
+    """Import the module in a fresh interpreter and return the cumulative import time (ms) of it and of the watched packages"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        times.setdefault(name, int(cumulative) / 1000)  # First (outermost) import of each module
+    return {name: times[name] for name in [module] + WATCHED if name in times}
+
+def run(repeat: int) -> dict:
+    """Median of several measurements"""
+    runs = [measure() for _ in range(repeat)]
+    names = set().union(*runs)
+    return {name: round(statistics.median(r.get(name, 0.0) for r in runs), 1) for name in sorted(names)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark of utils')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters to measure')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown over the baseline (0.25 = 25%%)')
+    parser.add_argument('--update', action='store_true', help='Save the measurement as the new baseline')
+    args = parser.parse_args()
+
+    current = run(args.repeat)
+    for name, ms in current.items():
+        print(f'{name:25s} {ms:10.1f} ms')
+
+    failed = False
+    loaded = [name for name in FORBIDDEN if name in current]
+    if loaded:
+        print('Loaded by "import utils": ' + ', '.join(loaded))
+        failed = True
+
+    if args.update:
+        BASELINE.write_text(json.dumps(current, indent=2) + '\n')
+        print(f'Baseline saved in {BASELINE.name}')
+    elif BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text())
+        limit = baseline['utils'] * (1 + args.tolerance)
+        print(f'Baseline {baseline["utils"]:.1f} ms, limit {limit:.1f} ms')
+        if current['utils'] > limit:
+            print('Import time regression')
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
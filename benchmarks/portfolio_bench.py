@@ -0,0 +1,51 @@
+# --- PORTFOLIO ANALYTICS BENCHMARK ------------------------------------------
+# Times the portfolio analytics on a synthetic inversiones sheet.
+#
+#   python benchmarks/portfolio_bench.py --positions 100000 --instruments 500
+#
+# With --instruments the positions are spread over that many instruments with 11 years of daily prices in a temporary
+# price store, and the mark-to-market valuation is timed too.
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import portfolio
+import price_store
+from synthetic import synthetic_investments, synthetic_prices
+
+def main():
+    parser = argparse.ArgumentParser(description='Portfolio analytics benchmark')
+    parser.add_argument('--positions', type=int, default=100_000)
+    parser.add_argument('--instruments', type=int, default=0, help='Instruments with prices, 0 to value at cost')
+    args = parser.parse_args()
+
+    data = synthetic_investments(args.positions)
+    asof = pd.Timestamp('2024-12-31')
+    cases = {'position_returns': lambda: portfolio.position_returns(data, asof),
+             'portfolio_xirr': lambda: portfolio.portfolio_xirr(data, asof),
+             'time_weighted_return': lambda: portfolio.time_weighted_return(data, asof),
+             'allocation by Type': lambda: portfolio.allocation(data, 'Type', asof),
+             'allocation by Platform': lambda: portfolio.allocation(data, 'Platform', asof)}
+    if args.instruments:
+        data['Investment'] = [f'inv {i % args.instruments}' for i in range(len(data))]
+        folder = Path(tempfile.mkdtemp())
+        prices = synthetic_prices(args.instruments)
+        cases['price import'] = lambda: price_store.append(prices, folder)
+        cases['price store load'] = lambda: price_store.load(folder)  # Maps the sorted file written by the import
+        cases['marked_values'] = lambda: portfolio.marked_values(data, price_store.load(folder), asof)
+        cases['daily_values by Type'] = lambda: portfolio.daily_values(data, price_store.load(folder), 'Type', asof)
+        cases['daily_values by Platform'] = lambda: portfolio.daily_values(data, price_store.load(folder), 'Platform', asof)
+        cases['time_weighted_return marked'] = lambda: portfolio.time_weighted_return(data, asof, store=price_store.load(folder))
+    print(f'{args.positions:,} positions' + (f', {args.instruments} instruments with {len(prices):,} prices' if args.instruments else ''))
+    for name, case in cases.items():
+        start = time.perf_counter()
+        case()
+        print(f'{name:28s} {1000 * (time.perf_counter() - start):10.1f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# --- RERUN LATENCY BENCHMARK ------------------------------------------
+# Time of the reruns caused by changing a filter on the Home and Visualize pages, with the pages run headless by the
+# Streamlit testing framework on a temporary SQLite database filled with synthetic sheets.
+#
+#   python benchmarks/rerun_bench.py                 # 100k movements per spending sheet
+#   python benchmarks/rerun_bench.py --rows 1000000
+#
+# 'whole page' is the rerun of the whole script, as it was before the sections became fragments (and as it still is
+# with Streamlit < 1.33). 'fragment' is the time of the section that owns the widget: what a rerun of that section alone
+# costs. The testing framework always reruns the whole script, so it is read from the profiling span of the section.
+
+import argparse
+import datetime
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from streamlit.testing.v1 import AppTest
+import sqlite_store
+import utils
+from synthetic import synthetic_spending, synthetic_investments
+
+PIN = 1234
+
+# --- SETUP ------------------------------------------
+def make_database(path: Path, rows: int):
+    """SQLite database with synthetic italia, colombia, juanis and inversiones sheets"""
+    conn = sqlite_store.connect(str(path))
+    sheets = {'italia': synthetic_spending(rows, 'italia', seed=1), 'colombia': synthetic_spending(rows, 'colombia', seed=2),
+              'juanis': synthetic_spending(rows // 10, 'italia', seed=3), 'inversiones': synthetic_investments(500, seed=4)}
+    for gsheet, data in sheets.items():
+        sqlite_store.write_sheet(conn, gsheet, utils.storage_frame(data, gsheet))
+    conn.close()
+
+def open_page(page: str, database: Path) -> AppTest:
+    """Page after login, with profiling on and the SQLite backend"""
+    app = AppTest.from_file(str(ROOT / page), default_timeout=300)
+    app.secrets['password'] = PIN
+    app.secrets['storage'] = {'backend': 'sqlite', 'path': str(database)}
+    app.secrets['profiling'] = {'enabled': True, 'panel': False}
+    app.run()
+    app.number_input[0].set_value(PIN).run()
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+    return app
+
+def widget(elements, label: str):
+    """Widget of a page by its label"""
+    return next(element for element in elements if element.label == label)
+
+def fragment_ms(app: AppTest, section: str) -> float:
+    """Duration of the section in the last rerun, NaN if there are no fragments (Streamlit < 1.33)"""
+    spans = [item['duration_ms'] for item in app.session_state['trace']['spans'] if item['name'] == 'fragment' and item.get('part') == section]
+    return sum(spans) if spans else float('nan')
+
+# --- INTERACTIONS ------------------------------------------
+def interactions() -> list:
+    """(name, page, section, change) with change(app, i) modifying a widget differently on every repetition"""
+    day = datetime.date(2020, 1, 1)
+    return [('Visualize: minimum date', 'pages/2_📈_Visualize.py', 'filters_and_charts',
+             lambda app, i: widget(app.date_input, 'Minimum date').set_value(day + datetime.timedelta(days=31 * i))),
+            ('Visualize: category', 'pages/2_📈_Visualize.py', 'filters_and_charts',
+             lambda app, i: widget(app.multiselect, 'Category').set_value(['Mercado', 'Salidas'][: 1 + i % 2])),
+            ('Home: recurrent', 'Home.py', 'monthly_spending',
+             lambda app, i: widget(app.multiselect, 'Recurrent').set_value([[True], [False], [True, False]][i % 3])),
+            ('Home: search raw data', 'Home.py', 'raw_data',
+             lambda app, i: widget(app.text_input, 'Search').set_value(f'movement {i}'))]
+
+def run(rows: int, repeat: int) -> list:
+    """Median time of the whole rerun and of the section for every interaction"""
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        database = Path(folder) / 'bench.db'
+        make_database(database, rows)
+        for name, page, section, change in interactions():
+            app = open_page(page, database)
+            whole, part = [], []
+            for i in range(repeat):
+                change(app, i)
+                start = time.perf_counter()
+                app.run()
+                whole.append(1000 * (time.perf_counter() - start))
+                part.append(fragment_ms(app, section))
+            results.append((name, statistics.median(whole), statistics.median(part)))
+            print(f'{name:30s} whole page {results[-1][1]:8.1f} ms   fragment {results[-1][2]:8.1f} ms')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency of the reruns of the Home and Visualize pages')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
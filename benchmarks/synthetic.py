@@ -0,0 +1,54 @@
+# --- SYNTHETIC SHEETS ------------------------------------------
+# Deterministic generators of sheets with the columns and types of the real ones, for the benchmarks.
+
+import numpy as np
+import pandas as pd
+
+SPENDING = {'italia': {'categories': ['Salidas', 'Mercado', 'Trabajo', 'Administrativo', 'Alojamiento', 'Ahorros',
+                                      'Compras varias', 'Servicios', 'Almuerzos', 'Transporte', 'Viajes', 'Salud'],
+                       'income': ['Trabajo', 'Ahorros'], 'scale': 30.0},
+            'colombia': {'categories': ['Ahorros', 'Salidas', 'Transporte', 'Compras', 'Viajes', 'Salario', 'Clases particulares'],
+                         'income': ['Salario', 'Clases particulares'], 'scale': 80_000.0}}
+
+def synthetic_spending(n: int, gsheet='italia', seed=0, years=10) -> pd.DataFrame:
+    """Movements of a spending sheet over the last years: mostly small expenses, some incomes and a few large recurrent ones"""
+    rng = np.random.default_rng(seed)
+    spec = SPENDING[gsheet]
+    categories = np.array(spec['categories'])
+    category = categories[rng.integers(0, len(categories), n)]
+    income = np.isin(category, spec['income'])
+    amount = np.where(income, rng.lognormal(3.5, 0.4, n) * spec['scale'], -rng.lognormal(0, 1.0, n) * spec['scale']).round(2)
+    dates = pd.Timestamp('2024-12-31') - pd.to_timedelta(rng.integers(0, 365 * years, n), 'D')
+    return pd.DataFrame({'date': dates,
+                         'amount': amount,
+                         'category': pd.Categorical(category, categories=list(categories)),
+                         'description': [f'movement {i}' for i in rng.integers(0, 50_000, n)],
+                         'recurrent': rng.random(n) < 0.3,
+                         'include': rng.random(n) < 0.9})
+
+def synthetic_investments(n: int, seed=0) -> pd.DataFrame:
+    """Positions opened over 10 years, 30% of them still active"""
+    rng = np.random.default_rng(seed)
+    opening = pd.Timestamp('2014-01-01') + pd.to_timedelta(rng.integers(0, 3650, n), 'D')
+    days = rng.integers(30, 2000, n)
+    active = rng.random(n) < 0.3
+    amount = rng.uniform(1e5, 1e7, n).round()
+    closing = amount * (1 + rng.normal(0.08, 0.1, n)) ** (days / 365)
+    return pd.DataFrame({'Investment': [f'inv {i}' for i in range(n)],
+                         'Platform': pd.Categorical(rng.choice(['Bancolombia', 'Trii', 'Tyba', 'XTB'], n)),
+                         'Type': pd.Categorical(rng.choice(['Acciones', 'Fondo', 'Divisas', 'ETF', 'Particular'], n)),
+                         'Opening date': opening,
+                         'Amount opening': amount,
+                         'Closing date': pd.Series(opening + pd.to_timedelta(days, 'D')).where(~active),
+                         'Amount closing': np.where(active, np.nan, closing.round()),
+                         'Comments': ''})
+
+def synthetic_prices(instruments: int, seed=0, start='2014-01-01', end='2024-12-31') -> pd.DataFrame:
+    """Daily prices (date, instrument, price) of the instruments 'inv 0', 'inv 1'... as random walks, in long format like the CSV imports"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end, freq='D')
+    returns = rng.normal(0.0003, 0.01, (instruments, len(dates)))
+    prices = 100 * np.exp(np.cumsum(returns, axis=1))
+    return pd.DataFrame({'date': np.tile(dates, instruments),
+                         'instrument': np.repeat([f'inv {i}' for i in range(instruments)], len(dates)),
+                         'price': prices.ravel().round(4)})
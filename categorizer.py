@@ -0,0 +1,139 @@
+# --- LIBRARIES ------------------------------------------
+import json
+import re
+import string
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# --- AUTO-CATEGORISATION RULES ------------------------------------------
+# Rules are defined per sheet in category_rules.json, in order of priority:
+#   {"italia": [{"category": "Mercado", "keywords": ["esselunga", "coop"]}, {"category": "Viajes", "regex": "ryanair|easyjet"}]}
+# Keywords are matched as whole words, case-insensitive. All the keywords of a sheet are compiled into one table of
+# word sequences: the descriptions are joined into a single text, split into words once and every word (or sequence of
+# words, for keywords like 'ita airways') is looked up in that table with a hash index, so there is no loop in Python
+# over the rows. Regex rules are combined into one pattern with a named group per rule, searched in the joined text
+# (a regex can't match across two descriptions unless it matches a new line). When several rules match a
+# description the first one in the list wins, and it is reported with the text it matched.
+
+RULES_PATH = Path(__file__).parent / 'category_rules.json'
+COMPILED = {}  # {(sheet, path, mtime of the rules file): compiled rules}
+SEPARATOR = '\x01'  # Word between two descriptions in the joined text
+NO_RULE = np.iinfo(np.int32).max
+SPACES = str.maketrans({ch: ' ' for ch in string.punctuation + string.whitespace})  # Punctuation splits words
+
+def words(text: str) -> list:
+    """Lower-case words of a text"""
+    return text.lower().translate(SPACES).split()
+
+def rule_name(rule: dict, position: int) -> str:
+    """Name shown for a rule: its 'name' or the category and its position in the list"""
+    return rule.get('name') or f"{rule['category']} #{position + 1}"
+
+def compile_rules(rules: list) -> dict:
+    """Compile the rules of a sheet: keywords grouped by number of words, regexes in one pattern"""
+
+    keywords = {}  # {number of words: {'words a b': (rule, keyword)}}
+    for i, rule in enumerate(rules):
+        for keyword in rule.get('keywords', []):
+            key = words(keyword)
+            if key:
+                keywords.setdefault(len(key), {}).setdefault(' '.join(key), (i, keyword))  # The first rule keeps a repeated keyword
+    regexes = [f'(?P<r{i}>{rule["regex"]})' for i, rule in enumerate(rules) if rule.get('regex')]
+    return {'keywords': {n: {'index': pd.Index(list(table.keys())),
+                             'rules': np.array([rule for rule, _ in table.values()], dtype=np.int32),
+                             'text': np.array([keyword for _, keyword in table.values()], dtype=object),
+                             'first': np.array(sorted({key.split(' ')[0] for key in table}), dtype=object)}
+                         for n, table in keywords.items()},
+            'regex': re.compile('|'.join(regexes), re.IGNORECASE) if regexes else None,
+            'categories': np.array([rule['category'] for rule in rules], dtype=object),
+            'names': np.array([rule_name(rule, i) for i, rule in enumerate(rules)], dtype=object)}
+
+def load_rules(sheet: str, path=RULES_PATH) -> dict:
+    """Compiled rules of a sheet, compiled again only when the rules file changes"""
+    path = Path(path)
+    mtime = path.stat().st_mtime if path.exists() else None
+    key = (sheet, str(path), mtime)
+    if key not in COMPILED:
+        rules = json.loads(path.read_text(encoding='utf-8')).get(sheet, []) if mtime is not None else []
+        COMPILED[key] = compile_rules(rules)
+    return COMPILED[key]
+
+# --- APPLY RULES ------------------------------------------
+def keyword_matches(texts: np.ndarray, compiled: dict, best: np.ndarray, matched: np.ndarray):
+    """Look up the keywords in all the texts at once, keeping in best the first rule matching each text"""
+
+    joined = f' {SEPARATOR} '.join(texts)
+    if joined.count(SEPARATOR) != len(texts) - 1:  # The separator can't appear inside a description
+        joined = f' {SEPARATOR} '.join(text.replace(SEPARATOR, ' ') for text in texts)
+    tokens = np.array(words(joined), dtype=object)
+    row = np.cumsum(tokens == SEPARATOR)  # Text of each word
+    padded = np.append(tokens, [''] * max(compiled['keywords']))
+    for n, table in compiled['keywords'].items():
+        if n == 1:
+            at, grams = np.arange(len(tokens)), tokens
+        else:  # Sequences of n words, only where the first word starts a keyword
+            at = np.flatnonzero(np.isin(tokens, table['first']))
+            grams = padded[at]
+            for shift in range(1, n):
+                grams = grams + ' ' + padded[at + shift]
+        found = table['index'].get_indexer(grams)
+        hit = np.flatnonzero(found >= 0)
+        keep_first(best, matched, row[at[hit]], table['rules'][found[hit]], table['text'][found[hit]])
+
+def regex_matches(texts: np.ndarray, compiled: dict, best: np.ndarray, matched: np.ndarray):
+    """Search the regex rules in all the texts joined by new lines (one scan in C), keeping in best the first rule matching each text.
+    The row of each match is found from its position, so new lines inside a description don't matter"""
+    starts = np.cumsum([0] + [len(text) + 1 for text in texts[:-1]])
+    found = [(match.start(), match.lastgroup, match.group()) for match in compiled['regex'].finditer('\n'.join(texts))]
+    if found:
+        position, group, text = zip(*found)
+        rows = np.searchsorted(starts, position, side='right') - 1
+        keep_first(best, matched, rows, np.array([int(name[1:]) for name in group], dtype=np.int32), np.array(text, dtype=object))
+
+def keep_first(best: np.ndarray, matched: np.ndarray, rows: np.ndarray, rules: np.ndarray, text: np.ndarray):
+    """Update the best rule of each text with the matches (row, rule, matched text) when they come first in the list of rules"""
+    order = np.lexsort((rules, rows))  # The first rule of each text comes first
+    rows, rules, text = rows[order], rules[order], text[order]
+    first = np.r_[True, rows[1:] != rows[:-1]] if len(rows) else np.zeros(0, dtype=bool)
+    rows, rules, text = rows[first], rules[first], text[first]
+    better = rules < best[rows]
+    best[rows[better]] = rules[better]
+    matched[rows[better]] = text[better]
+
+def categorize(descriptions: pd.Series, compiled: dict) -> pd.DataFrame:
+    """Category, rule and matched text for every description. Rows not matched by any rule get None"""
+
+    codes, texts = pd.factorize(descriptions.astype(object).fillna('').astype(str))
+    texts = np.asarray(texts, dtype=object)  # Each distinct description once
+    best = np.full(len(texts), NO_RULE, dtype=np.int32)
+    matched = np.full(len(texts), None, dtype=object)
+    if len(texts) > 0 and compiled['keywords']:
+        keyword_matches(texts, compiled, best, matched)
+    if len(texts) > 0 and compiled['regex'] is not None:
+        regex_matches(texts, compiled, best, matched)
+
+    rule = best[codes]
+    fired = rule != NO_RULE
+    category = np.full(len(codes), None, dtype=object)
+    name = np.full(len(codes), None, dtype=object)
+    category[fired] = compiled['categories'][rule[fired]]
+    name[fired] = compiled['names'][rule[fired]]
+    return pd.DataFrame({'category': category, 'rule': name, 'match': matched[codes]}, index=descriptions.index)
+
+def fill_categories(data: pd.DataFrame, compiled: dict, overwrite=False) -> pd.DataFrame:
+    """Copy of a spending sheet with the categories given by the rules, only for the rows without category unless overwrite.
+    Adds the columns 'rule' and 'match' with the rule that fired in each changed row"""
+
+    labels = categorize(data['description'], compiled)
+    target = labels['category'].notna() & (labels['category'] != data['category'].astype(object)) if overwrite \
+        else labels['category'].notna() & data['category'].isna()
+    data = data.copy()
+    category = data['category'].astype(object).where(~target, labels['category'])
+    if isinstance(data['category'].dtype, pd.CategoricalDtype):  # Keep the column categorical with the new categories
+        known = data['category'].cat.categories
+        category = pd.Categorical(category, categories=known.append(pd.Index(sorted(set(category.dropna()) - set(known)))))
+    data['category'] = category
+    data['rule'] = labels['rule'].where(target)
+    data['match'] = labels['match'].where(target)
+    return data
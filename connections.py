@@ -0,0 +1,100 @@
+# --- LIBRARIES ------------------------------------------
+import functools
+import random
+import sqlite3
+import threading
+import time
+
+# --- CONNECTION POOL ------------------------------------------
+# One pool per server process (utils.get_pool() creates it with st.cache_resource) owns the connection to the storage
+# backend: the authenticated client is created on first use and reused by every session and by the journal flusher.
+# Requests go through call(), which holds one of max_requests slots so the sessions and the prefetch threads can't
+# flood the API, and retries quota errors (HTTP 429) and a locked SQLite database with exponential backoff and jitter.
+# Pooled(pool) looks like the backend module (same functions and arguments) but runs every function through call().
+# Only the reads in READS are retried: a write is sent once, because a write that failed halfway (rows deleted, then
+# a quota error reading them back) would change the wrong rows if sent again. The journal checks the row count of a
+# failed write before sending it again.
+
+READS = {'sync_sheet', 'check_sheet', 'count_rows', 'freshness', 'monthly_cells', 'filter_rows', 'table_columns',
+         'month_flows', 'date_bounds', 'raw_positions'}
+
+def new_pool(backend, connect, max_requests=4, retries=5, backoff=1.0) -> dict:
+    """Pool for a backend module. connect() creates the connection, only once unless reset()"""
+    return {'backend': backend, 'connect': connect, 'conn': None, 'lock': threading.Lock(),
+            'slots': threading.BoundedSemaphore(max_requests), 'max_requests': max_requests, 'retries': retries, 'backoff': backoff,
+            'metrics': {'setups': 0, 'requests': 0, 'retries': 0, 'failures': 0, 'active': 0, 'peak': 0, 'wait_ms': 0.0}}
+
+def connection(pool: dict):
+    """The connection of the pool, created on first use"""
+    with pool['lock']:
+        if pool['conn'] is None:
+            pool['conn'] = pool['connect']()
+            pool['metrics']['setups'] += 1
+        return pool['conn']
+
+def reset(pool: dict):
+    """Drop the connection, the next request creates a new one"""
+    with pool['lock']:
+        pool['conn'] = None
+
+def is_retryable(error: Exception) -> bool:
+    """Quota errors of the Google APIs and a SQLite database locked by another writer"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    if isinstance(error, sqlite3.OperationalError):
+        return 'locked' in str(error)
+    return 'RESOURCE_EXHAUSTED' in str(error) or 'Quota exceeded' in str(error)
+
+def call(pool: dict, func, *args, **kwargs):
+    """Run func(*args, **kwargs) holding one of the request slots, retrying quota errors with exponential backoff"""
+    return request(pool, pool['retries'], func, args, kwargs)
+
+def call_once(pool: dict, func, *args, **kwargs):
+    """Run func(*args, **kwargs) holding one of the request slots, without retries"""
+    return request(pool, 0, func, args, kwargs)
+
+def request(pool: dict, retries: int, func, args, kwargs):
+    metrics = pool['metrics']
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        with pool['slots']:
+            with pool['lock']:
+                metrics['wait_ms'] += 1000 * (time.perf_counter() - start)
+                metrics['requests'] += 1
+                metrics['active'] += 1
+                metrics['peak'] = max(metrics['peak'], metrics['active'])
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if not is_retryable(error) or attempt == retries:
+                    with pool['lock']:
+                        metrics['failures'] += 1
+                    raise
+                with pool['lock']:
+                    metrics['retries'] += 1
+            finally:
+                with pool['lock']:
+                    metrics['active'] -= 1
+        time.sleep(pool['backoff'] * 2 ** attempt * random.uniform(0.5, 1.5))  # Waiting without holding a slot
+
+def metrics(pool: dict) -> dict:
+    """Connection setups, requests, retried quota errors, failures, busiest moment and total time waiting for a slot"""
+    with pool['lock']:
+        return {**pool['metrics'], 'max_requests': pool['max_requests']}
+
+class Pooled:
+    """The backend module of a pool with every function running through call(), or call_once() for writes: pooled.sync_sheet(conn, gsheet, ncols)"""
+
+    def __init__(self, pool: dict):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        func = getattr(self.pool['backend'], name)
+        if not callable(func):
+            return func
+        run = call if name in READS else call_once
+        @functools.wraps(func)
+        def pooled(*args, **kwargs):
+            return run(self.pool, func, *args, **kwargs)
+        return pooled
@@ -0,0 +1,45 @@
+# --- LIBRARIES ------------------------------------------
+from collections import OrderedDict
+
+# --- FIGURE CACHE ------------------------------------------
+# Bounded LRU cache for the Plotly figures and pivot tables of the charts. Keys are (kind, gsheet, version, *filters):
+# the version of the sheet is bumped by every write, so a cached figure is never served for older data, and
+# invalidate() drops the entries of a sheet as soon as it is written.
+
+def new_cache(max_entries=64) -> dict:
+    """Create an empty cache keeping at most max_entries figures"""
+    return {'entries': OrderedDict(), 'max_entries': max_entries, 'hits': 0, 'misses': 0}
+
+def freeze(value):
+    """Turn the lists and dicts used as filters into tuples so they can be part of a key"""
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    return value
+
+def lookup(cache: dict, key: tuple, build):
+    """Return the cached value for key, calling build() to create it on a miss"""
+    key = freeze(key)
+    entries = cache['entries']
+    if key in entries:
+        entries.move_to_end(key)  # Most recently used
+        cache['hits'] += 1
+        return entries[key]
+    cache['misses'] += 1
+    value = build()
+    entries[key] = value
+    while len(entries) > cache['max_entries']:  # Evict the least recently used
+        entries.popitem(last=False)
+    return value
+
+def invalidate(cache: dict, gsheet=None):
+    """Drop the entries of one sheet, or all of them if gsheet is None"""
+    for key in [key for key in cache['entries'] if gsheet is None or key[1] == gsheet]:
+        del cache['entries'][key]
+
+def stats(cache: dict) -> dict:
+    """Hit and miss counters of the cache"""
+    total = cache['hits'] + cache['misses']
+    return {'hits': cache['hits'], 'misses': cache['misses'], 'entries': len(cache['entries']),
+            'hit rate': cache['hits'] / total if total else 0.0}
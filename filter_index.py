@@ -0,0 +1,55 @@
+# --- LIBRARIES ------------------------------------------
+import numpy as np
+import pandas as pd
+
+# --- FILTER INDEX ------------------------------------------
+# Built once per version of a spending sheet. The rows are sorted by date so a date range is a slice found with a
+# binary search, and the category and the recurrent/include flags of each row are kept as small integer codes in the
+# same order. A filter looks up the codes of the rows inside the date range in tables of allowed values, so its cost
+# depends on the rows in the range, not on the size of the sheet.
+
+def build_index(data: pd.DataFrame) -> dict:
+    """Build the filter index of a spending sheet. Rows without date are left out"""
+
+    dates = data['date'].to_numpy(dtype='datetime64[ns]')
+    order = np.argsort(dates, kind='stable')      # NaT goes last
+    valid = int((~np.isnat(dates)).sum())
+    order = order[:valid]
+
+    category = pd.Categorical(data['category'])
+    flags = 2 * data['recurrent'].to_numpy(dtype=bool) + data['include'].to_numpy(dtype=bool)
+    return {'dates': dates[order],
+            'labels': data.index.to_numpy()[order],     # Labels of the rows in date order
+            'codes': category.codes[order] + 1,         # 0 is a row without category
+            'categories': category.categories,
+            'flags': flags[order].astype(np.int8)}
+
+def date_slice(index: dict, left=None, right=None) -> slice:
+    """Positions in the index of the rows with left <= date <= right"""
+    dates = index['dates']
+    lo = 0 if left is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(left), 'ns'), side='left')
+    hi = len(dates) if right is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(right), 'ns'), side='right')
+    return slice(lo, hi)
+
+def select(index: dict, categories=None, recurrent=(True, False), include=(True, False), left=None, right=None) -> np.ndarray:
+    """Labels of the rows matching all the filters, in date order"""
+
+    rows = date_slice(index, left, right)
+    keep = np.ones(rows.stop - rows.start, dtype=bool)
+    if categories is not None:
+        allowed = np.zeros(len(index['categories']) + 1, dtype=bool)
+        allowed[index['categories'].get_indexer(list(categories)) + 1] = True
+        allowed[0] = False                          # get_indexer() gives -1 for unknown categories
+        keep &= allowed[index['codes'][rows]]
+    allowed_flags = np.zeros(4, dtype=bool)
+    for r in recurrent:
+        for i in include:
+            allowed_flags[2 * bool(r) + bool(i)] = True
+    keep &= allowed_flags[index['flags'][rows]]
+    return index['labels'][rows][keep]
+
+def date_bounds(index: dict):
+    """First and last date of the sheet"""
+    if len(index['dates']) == 0:
+        return None, None
+    return pd.Timestamp(index['dates'][0]), pd.Timestamp(index['dates'][-1])
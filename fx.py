@@ -0,0 +1,93 @@
+# --- LIBRARIES ------------------------------------------
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# --- FX RATES ------------------------------------------
+# Daily exchange rates kept in a local CSV in long format, easy to append to:
+#   date,currency,rate
+#   2024-05-02,COP,4180.5      -> 1 EUR = 4180.5 COP on that day
+# Rates are units of the currency per 1 EUR, so EUR is always 1. A movement is converted with the last rate known on
+# its date (an as-of join with merge_asof). Movements older than the table use its first rate.
+
+RATES_PATH = Path(__file__).parent / 'fx_rates.csv'
+SHEET_CURRENCY = {'italia': 'EUR', 'colombia': 'COP', 'juanis': 'COP'}
+CURRENCY_SYMBOL = {'EUR': '\N{euro sign}', 'COP': '$', 'USD': 'US$'}
+LOADED = {}  # {rates_key(path): rates}
+
+def rates_key(path=RATES_PATH) -> tuple:
+    """(path, mtime_ns, size) of the rates file, changes with every write. None if there is no file"""
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return (str(path), stat.st_mtime_ns, stat.st_size)
+
+def load_rates(path=RATES_PATH) -> pd.DataFrame:
+    """Rates as a date-sorted table with one column per currency, read again only when the file changes.
+    Returns None if there is no table"""
+    key = rates_key(path)
+    if key is None:
+        return None
+    if key not in LOADED:
+        rates = pd.read_csv(path, parse_dates=['date'])
+        table = rates.pivot_table(index='date', columns='currency', values='rate', aggfunc='last').sort_index()
+        table['EUR'] = 1.0
+        LOADED.clear()
+        LOADED[key] = table.ffill().bfill()  # Currencies quoted on different days
+    return LOADED[key]
+
+def add_rate(currency: str, rate: float, day=None, path=RATES_PATH):
+    """Append the rate of a currency (units per 1 EUR) for a day, today by default"""
+    path = Path(path)
+    day = day or datetime.date.today()
+    new = not path.exists()
+    with open(path, 'a') as file:
+        if new:
+            file.write('date,currency,rate\n')
+        file.write(f'{pd.Timestamp(day):%Y-%m-%d},{currency},{rate}\n')
+
+def currencies(rates: pd.DataFrame) -> list:
+    """Currencies available in the table"""
+    return sorted(rates.columns)
+
+# --- CONVERSION ------------------------------------------
+def factors(rates: pd.DataFrame, currency: str, base: str) -> pd.DataFrame:
+    """Factor to convert an amount in currency to base for each date of the table"""
+    return pd.DataFrame({'fx_date': rates.index, 'fx': (rates[base] / rates[currency]).to_numpy()})
+
+def convert(data: pd.DataFrame, currency: str, base: str, rates: pd.DataFrame) -> pd.Series:
+    """Amounts of a spending sheet in the base currency, with the rate of the date of each movement"""
+
+    if currency == base:
+        return data['amount'].astype(float)
+    table = factors(rates, currency, base)
+    dates = data['date'].to_numpy(dtype='datetime64[ns]')
+    order = np.argsort(dates, kind='stable')  # merge_asof needs sorted keys, NaT last
+    valid = order[~np.isnat(dates[order])]
+    left = pd.DataFrame({'date': dates[valid], 'position': valid})
+    joined = pd.merge_asof(left, table, left_on='date', right_on='fx_date', direction='backward')
+    fx = np.full(len(data), np.nan)
+    fx[joined['position'].to_numpy()] = joined['fx'].fillna(table['fx'].iloc[0]).to_numpy()  # Before the table: first rate
+    return pd.Series(data['amount'].to_numpy(dtype=float) * fx, index=data.index)
+
+def consolidate(sheets: dict, base: str, rates: pd.DataFrame) -> pd.DataFrame:
+    """All the spending sheets in one frame with the amounts in the base currency and the sheet of each movement"""
+
+    names = [gsheet for gsheet, currency in SHEET_CURRENCY.items() if gsheet in sheets and currency in rates.columns]
+    if not names:
+        return pd.DataFrame(columns=['date', 'amount', 'original amount', 'currency', 'sheet', 'category', 'recurrent', 'include'])
+    frames = [sheets[gsheet] for gsheet in names]
+    sizes = [len(data) for data in frames]
+    currencies = sorted({SHEET_CURRENCY[gsheet] for gsheet in names})
+    codes = np.repeat(np.arange(len(names)), sizes)  # Sheet of each row, the strings are never repeated
+    categories = pd.api.types.union_categoricals([pd.Categorical(data['category']) for data in frames], ignore_order=True)
+    return pd.DataFrame({'date': np.concatenate([data['date'].to_numpy(dtype='datetime64[ns]') for data in frames]),
+                         'amount': np.concatenate([convert(data, SHEET_CURRENCY[gsheet], base, rates).to_numpy() for gsheet, data in zip(names, frames)]),
+                         'original amount': np.concatenate([data['amount'].to_numpy(dtype=float) for data in frames]),
+                         'currency': pd.Categorical.from_codes(np.repeat([currencies.index(SHEET_CURRENCY[gsheet]) for gsheet in names], sizes), currencies),
+                         'sheet': pd.Categorical.from_codes(codes, names),
+                         'category': categories,
+                         'recurrent': np.concatenate([data['recurrent'].to_numpy(dtype=bool) for data in frames]),
+                         'include': np.concatenate([data['include'].to_numpy(dtype=bool) for data in frames])})
@@ -0,0 +1,137 @@
+# --- LIBRARIES ------------------------------------------
+import datetime
+import hashlib
+import json
+import threading
+import numpy as np
+import pandas as pd
+from sheet_cache import CACHE_DIR, to_cell
+
+# --- VERSION HISTORY ------------------------------------------
+# Every write of the app (edits in the raw data editor, new movements, imports, re-categorising, rollbacks) adds a
+# version of the sheet to .cache/history/<gsheet>.jsonl. A version only holds its delta: the rows it touched with
+# their position, the old values of the edited and deleted rows and the new values of the edited and inserted ones.
+# The file grows with the size of the edits, not with the size of the sheet. Each version is addressed by the hash
+# of its delta and of the previous version, like a commit. The version before the first one is the sheet as it was
+# when the history started.
+# Comparing two versions walks the deltas between them, following the position of each row as rows above it are
+# deleted. Rolling back applies the reverse of that comparison as one more write: edited rows get their old values,
+# inserted rows are deleted and deleted rows come back at the end of the sheet (the app orders the rows by date).
+
+HISTORY_DIR = CACHE_DIR / 'history'
+LOCK = threading.Lock()
+LOADED = {}  # {gsheet: ((mtime, size), versions)}
+
+def history_path(gsheet: str):
+    return HISTORY_DIR / f'{gsheet}.jsonl'
+
+def cells(row) -> list:
+    """Values of a row as they are stored in the sheet and in the history"""
+    return json.loads(json.dumps([to_cell(value) for value in row]))
+
+# --- RECORD ------------------------------------------
+def delta_from_diff(old: pd.DataFrame, diff: dict, start: int) -> dict:
+    """Delta of a write from a diff of sheet_cache.diff_frames(). old has the stored values of (at least) the touched rows,
+    indexed by position, and start is the position of the first inserted row in the new version"""
+
+    edited = {}
+    for position, col, value in diff['cells']:
+        edited.setdefault(position, cells(old.loc[position]))[col] = cells([value])[0]
+    return {'edited': [[position, cells(old.loc[position]), cells(row)] for position, row in sorted(edited.items())],
+            'deleted': [[position, cells(old.loc[position])] for position in sorted(diff['deleted'])],
+            'inserted': [[start + i, cells(row)] for i, row in enumerate(diff['inserted'])]}
+
+def record(gsheet: str, delta: dict, summary: str) -> dict:
+    """Add a version with the delta of a write after the last one of the sheet. Nothing is added for an empty delta"""
+
+    if not (delta['edited'] or delta['deleted'] or delta['inserted']):
+        return None
+    with LOCK:
+        previous = versions(gsheet)
+        parent = previous[-1]['id'] if previous else None
+        body = json.dumps({'parent': parent, 'delta': delta}, sort_keys=True)
+        version = {'id': hashlib.sha1(body.encode()).hexdigest(), 'parent': parent, 'version': len(previous) + 1,
+                   'time': datetime.datetime.now().isoformat(timespec='seconds'), 'summary': summary, 'delta': delta}
+        HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+        with open(history_path(gsheet), 'a', encoding='utf-8') as file:
+            file.write(json.dumps(version) + '\n')
+    return version
+
+def versions(gsheet: str) -> list:
+    """All the versions of a sheet, oldest first. Read again only when the file changes"""
+    path = history_path(gsheet)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return []
+    key = (stat.st_mtime_ns, stat.st_size)
+    if gsheet not in LOADED or LOADED[gsheet][0] != key:
+        loaded = []
+        for line in path.read_text(encoding='utf-8').splitlines():
+            try:
+                loaded.append(json.loads(line))
+            except ValueError:  # Last line cut by a crash
+                break
+        LOADED[gsheet] = (key, loaded)
+    return LOADED[gsheet][1]
+
+def log(gsheet: str) -> pd.DataFrame:
+    """One row per version, most recent first"""
+    rows = [{'version': v['version'], 'id': v['id'][:10], 'time': v['time'], 'summary': v['summary'],
+             'edited': len(v['delta']['edited']), 'deleted': len(v['delta']['deleted']), 'inserted': len(v['delta']['inserted'])}
+            for v in versions(gsheet)]
+    return pd.DataFrame(rows, columns=['version', 'id', 'time', 'summary', 'edited', 'deleted', 'inserted']).iloc[::-1]
+
+# --- COMPARE ------------------------------------------
+def net_changes(history: list, a: int, b: int) -> dict:
+    """What changed from version a to version b (a < b, 0 is the start of the history), with positions in version b:
+    {'edited': [(position, old, new)], 'added': [(position, row)], 'removed': [row]}"""
+
+    introduced = {}  # {position in the current version: (row, row at version a or None if it didn't exist)}
+    removed = []
+    for version in history[a:b]:
+        delta = version['delta']
+        for position, old, new in delta['edited']:
+            introduced[position] = (new, introduced[position][1] if position in introduced else old)
+        for position, old in delta['deleted']:
+            if position in introduced:
+                original = introduced.pop(position)[1]
+                if original is not None:  # Edited after a and then deleted: its value at a is what was removed
+                    removed.append(original)
+            else:
+                removed.append(old)
+        deleted = np.sort([position for position, _ in delta['deleted']])
+        if len(deleted) > 0:  # Rows below a deleted one move up
+            introduced = {int(position - np.searchsorted(deleted, position)): entry for position, entry in introduced.items()}
+        for position, row in delta['inserted']:
+            introduced[position] = (row, None)
+    return {'edited': [(position, original, row) for position, (row, original) in sorted(introduced.items()) if original is not None and row != original],
+            'added': [(position, row) for position, (row, original) in sorted(introduced.items()) if original is None],
+            'removed': removed}
+
+def changes_table(changes: dict, columns: list) -> pd.DataFrame:
+    """Changes returned by net_changes() as a table: the values before and after of edited rows, added and removed rows"""
+    rows = []
+    for position, old, new in changes['edited']:
+        rows.append({'change': 'edited (before)', 'row': position, **dict(zip(columns, old))})
+        rows.append({'change': 'edited (after)', 'row': position, **dict(zip(columns, new))})
+    rows += [{'change': 'added', 'row': position, **dict(zip(columns, row))} for position, row in changes['added']]
+    rows += [{'change': 'removed', 'row': None, **dict(zip(columns, row))} for row in changes['removed']]
+    return pd.DataFrame(rows, columns=['change', 'row'] + list(columns)).astype({'row': 'Int64'})  # Removed rows have no position
+
+# --- ROLLBACK ------------------------------------------
+def stored(value):
+    """Value of the history as given to the writes, empty cells as None"""
+    return None if value == '' else value
+
+def rollback_diff(changes: dict) -> dict:
+    """Diff, in the format of sheet_cache.diff_frames(), that takes the sheet back from version b to version a of net_changes()"""
+    return {'cells': [(position, col, stored(old[col])) for position, old, new in changes['edited'] for col in range(len(old)) if old[col] != new[col]],
+            'deleted': [position for position, _ in changes['added']],
+            'inserted': [[stored(value) for value in row] for row in changes['removed']]}
+
+def matches(current: pd.DataFrame, changes: dict) -> bool:
+    """True if the touched rows of the sheet (stored values, indexed by position) are still the ones of the last version,
+    False if the sheet was changed outside the app and a rollback could touch the wrong rows"""
+    expected = [(position, new) for position, _, new in changes['edited']] + changes['added']
+    return all(position in current.index and cells(current.loc[position]) == row for position, row in expected)
@@ -0,0 +1,228 @@
+# --- LIBRARIES ------------------------------------------
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from sheet_cache import CACHE_DIR, to_cell
+
+# --- WRITE-AHEAD JOURNAL ------------------------------------------
+# Every write of the app is first appended to a local journal (one JSON line, fsync'd) and applied to the data in the
+# session state, so adding or editing a movement only waits for the disk. A background thread sends the pending
+# entries to the storage backend in order: consecutive appends to the same sheet go in one batch and a failed flush is
+# retried with exponential backoff.
+# Each batch is recorded as 'begin' (with the number of rows of the sheet before writing) and 'done'. After a crash a
+# batch left between both is only replayed if the sheet still has the rows it had before: appends and deletions change
+# that number, cell updates can be sent twice without harm. When nothing is pending the journal is emptied.
+# A batch the database rejects (a sheet that doesn't exist, an invalid value) would fail forever and hold back every
+# write after it: after PARK_AFTER such failures it is moved to .cache/journal_parked.jsonl and the queue goes on.
+# Network and quota errors are never parked, they are retried until they succeed.
+
+JOURNAL_PATH = CACHE_DIR / 'journal.jsonl'
+PARKED_PATH = CACHE_DIR / 'journal_parked.jsonl'
+PARK_AFTER = 3                   # Rejections of a batch before it is parked
+LOCK = threading.RLock()         # Writes to the journal file
+FLUSH_LOCK = threading.Lock()    # Only one flush at a time
+BACKOFF = (1.0, 60.0)            # First and maximum seconds between retries
+FLUSHER = {'thread': None, 'wake': threading.Event(), 'flushed': 0, 'retries': 0, 'error': None, 'rejected': {}}
+
+def write_record(record: dict):
+    """Append one record to the journal and wait until it is on disk"""
+    with LOCK:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with open(JOURNAL_PATH, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+def read_records() -> list:
+    """All the records of the journal. A last line cut by a crash is ignored, it was never acknowledged"""
+    with LOCK:
+        try:
+            lines = JOURNAL_PATH.read_text(encoding='utf-8').splitlines()
+        except FileNotFoundError:
+            return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            break
+    return records
+
+# --- RECORD WRITES ------------------------------------------
+def record(gsheet: str, op: str, payload) -> str:
+    """Save a write in the journal and wake up the flusher. op is 'append' (payload: list of rows) or
+    'diff' (payload: dict from sheet_cache.diff_frames()). Returns the id of the entry"""
+
+    if op == 'append':
+        payload = [[to_cell(value) for value in row] for row in payload]
+    else:
+        payload = {'cells': [(position, col, to_cell(value)) for position, col, value in payload['cells']],
+                   'deleted': list(payload['deleted']),
+                   'inserted': [[to_cell(value) for value in row] for row in payload['inserted']]}
+    entry_id = uuid.uuid4().hex
+    write_record({'kind': 'entry', 'id': entry_id, 'gsheet': gsheet, 'op': op, 'payload': payload})
+    FLUSHER['wake'].set()
+    return entry_id
+
+def entry_steps(entry: dict) -> list:
+    """Split an entry into steps that change the sheet in a single way: cells, deleted rows or appended rows"""
+    gsheet, payload = entry['gsheet'], entry['payload']
+    if entry['op'] == 'append':
+        return [{'id': entry['id'], 'gsheet': gsheet, 'op': 'append', 'rows': payload}]
+    steps = []
+    if payload['cells']:
+        steps.append({'id': entry['id'] + ':cells', 'gsheet': gsheet, 'op': 'cells', 'cells': payload['cells']})
+    if payload['deleted']:
+        steps.append({'id': entry['id'] + ':deleted', 'gsheet': gsheet, 'op': 'deleted', 'deleted': payload['deleted']})
+    if payload['inserted']:
+        steps.append({'id': entry['id'] + ':inserted', 'gsheet': gsheet, 'op': 'append', 'rows': payload['inserted']})
+    return steps
+
+def pending_steps(records: list):
+    """Steps not flushed yet in journal order, and the 'begin' records of the batches that may have been interrupted"""
+    done = {step for r in records if r['kind'] in ('done', 'parked') for step in r['steps']}
+    begun = {step: r for r in records if r['kind'] == 'begin' for step in r['steps']}
+    steps = [step for r in records if r['kind'] == 'entry' for step in entry_steps(r) if step['id'] not in done]
+    return steps, {step: r for step, r in begun.items() if step not in done}
+
+def plan(steps: list, begun: dict) -> list:
+    """Group the pending steps into batches: consecutive appends to the same sheet are sent together.
+    An interrupted batch is retried with exactly the same steps so its row count check stays valid"""
+
+    batches = []
+    i = 0
+    while i < len(steps):
+        step = steps[i]
+        if step['id'] in begun:
+            ids = set(begun[step['id']]['steps'])
+            size = sum(1 for s in steps[i:i + len(ids)] if s['id'] in ids)
+        elif step['op'] == 'append':
+            size = 1
+            while (i + size < len(steps) and steps[i + size]['op'] == 'append' and steps[i + size]['gsheet'] == step['gsheet']
+                   and steps[i + size]['id'] not in begun):
+                size += 1
+        else:
+            size = 1
+        batches.append(steps[i:i + size])
+        i += size
+    return batches
+
+def queue_depth() -> int:
+    """Number of journal entries not completely sent to the database"""
+    steps, _ = pending_steps(read_records())
+    return len({step['id'].split(':')[0] for step in steps})
+
+def pending_sheets() -> set:
+    """Sheets with writes not sent to the database yet"""
+    steps, _ = pending_steps(read_records())
+    return {step['gsheet'] for step in steps}
+
+# --- FLUSH ------------------------------------------
+def row_change(batch: list) -> int:
+    """Rows added (or removed if negative) by a batch"""
+    return sum(len(step['rows']) if step['op'] == 'append' else -len(step['deleted']) if step['op'] == 'deleted' else 0
+               for step in batch)
+
+def is_rejected(error: Exception) -> bool:
+    """True if the database refused the write itself, so sending it again would fail the same way"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return 400 <= status < 500 and status not in (408, 429)  # Timeouts and quota errors pass
+    if isinstance(error, sqlite3.OperationalError):
+        return 'locked' not in str(error)
+    return isinstance(error, (sqlite3.IntegrityError, sqlite3.ProgrammingError, ValueError, KeyError, TypeError))
+
+def park(batch: list, error: Exception):
+    """Move a rejected batch out of the queue: its steps are kept in the parked file and marked as parked in the journal"""
+    with LOCK:
+        with open(PARKED_PATH, 'a', encoding='utf-8') as file:
+            for step in batch:
+                file.write(json.dumps({**step, 'error': repr(error)}) + '\n')
+        write_record({'kind': 'parked', 'steps': [step['id'] for step in batch]})
+
+def parked() -> int:
+    """Number of steps moved out of the queue because the database rejected them"""
+    try:
+        return len(PARKED_PATH.read_text(encoding='utf-8').splitlines())
+    except FileNotFoundError:
+        return 0
+
+def send_batch(backend, conn, batch: list):
+    """Write one batch with the backend"""
+    gsheet, op = batch[0]['gsheet'], batch[0]['op']
+    if op == 'append':
+        backend.append_rows(conn, gsheet, [row for step in batch for row in step['rows']])
+    elif op == 'cells':
+        backend.write_diff(conn, gsheet, {'cells': batch[0]['cells'], 'deleted': [], 'inserted': []})
+    else:
+        backend.write_diff(conn, gsheet, {'cells': [], 'deleted': batch[0]['deleted'], 'inserted': []})
+
+def flush(backend, conn) -> int:
+    """Send all the pending steps to the database in order. Returns the number of steps sent, errors are raised"""
+
+    with FLUSH_LOCK:
+        steps, begun = pending_steps(read_records())
+        for batch in plan(steps, begun):
+            gsheet, ids = batch[0]['gsheet'], [step['id'] for step in batch]
+            change = row_change(batch)
+            rows = backend.count_rows(conn, gsheet) if change != 0 else None
+            interrupted = begun.get(ids[0])
+            if interrupted is not None and change != 0 and rows != interrupted['rows']:
+                write_record({'kind': 'done', 'steps': ids})  # Reached the sheet before the crash
+                continue
+            if interrupted is None:
+                write_record({'kind': 'begin', 'steps': ids, 'rows': rows})
+            try:
+                send_batch(backend, conn, batch)
+            except Exception as error:
+                if not is_rejected(error):
+                    raise
+                FLUSHER['rejected'][ids[0]] = FLUSHER['rejected'].get(ids[0], 0) + 1
+                if FLUSHER['rejected'][ids[0]] < PARK_AFTER:
+                    raise
+                park(batch, error)  # The writes after it can go on
+                del FLUSHER['rejected'][ids[0]]
+                continue
+            FLUSHER['rejected'].pop(ids[0], None)
+            write_record({'kind': 'done', 'steps': ids})
+            FLUSHER['flushed'] += len(ids)
+        compact()
+        return len(steps)
+
+def compact():
+    """Empty the journal when every entry has been sent"""
+    with LOCK:
+        steps, _ = pending_steps(read_records())
+        if not steps and JOURNAL_PATH.exists():
+            tmp = JOURNAL_PATH.with_suffix('.tmp')
+            tmp.write_text('')
+            os.replace(tmp, JOURNAL_PATH)
+
+def flusher_loop(backend, conn, interval: float):
+    """Background loop: flush when woken up by a new entry (or every interval seconds), backing off after errors"""
+    while True:
+        FLUSHER['wake'].wait(timeout=interval)
+        FLUSHER['wake'].clear()
+        try:
+            flush(backend, conn)
+            FLUSHER['retries'], FLUSHER['error'] = 0, None
+        except Exception as error:  # Network or API errors: the entries stay in the journal
+            FLUSHER['retries'] += 1
+            FLUSHER['error'] = repr(error)
+            time.sleep(min(BACKOFF[0] * 2 ** (FLUSHER['retries'] - 1), BACKOFF[1]))
+            FLUSHER['wake'].set()  # Retry right after the backoff
+
+def start_flusher(backend, conn, interval=30.0):
+    """Start the background flusher of this process if it is not running"""
+    with LOCK:
+        if FLUSHER['thread'] is None or not FLUSHER['thread'].is_alive():
+            FLUSHER['thread'] = threading.Thread(target=flusher_loop, args=(backend, conn, interval), name='journal-flusher', daemon=True)
+            FLUSHER['thread'].start()
+    FLUSHER['wake'].set()
+
+def status() -> dict:
+    """Queue depth, parked steps and state of the flusher"""
+    return {'pending': queue_depth(), 'parked': parked(), 'flushed': FLUSHER['flushed'], 'retries': FLUSHER['retries'], 'error': FLUSHER['error']}
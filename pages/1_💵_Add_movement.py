@@ -1,9 +1,10 @@
 import streamlit as st
 import pandas as pd
 import utils
-from streamlit_gsheets import GSheetsConnection
 import time
 
+utils.start_trace('Add movement') # Time the stages of this rerun if profiling is enabled
+
 # --- ADD NEW TRANSACTIONS --------------------------
 st.title('Add new movement')
 selected = utils.sheet_menu()
@@ -38,11 +39,14 @@ if 'auth' in st.session_state:
     if st.session_state['auth']:
 
         # --- INSIDE APP AFTER LOGIN -------------
-        conn = st.connection("gsheets", type=GSheetsConnection, ttl=0)
-        st.session_state['conn'] = conn # Save connection status to database in session state
+        utils.get_conn() # Connection to the storage backend from the pool of the server process (utils.get_pool()), shared by all the sessions
         
+        if 'sheets' not in st.session_state: # Read all the sheets in parallel right after login
+            utils.prefetch_sheets('not_other')
+        else:
+            utils.sync_sheets() # Pick up the changes made by other sessions
         if 'data' not in st.session_state: # In case the data was already read before
-            utils.read_data('not_other', gsheet=gsheet, ncols=ncols) # Read the data from the selected sheet
+            utils.select_sheet('not_other', gsheet=gsheet, ncols=ncols) # Take the selected sheet from the per-sheet store
 
         #if st.button('Reload data'): # Manually reading data
         #    if 'data' in st.session_state:
@@ -63,11 +67,7 @@ if 'auth' in st.session_state:
             #     st.error('You are not authorized to update the data')
             # else:
             #if inserted_pw == int(st.secrets['password']): # Check if password is correct
-            data = st.session_state['data'].copy()
-            data.loc[len(data.index)] = new_row  # Add new row
-            st.session_state['data'] = data  # Save the new data to the session state
-
-            st.session_state['conn'].update(data=data, worksheet=st.session_state['gsheet'])  # Update Google Sheets
+            utils.append_data([new_row], st.session_state['gsheet'])  # Send only the new row to Google Sheets and add it to the session state
 
             # Force reloading data to ensure we see the new row
             #utils.read_data('not_other', gsheet=st.session_state['gsheet'], ncols=len(data.columns))
@@ -76,8 +76,24 @@ if 'auth' in st.session_state:
             #else:
             #    st.error('Incorrect password')
 
+        # --- Import bank statement ------------------------
+        if st.session_state['gsheet'] != 'inversiones':
+            st.subheader('Import bank statement')
+            statement = st.file_uploader('CSV or OFX export of the bank', type=['csv', 'ofx', 'qfx'])
+            col1, col2, col3 = st.columns(3)
+            decimal = col1.selectbox('Decimal mark', ['.', ','])
+            dayfirst = col2.checkbox('Day before month', value=True)  # 01/02/2024 is the 1st of February
+            recurrent = col3.checkbox('Recurrent spending', value=False, key='import_recurrent')
+            if statement is not None and st.button('Import'):
+                read, added, categorised = utils.import_statement(statement, statement.name, st.session_state['gsheet'],
+                                                                  decimal=decimal, dayfirst=dayfirst, recurrent=recurrent)
+                st.success(f'{added} new movements added to "{st.session_state["gsheet"]}" ({categorised} categorised by the rules), '
+                           f'{read - added} were already there')
+
         # --- Sidebar ---------------
         #authenticator = st.session_state['authenticator']
         #authenticator.logout('Logout', 'sidebar')
 
-#st.write(st.session_state['data'].tail(10))
\ No newline at end of file
+#st.write(st.session_state['data'].tail(10))
+
+utils.profiler_panel() # Waterfall of the stages of this rerun in the sidebar
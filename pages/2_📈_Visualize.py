@@ -1,8 +1,8 @@
 import streamlit as st
 import pandas as pd
 import utils
-from streamlit_gsheets import GSheetsConnection
 
+utils.start_trace('Visualize') # Time the stages of this rerun if profiling is enabled
 
 # --- VISUALIZATIONS ---------------------
 st.title('Visualizations of spending')
@@ -35,11 +35,14 @@ if 'auth' in st.session_state:
     if st.session_state['auth']:
 
         # --- INSIDE APP AFTER LOGIN -------------
-        conn = st.connection("gsheets", type=GSheetsConnection, ttl=0)
-        st.session_state['conn'] = conn # Save connection status to database in session state
+        utils.get_conn() # Connection to the storage backend from the pool of the server process (utils.get_pool()), shared by all the sessions
         
+        if 'sheets' not in st.session_state: # Read all the sheets in parallel right after login
+            utils.prefetch_sheets('not_other')
+        else:
+            utils.sync_sheets() # Pick up the changes made by other sessions
         if 'data' not in st.session_state: # In case the data was already read before
-            utils.read_data('not_other', gsheet=gsheet, ncols=ncols) # Read the data from the selected sheet
+            utils.select_sheet('not_other', gsheet=gsheet, ncols=ncols) # Take the selected sheet from the per-sheet store
 
         #if st.button('Reload data'): # Manually reading data
         #    if 'data' in st.session_state:
@@ -48,60 +51,85 @@ if 'auth' in st.session_state:
         #    utils.read_data('not_other', gsheet=gsheet, ncols=ncols)
         #    st.success('Data loaded')
 
-        new_data = st.session_state['data'].copy() # Read the data and format dates
-
         if gsheet == 'inversiones': 
-            new_data = utils.process_investments(new_data)
-            utils.pie_plot_invs(new_data)
+            new_data = utils.process_investments(st.session_state['data']) # Read the data, dates are already parsed when loading it
+            utils.show_investments(new_data)
+            utils.portfolio_summary(st.session_state['data'], key=())
+            utils.pie_plot_invs(new_data, key=())
+
+            # --- Prices ---------------
+            # Active positions are valued at the last imported price of their instrument, at cost if it has none
+            store = utils.get_prices()
+            active = new_data[new_data['Active']]
+            priced = active['Investment'].isin(store['codes'] if store is not None else []).sum()
+            st.caption(f'{priced} of {len(active)} active investments valued at market prices, the rest at cost')
+            with st.expander('Value over time'):
+                utils.portfolio_value_chart(st.session_state['data'], key=())
+            with st.expander('Import prices'): # CSV with the columns date,instrument,price, the instrument is the name of the investment
+                prices = st.file_uploader('CSV of prices or NAVs', type=['csv'])
+                if prices is not None and st.button('Import prices'):
+                    try:
+                        added = utils.import_prices(prices)
+                    except ValueError as error:
+                        st.error(str(error))
+                    else:
+                        st.toast(f'{added} prices imported')
+                        st.rerun() # The values, returns and charts above change with the prices
 
         else:  # if colombia or italia where date column exists
-            new_data['date'] = pd.to_datetime(new_data['date'], yearfirst=True)
-
-            # --- Filter-------
-            st.subheader('Filters')
-
-            all_categories = utils.get_categories(st.session_state['gsheet'])
-            all_categories.insert(0, 'All') # Add 'All' as the first element
-
-            categories = st.multiselect('Category', all_categories, default='All')
-            if 'All' in categories:
-                include_categories = all_categories[1:] # Keep all categories except 'All', as it is not an actual category
-            else:
-                include_categories = categories
-
-            col1, col2 = st.columns(2)
-            recurrent = col1.multiselect('Recurrent',[True,False], default=[True,False])
-            include = col2.multiselect('Include', [True,False], default=[True])
-
-            min_date = new_data['date'].min()
-            max_date = new_data['date'].max()
-            left_date = col1.date_input('Minimum date', min_value=min_date, value=min_date)
-            right_date = col2.date_input('Maximum date', max_value=max_date, value=max_date, min_value=left_date)
-            
-            mask = (new_data['category'].isin(include_categories))&(new_data['recurrent'].isin(recurrent))&(new_data['include'].isin(include))&\
-                (new_data['date'] >= str(left_date))&(new_data['date'] <= str(right_date))
-            new_data['Date'] = pd.to_datetime(new_data.date).dt.strftime('%b-%y')
-            filtered_data = new_data[mask]
-
-            # --- Spending chart ----------
-            if len(filtered_data)>0: # In case filters don't match any data
-                monthly_spend = utils.monthly_table(filtered_data)
-
-                # --- Stacked bar chart -------
-                try:
-                    utils.stacked_bar_chart(new_data, currency)
-                except:
-                    st.error('Error generating barchart')
-
-                # --- Heatmap ------------
-                try:
-                    utils.get_monthly_heatmap(monthly_spend, gsheet)
-                except:
-                    st.error('Error generating heatmap')
-            
-            else:
-                st.warning('No data matches the filters')
+            @utils.fragment # Changing a filter reruns only this section, not the login and the loading of the sheets
+            def filters_and_charts(gsheet, currency):
+                new_data = st.session_state['sheets'][gsheet]
+
+                # --- Filter-------
+                st.subheader('Filters')
+
+                all_categories = utils.get_categories(gsheet)
+                all_categories.insert(0, 'All') # Add 'All' as the first element
+
+                categories = st.multiselect('Category', all_categories, default='All')
+                if 'All' in categories:
+                    include_categories = all_categories[1:] # Keep all categories except 'All', as it is not an actual category
+                else:
+                    include_categories = categories
+
+                col1, col2 = st.columns(2)
+                recurrent = col1.multiselect('Recurrent',[True,False], default=[True,False])
+                include = col2.multiselect('Include', [True,False], default=[True])
+
+                min_date, max_date = utils.date_bounds(gsheet) # From SQLite or the date-sorted index instead of scanning the dates
+                left_date = col1.date_input('Minimum date', min_value=min_date, value=min_date)
+                right_date = col2.date_input('Maximum date', max_value=max_date, value=max_date, min_value=left_date)
+                
+                filters = (include_categories, recurrent, include, left_date, right_date) # Key to reuse the tables and figures while data and filters don't change
+                filtered_data = utils.cached('filter_cube', filters, lambda: utils.filter_cube(new_data, gsheet, *filters)) # Monthly cube cells matching the filters
+
+                # --- Spending chart ----------
+                if len(filtered_data)>0: # In case filters don't match any data
+                    monthly_spend = utils.monthly_table(filtered_data, key=filters)
+
+                    # --- Stacked bar chart -------
+                    try:
+                        utils.stacked_bar_chart(utils.monthly_cube.cube_frame(utils.get_cube(gsheet)), currency, key=())
+                    except:
+                        st.error('Error generating barchart')
+
+                    # --- Heatmap ------------
+                    try:
+                        utils.get_monthly_heatmap(monthly_spend, gsheet, key=filters)
+                    except:
+                        st.error('Error generating heatmap')
+                
+                else:
+                    st.warning('No data matches the filters')
+
+            filters_and_charts(gsheet, currency)
+
+        with st.expander('Figure cache'): # Hits and misses of the cached figures and tables
+            st.write(utils.figure_cache.stats(utils.get_figure_cache()))
 
         # --- Sidebar ---------------
         # authenticator = st.session_state['authenticator']
         # authenticator.logout('Logout', 'sidebar')
+
+utils.profiler_panel() # Waterfall of the stages of this rerun in the sidebar
@@ -0,0 +1,56 @@
+import streamlit as st
+import pandas as pd
+import utils
+
+utils.start_trace('Consolidated') # Time the stages of this rerun if profiling is enabled
+
+# --- CONSOLIDATED VIEW ---------------------
+st.title('All the sheets together')
+st.write('Italy, Colombia and Lupi converted to one currency with the daily exchange rates in _fx_rates.csv_')
+
+if 'auth' not in st.session_state:
+    inserted_pw = st.number_input('Write the required PIN to insert data', step=1) # Can modify data only with the correct password
+    if inserted_pw == int(st.secrets['password']): # Check if password is correct
+        st.session_state['auth'] = True
+        st.success('Correct password')
+    else:
+        st.error('Incorrect password')
+
+if 'auth' in st.session_state:
+    if st.session_state['auth']:
+
+        # --- INSIDE APP AFTER LOGIN -------------
+        utils.get_conn() # Connection to the storage backend from the pool of the server process (utils.get_pool()), shared by all the sessions
+
+        if 'sheets' not in st.session_state: # Read all the sheets in parallel right after login
+            utils.prefetch_sheets('not_other')
+        else:
+            utils.sync_sheets() # Pick up the changes made by other sessions
+        if 'data' not in st.session_state: # In case the data was already read before
+            utils.select_sheet('not_other')
+
+        rates = utils.fx.load_rates()
+        if rates is None:
+            st.warning('There is no table of exchange rates yet, add the first rate below')
+        else:
+            currencies = utils.fx.currencies(rates)
+            base = st.selectbox('Currency', currencies, index=currencies.index('EUR'))
+            symbol = utils.fx.CURRENCY_SYMBOL.get(base, base + ' ')
+            consolidated = utils.get_consolidated(base) # Cached until a sheet or the rates change
+
+            utils.consolidated_summary(consolidated, symbol)
+            utils.consolidated_chart(consolidated, symbol, key=(base,))
+            with st.expander('Monthly expenses by sheet'):
+                utils.consolidated_table(consolidated)
+
+        # --- Add exchange rate ---------------
+        with st.expander('Add exchange rate'): # Units of the currency for 1 EUR
+            col1, col2, col3 = st.columns(3)
+            currency = col1.text_input('Currency', value='COP')
+            rate = col2.number_input('Units for 1 EUR', min_value=0.0, step=0.01)
+            day = col3.date_input('Date')
+            if st.button('Add rate') and rate > 0:
+                utils.fx.add_rate(currency.upper(), rate, day)
+                st.success(f'1 EUR = {rate:,.2f} {currency.upper()} on {day}')
+
+utils.profiler_panel() # Waterfall of the stages of this rerun in the sidebar
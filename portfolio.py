@@ -0,0 +1,258 @@
+# --- LIBRARIES ------------------------------------------
+import numpy as np
+import pandas as pd
+
+# --- PORTFOLIO ANALYTICS ------------------------------------------
+# Analytics over the inversiones sheet. Every position is a cash flow out at 'Opening date' ('Amount opening') and a
+# cash flow in at 'Closing date' ('Amount closing'). Active positions are valued at the as-of date with the given
+# current values, or at cost when there is no better value.
+# All the functions work on whole columns: the IRR of every position is found at once by a batched Newton method
+# safeguarded with bisection, and values over time are computed in chunks of positions to bound memory.
+
+DAYS_YEAR = 365.0
+
+def positions(data: pd.DataFrame, asof=None, values=None) -> dict:
+    """Arrays with the flows of every position. values are the current values of the active positions (default: cost)"""
+
+    asof = pd.Timestamp.today().normalize() if asof is None else pd.Timestamp(asof)
+    open_date = data['Opening date'].to_numpy(dtype='datetime64[ns]')
+    close_date = data['Closing date'].to_numpy(dtype='datetime64[ns]')
+    active = np.isnat(close_date)
+    open_amount = data['Amount opening'].to_numpy(dtype=float)
+    close_amount = data['Amount closing'].to_numpy(dtype=float)
+    current = open_amount if values is None else np.asarray(values, dtype=float)
+    close_amount = np.where(active, current, close_amount)        # Active positions end at the as-of date
+    close_date = np.where(active, np.datetime64(asof, 'ns'), close_date)
+    valid = ~np.isnat(open_date) & np.isfinite(open_amount) & np.isfinite(close_amount) & (open_amount > 0)
+    return {'open_date': open_date, 'close_date': close_date, 'open_amount': open_amount, 'close_amount': close_amount,
+            'active': active, 'valid': valid, 'asof': asof}
+
+def years_between(start, end) -> np.ndarray:
+    """Years between two datetime64 arrays"""
+    return (end - start) / np.timedelta64(1, 'D') / DAYS_YEAR
+
+# --- IRR ------------------------------------------
+def xirr_batch(amounts: np.ndarray, times: np.ndarray, tol=1e-10, max_iter=100) -> np.ndarray:
+    """Annual IRR of each row of cash flows: solves sum(amount * (1 + r) ** -time) = 0 for every row at once.
+    amounts and times are (rows x flows) matrices, times in years and padded with zero amounts. Rows without a sign change give NaN"""
+
+    amounts = np.atleast_2d(np.asarray(amounts, dtype=float))
+    times = np.atleast_2d(np.asarray(times, dtype=float))
+    scale = np.abs(amounts).sum(axis=1)
+    scale[scale == 0] = 1.0
+
+    def npv(x):  # x = log(1 + r)
+        discounted = amounts * np.exp(-x[:, None] * times)
+        return discounted.sum(axis=1) / scale, -(discounted * times).sum(axis=1) / scale
+
+    lo = np.full(len(amounts), -5.0)                  # r = -99.3%
+    hi = np.full(len(amounts), 5.0)                   # r = 14700%
+    f_lo, _ = npv(lo)
+    f_hi, _ = npv(hi)
+    solvable = np.sign(f_lo) != np.sign(f_hi)
+    x = np.full(len(amounts), np.log1p(0.1))
+    for _ in range(max_iter):
+        f, df = npv(x)
+        same_as_lo = np.sign(f) == np.sign(f_lo)
+        lo = np.where(same_as_lo, x, lo)              # Shrink the bracket around the root
+        f_lo = np.where(same_as_lo, f, f_lo)
+        hi = np.where(same_as_lo, hi, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = x - f / df
+        inside = np.isfinite(newton) & (newton > lo) & (newton < hi)
+        x_new = np.where(inside, newton, (lo + hi) / 2)  # Bisection when Newton jumps out of the bracket
+        done = (np.abs(f) < tol) | (hi - lo < tol)
+        x = np.where(done, x, x_new)
+        if done[solvable].all():
+            break
+    return np.where(solvable, np.expm1(x), np.nan)
+
+def position_returns(data: pd.DataFrame, asof=None, values=None) -> pd.DataFrame:
+    """ROI, years held and IRR of every position, including the active ones valued at the as-of date"""
+
+    p = positions(data, asof, values)
+    years = years_between(p['open_date'], p['close_date'])
+    amounts = np.column_stack([-p['open_amount'], p['close_amount']])
+    times = np.column_stack([np.zeros(len(years)), years])
+    irr = np.full(len(years), np.nan)
+    ok = p['valid'] & (years > 0)
+    irr[ok] = xirr_batch(amounts[ok], times[ok])
+    return pd.DataFrame({'Active': p['active'],
+                         'Value': p['close_amount'],
+                         'ROI': p['close_amount'] / p['open_amount'] - 1,
+                         'Years': years,
+                         'IRR': irr}, index=data.index)
+
+def portfolio_xirr(data: pd.DataFrame, asof=None, values=None) -> float:
+    """IRR of the whole portfolio: all the openings, closings and the value of the active positions at the as-of date"""
+
+    p = positions(data, asof, values)
+    v = p['valid']
+    if not v.any():
+        return np.nan
+    start = p['open_date'][v].min()
+    amounts = np.concatenate([-p['open_amount'][v], p['close_amount'][v]])
+    times = np.concatenate([years_between(start, p['open_date'][v]), years_between(start, p['close_date'][v])])
+    return float(xirr_batch(amounts[None, :], times[None, :])[0])
+
+# --- VALUES OVER TIME ------------------------------------------
+def month_grid(data: pd.DataFrame, asof=None) -> pd.DatetimeIndex:
+    """Month ends from the first opening until the as-of date"""
+    asof = pd.Timestamp.today().normalize() if asof is None else pd.Timestamp(asof)
+    start = data['Opening date'].min()
+    if pd.isna(start):
+        return pd.DatetimeIndex([])
+    return pd.date_range(start + pd.offsets.MonthEnd(0), asof + pd.offsets.MonthEnd(0), freq='M')
+
+def value_grid(data: pd.DataFrame, grid: pd.DatetimeIndex, by=None, asof=None, values=None, chunk=4096) -> pd.DataFrame:
+    """Value of the positions at each date of the grid, grouped by the column 'by' (one 'Total' column if None).
+    Between opening and closing each position grows at its own IRR, so it is worth 'Amount opening' when opened
+    and 'Amount closing' (or its current value) when closed"""
+
+    p = positions(data, asof, values)
+    returns = position_returns(data, asof, values)
+    growth = np.log1p(returns['IRR'].fillna(0).to_numpy())
+    groups = pd.Categorical(data[by].astype(object).fillna('')) if by is not None else pd.Categorical(['Total'] * len(data))
+    names = list(groups.categories)
+    codes = groups.codes
+    dates = grid.to_numpy(dtype='datetime64[ns]')
+    totals = np.zeros((len(names), len(dates)))
+
+    for start in range(0, len(data), chunk):  # Bounded (chunk x dates) matrices
+        rows = slice(start, start + chunk)
+        valid = p['valid'][rows]
+        open_date, close_date = p['open_date'][rows][valid], p['close_date'][rows][valid]
+        alive = (open_date[:, None] <= dates[None, :]) & ((close_date[:, None] > dates[None, :]) | p['active'][rows][valid][:, None])
+        held = years_between(open_date[:, None], dates[None, :])
+        value = np.where(alive, p['open_amount'][rows][valid][:, None] * np.exp(growth[rows][valid][:, None] * held), 0.0)
+        onehot = np.zeros((len(names), len(open_date)))
+        onehot[codes[rows][valid], np.arange(len(open_date))] = 1.0
+        totals += onehot @ value
+    return pd.DataFrame(totals.T, index=grid, columns=names)
+
+def net_flows(data: pd.DataFrame, grid: pd.DatetimeIndex, asof=None, values=None) -> pd.Series:
+    """Money put in (openings) minus money taken out (closings) in each interval of the grid"""
+
+    p = positions(data, asof, values)
+    v = p['valid'] & ~np.isnat(p['open_date'])
+    dates = grid.to_numpy(dtype='datetime64[ns]')
+    flows = np.zeros(len(dates))
+    opened = np.searchsorted(dates, p['open_date'][v], side='left')  # Interval (previous grid date, grid date]
+    np.add.at(flows, opened[opened < len(dates)], p['open_amount'][v][opened < len(dates)])
+    closed_rows = v & ~p['active']
+    closed = np.searchsorted(dates, p['close_date'][closed_rows], side='left')
+    np.add.at(flows, closed[closed < len(dates)], -p['close_amount'][closed_rows][closed < len(dates)])
+    return pd.Series(flows, index=grid)
+
+def chained_return(value: np.ndarray, flows: np.ndarray, grid: pd.DatetimeIndex) -> tuple:
+    """Total and annualised return chaining the returns of the intervals of the grid, with the flows of an interval at its end"""
+    previous = value[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        period = np.where(previous > 0, (value[1:] - flows[1:]) / previous - 1, 0.0)
+    total = np.prod(1 + period) - 1
+    years = years_between(grid[0].to_datetime64(), grid[-1].to_datetime64())
+    return float(total), float((1 + total) ** (1 / years) - 1) if years > 0 else np.nan
+
+def time_weighted_return(data: pd.DataFrame, asof=None, values=None, store=None) -> tuple:
+    """Time-weighted return of the portfolio. Returns the total TWR, the annualised TWR and whether it is exact.
+    With a price store it chains daily returns of daily_values(). It is exact only if every position has prices: between its
+    flows a position without prices is valued at its own IRR, which makes the result close to a money-weighted return.
+    Without a store it chains monthly returns of value_grid() and is always approximate"""
+
+    if store is not None:
+        asof = pd.Timestamp.today().normalize() if asof is None else pd.Timestamp(asof)
+        daily = daily_values(data, store, asof=asof)
+        if len(daily) < 2:
+            return np.nan, np.nan, False
+        marked = mark(data, store, asof)
+        p = positions(data, asof, marked['values'])
+        flows = net_flows(data, daily.index, asof, marked['values']).to_numpy()
+        return chained_return(daily['Total'].to_numpy(), flows, daily.index) + (bool((marked['priced'] | ~p['valid']).all()),)
+
+    grid = month_grid(data, asof)
+    if len(grid) < 2:
+        return np.nan, np.nan, False
+    value = value_grid(data, grid, asof=asof, values=values)['Total'].to_numpy()
+    flows = net_flows(data, grid, asof, values).to_numpy()
+    return chained_return(value, flows, grid) + (False,)
+
+def allocation(data: pd.DataFrame, by='Type', asof=None, values=None) -> pd.DataFrame:
+    """Share of the portfolio value in each group of the column 'by' at every month end"""
+
+    grid = month_grid(data, asof)
+    value = value_grid(data, grid, by=by, asof=asof, values=values)
+    total = value.sum(axis=1)
+    return value.div(total.where(total > 0), axis=0).fillna(0)
+
+# --- MARK TO MARKET ------------------------------------------
+# With a history of prices of the instruments (price_store.py) a position is a number of units bought at the opening:
+# 'Amount opening' divided by the price of its instrument ('Investment') that day, or by the first price known if the
+# history starts later. Its value on a day is those units at the price of the day. Positions without prices keep
+# the values above. The daily series adds up the units held of each instrument in each group with a cumulative sum
+# over the days, so it costs (instruments x groups x days) and not (positions x days).
+
+def mark(data: pd.DataFrame, store: dict, asof) -> dict:
+    """Instrument code, price at the opening and value at the as-of date of every position"""
+    import price_store
+    codes = price_store.instrument_codes(store, data['Investment'])
+    open_amount = data['Amount opening'].to_numpy(dtype=float)
+    bought = price_store.prices_on(store, codes, price_store.day_number(data['Opening date']))
+    now = price_store.prices_on(store, codes, np.full(len(codes), price_store.day_number([asof])[0]))
+    priced = np.isfinite(bought) & (bought > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'codes': codes, 'bought': bought, 'priced': priced, 'values': np.where(priced, open_amount * now / bought, open_amount)}
+
+def marked_values(data: pd.DataFrame, store: dict, asof=None) -> np.ndarray:
+    """Value of every position at the price of the as-of date, 'Amount opening' for positions without prices.
+    Pass it as values to the other functions. None if there is no store"""
+    if store is None:
+        return None
+    return mark(data, store, pd.Timestamp.today().normalize() if asof is None else pd.Timestamp(asof))['values']
+
+def daily_values(data: pd.DataFrame, store: dict, by=None, asof=None, chunk=256) -> pd.DataFrame:
+    """Value of the portfolio on every day from the first opening until the as-of date, grouped by the column 'by'
+    (one 'Total' column if None). Positions with prices are marked to market, the rest grow as in value_grid()"""
+
+    asof = pd.Timestamp.today().normalize() if asof is None else pd.Timestamp(asof)
+    start = data['Opening date'].min()
+    if pd.isna(start) or start > asof:
+        return pd.DataFrame()
+    grid = pd.date_range(start.normalize(), asof, freq='D')
+    groups = pd.Categorical(data[by].astype(object).fillna('')) if by is not None else pd.Categorical(['Total'] * len(data))
+    names = list(groups.categories)
+    totals = np.zeros((len(names), len(grid)))
+
+    marked = mark(data, store, asof) if store is not None else None
+    values = None if marked is None else marked['values']
+    p = positions(data, asof, values)
+    priced = np.zeros(len(data), dtype=bool)
+    if marked is not None:
+        import price_store
+        days = price_store.day_number(grid)
+        priced = p['valid'] & marked['priced']
+        units = p['open_amount'][priced] / marked['bought'][priced]
+        # Each (instrument, group) pair gets the units of a position on its opening day and loses them on its closing day
+        keys, pair = np.unique(marked['codes'][priced] * len(names) + groups.codes[priced], return_inverse=True)
+        pairs = np.column_stack([keys // len(names), keys % len(names)])
+        first = np.searchsorted(days, price_store.day_number(p['open_date'][priced]))
+        last = np.where(p['active'][priced], len(days), np.searchsorted(days, price_store.day_number(p['close_date'][priced])))
+        instruments, row = np.unique(pairs[:, 0], return_inverse=True)  # pairs are sorted by instrument
+        prices = price_store.price_table(store, instruments, days)  # Instruments x days, read from the mapped file
+        width = len(days) + 1
+        for lo in range(0, len(pairs), chunk):  # Bounded (chunk x days) matrices
+            hi = min(lo + chunk, len(pairs))
+            mine = (pair >= lo) & (pair < hi)
+            flat = (pair[mine] - lo) * width
+            size = (hi - lo) * width
+            held = np.bincount(flat + first[mine], units[mine], size) - np.bincount(flat + last[mine], units[mine], size)
+            held = held.reshape(hi - lo, width)[:, :-1].cumsum(axis=1)
+            onehot = np.zeros((len(names), hi - lo))
+            onehot[pairs[lo:hi, 1], np.arange(hi - lo)] = 1.0
+            totals += onehot @ (held * prices[row[lo:hi]])
+
+    totals = pd.DataFrame(totals.T, index=grid, columns=names)
+    rest = ~priced
+    if rest.any():
+        other = value_grid(data[rest], grid, by=by, asof=asof, values=None if values is None else values[rest], chunk=chunk)
+        totals += other.reindex(columns=names, fill_value=0.0)
+    return totals
@@ -0,0 +1,152 @@
+# --- LIBRARIES ------------------------------------------
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from sheet_cache import CACHE_DIR
+
+# --- PRICE STORE ------------------------------------------
+# Local history of prices (or NAVs) of the instruments of the inversiones sheet, filled by importing CSV files with
+# the columns date,instrument,price, one row per instrument and day. The instrument is the 'Investment' of the sheet.
+# The prices are fixed-size binary records (instrument code, day, price) in .cache/prices/:
+#   prices.log     every imported record, append-only, in the order of the imports
+#   prices.bin     the same records sorted by instrument and day, one per day (the last imported wins), rewritten after each import
+#   instruments.json  names of the instruments, the code of an instrument is its position in the list
+# prices.bin is memory-mapped, not read: loading it costs the same for a week or for years of prices, and a lookup only
+# touches the pages of the instruments it asks for. The prices of an instrument are a contiguous slice found by binary search.
+#
+#   python price_store.py prices.csv    # Import from the command line
+
+PRICES_DIR = CACHE_DIR / 'prices'
+RECORD = np.dtype([('instrument', '<i4'), ('day', '<i4'), ('price', '<f8')])
+COLUMNS = ['date', 'instrument', 'price']
+LOCK = threading.Lock()
+LOADED = {}  # {folder: (key, store)}
+
+def paths(folder=PRICES_DIR) -> dict:
+    return {'log': folder / 'prices.log', 'sorted': folder / 'prices.bin', 'instruments': folder / 'instruments.json'}
+
+def day_number(dates) -> np.ndarray:
+    """Days since 1970-01-01 of each date, in the type of the records. Missing dates are before any price"""
+    days = np.asarray(dates, dtype='datetime64[D]')
+    return np.where(np.isnat(days), np.iinfo(np.int32).min, days.astype(np.int64)).astype(np.int32)
+
+def instruments(folder=PRICES_DIR) -> list:
+    path = paths(folder)['instruments']
+    return json.loads(path.read_text(encoding='utf-8')) if path.exists() else []
+
+def read_records(path) -> np.ndarray:
+    """Records of a file mapped in memory, without reading them. A record cut by a crash at the end is left out"""
+    count = path.stat().st_size // RECORD.itemsize if path.exists() else 0
+    if count == 0:  # np.memmap can't map an empty file
+        return np.zeros(0, dtype=RECORD)
+    return np.memmap(path, dtype=RECORD, mode='r', shape=(count,)).view(np.ndarray)  # Plain view of the mapping, slicing a memmap is slow
+
+# --- IMPORT ------------------------------------------
+def append(prices: pd.DataFrame, folder=PRICES_DIR) -> int:
+    """Add prices (columns date, instrument, price) to the log and rebuild the sorted file. Returns the number of prices added"""
+
+    prices = prices.dropna(subset=COLUMNS)
+    prices = prices[prices['price'] > 0]
+    with LOCK:
+        names = instruments(folder)
+        codes = {name: i for i, name in enumerate(names)}
+        new = [name for name in pd.unique(prices['instrument']) if name not in codes]
+        names += new
+        codes.update({name: len(codes) + i for i, name in enumerate(new)})
+        records = np.empty(len(prices), dtype=RECORD)
+        records['instrument'] = prices['instrument'].map(codes).to_numpy()
+        records['day'] = day_number(prices['date'])
+        records['price'] = prices['price'].to_numpy(dtype=float)
+
+        folder.mkdir(parents=True, exist_ok=True)
+        files = paths(folder)
+        files['instruments'].write_text(json.dumps(names, ensure_ascii=False), encoding='utf-8')
+        with open(files['log'], 'ab') as file:
+            file.write(records.tobytes())
+        compact(folder)
+    return len(records)
+
+def compact(folder=PRICES_DIR):
+    """Write the sorted file from the log: records ordered by instrument and day, keeping the last one imported for each day"""
+
+    files = paths(folder)
+    log = read_records(files['log'])
+    ordered = log[np.lexsort((log['day'], log['instrument']))]  # Stable: the records of a day stay in the order they were imported
+    last = np.ones(len(ordered), dtype=bool)
+    last[:-1] = (ordered['instrument'][1:] != ordered['instrument'][:-1]) | (ordered['day'][1:] != ordered['day'][:-1])
+    temporary = files['sorted'].with_suffix('.tmp')
+    ordered[last].tofile(temporary)
+    os.replace(temporary, files['sorted'])  # Sessions that mapped the old file keep reading it until they load again
+
+def import_csv(file, folder=PRICES_DIR, **options) -> int:
+    """Import a CSV of prices with the columns date, instrument and price. options are passed to pandas.read_csv"""
+    prices = pd.read_csv(file, **options)
+    prices.columns = [str(column).strip().lower() for column in prices.columns]
+    missing = [column for column in COLUMNS if column not in prices.columns]
+    if missing:
+        raise ValueError(f'Could not find the columns {missing} in {list(prices.columns)}')
+    prices['date'] = pd.to_datetime(prices['date'], errors='coerce')
+    prices['instrument'] = prices['instrument'].astype(str).str.strip()
+    prices['price'] = pd.to_numeric(prices['price'], errors='coerce')
+    return append(prices, folder)
+
+# --- LOAD ------------------------------------------
+def load(folder=PRICES_DIR) -> dict:
+    """The store mapped in memory, mapped again only when an import changes it. None if there are no prices.
+    {'key', 'names', 'codes': {name: code}, 'records', 'starts': first record of each code (and the end)}"""
+
+    path = paths(folder)['sorted']
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    if folder not in LOADED or LOADED[folder][0] != key:
+        records = read_records(path)
+        names = instruments(folder)
+        starts = np.searchsorted(records['instrument'], np.arange(len(names) + 1))  # Binary search, nothing is read in full
+        LOADED[folder] = (key, {'key': key, 'names': names, 'codes': {name: i for i, name in enumerate(names)},
+                                'records': records, 'starts': starts})
+    store = LOADED[folder][1]
+    return store if len(store['records']) > 0 else None
+
+# --- LOOKUP ------------------------------------------
+def instrument_codes(store: dict, names) -> np.ndarray:
+    """Code of each instrument name, -1 if it has no prices"""
+    return pd.Series(names, dtype=object).map(store['codes']).fillna(-1).to_numpy(dtype=np.int64)
+
+def lookup(store: dict, code: int, days) -> np.ndarray:
+    """Price of an instrument on each day: the last one known on or before the day, or the first one for days before
+    the history starts. NaN if the instrument has no prices"""
+
+    days = np.asarray(days)
+    if code < 0:
+        return np.full(days.shape, np.nan)
+    a, b = store['starts'][code], store['starts'][code + 1]
+    if a == b:
+        return np.full(days.shape, np.nan)
+    records = store['records'][a:b]
+    position = np.searchsorted(records['day'], days, side='right') - 1
+    return np.asarray(records['price'][np.maximum(position, 0)], dtype=float)
+
+def prices_on(store: dict, codes: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """Price of the instrument of each row on the day of the row, one search per instrument"""
+    prices = np.full(len(codes), np.nan)
+    order = np.argsort(codes, kind='stable')
+    for rows in np.split(order, np.flatnonzero(np.diff(codes[order])) + 1):
+        if len(rows) > 0:
+            prices[rows] = lookup(store, int(codes[rows[0]]), days[rows])
+    return prices
+
+def price_table(store: dict, codes: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """Prices of some instruments on the same days: (codes x days)"""
+    return np.array([lookup(store, int(code), days) for code in codes]).reshape(len(codes), len(days))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Import a CSV of prices (date,instrument,price) into the local price store')
+    parser.add_argument('paths', nargs='+')
+    for csv in parser.parse_args().paths:
+        print(f'{csv}: {import_csv(csv)} prices')
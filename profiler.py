@@ -0,0 +1,79 @@
+# --- LIBRARIES ------------------------------------------
+import json
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from pathlib import Path
+
+# --- SPAN TIMING ------------------------------------------
+# A trace is the list of timed spans (read, parse, filter, aggregate, charts, write) of one rerun of a page.
+# When profiling is off there is no trace and span() returns the same empty context manager, so the instrumented
+# code only pays a function call. Spans can be opened from the threads that prefetch the sheets.
+
+NO_SPAN = nullcontext()
+
+def session_id() -> str:
+    """Short random id to group the spans of one browser session"""
+    return uuid.uuid4().hex[:8]
+
+def new_trace(page: str, session: str) -> dict:
+    """Empty trace for a rerun of a page"""
+    return {'session': session, 'run': uuid.uuid4().hex[:8], 'page': page, 'start': time.perf_counter(),
+            'time': time.time(), 'spans': [], 'lock': threading.Lock()}
+
+class Span:
+    """Context manager that adds its duration to the trace when it ends"""
+    __slots__ = ('trace', 'name', 'attrs', 'start')
+
+    def __init__(self, trace: dict, name: str, attrs: dict):
+        self.trace, self.name, self.attrs = trace, name, attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        span = {'name': self.name, 'start_ms': 1000 * (self.start - self.trace['start']), 'duration_ms': 1000 * (end - self.start),
+                'thread': threading.current_thread().name, **self.attrs}
+        with self.trace['lock']:
+            self.trace['spans'].append(span)
+        return False
+
+def span(trace, name: str, **attrs):
+    """Time the block inside 'with span(trace, name):'. Does nothing if trace is None"""
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, attrs)
+
+def total_ms(trace: dict) -> float:
+    """Time since the start of the rerun"""
+    return 1000 * (time.perf_counter() - trace['start'])
+
+# --- EXPORT ------------------------------------------
+def export(trace: dict, path):
+    """Append the spans of a trace to a JSON lines file, one span per line"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    context = {'session': trace['session'], 'run': trace['run'], 'page': trace['page'], 'time': trace['time']}
+    with trace['lock'], open(path, 'a') as file:
+        for item in trace['spans']:
+            file.write(json.dumps({**context, **item}) + '\n')
+
+def summary(path, percentiles=(0.5, 0.95)):
+    """Count, p50 and p95 of the duration of each span (stage and part) over all the exported reruns"""
+    import pandas as pd
+    spans = pd.read_json(path, lines=True)
+    spans['part'] = spans['part'].fillna('') if 'part' in spans else ''
+    grouped = spans.groupby(['name', 'part'])['duration_ms']
+    table = grouped.count().rename('count').to_frame()
+    for q in percentiles:
+        table[f'p{int(q * 100)} ms'] = grouped.quantile(q)
+    return table.sort_values(by=f'p{int(percentiles[-1] * 100)} ms', ascending=False)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Percentiles of the exported spans')
+    parser.add_argument('path', nargs='?', default=str(Path(__file__).parent / '.cache' / 'spans.jsonl'))
+    print(summary(parser.parse_args().path).round(1).to_string())
@@ -0,0 +1,186 @@
+# --- LIBRARIES ------------------------------------------
+import argparse
+import html
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+import pandas as pd
+
+# --- BATCH REPORTS ------------------------------------------
+# Static reports of all the sheets, written without running the app:
+#
+#   python report.py                            # Sheets mirrored in the local cache (.cache/), report in reports/
+#   python report.py --sqlite finance.db        # Sheets of a SQLite database
+#   python report.py --out ~/finance --png      # PNG copies of the charts too (needs the kaleido package)
+#
+# reports/index.html links a page per sheet with its full history (monthly table, charts, heatmap or the investments)
+# and, for the spending sheets, a page and a CSV of movements per month. The work runs on a pool of processes in two
+# rounds: one task per sheet reads it and writes its history, then the months of all the sheets are spread over the pool.
+# The analytics and figures are the same functions of utils used by the pages, without drawing anything in Streamlit.
+
+SHEETS = ['italia', 'colombia', 'juanis', 'inversiones']
+AVERAGE_MONTHS = 12  # A month is compared with the average of this many months before it
+TOP_MOVEMENTS = 10
+
+def worker_setup():
+    """utils runs outside Streamlit: silence the warnings about the session state not working without 'streamlit run'"""
+    import streamlit.logger
+    streamlit.logger.set_log_level(logging.ERROR)
+
+def currency_of(gsheet: str) -> str:
+    import fx
+    return fx.CURRENCY_SYMBOL.get(fx.SHEET_CURRENCY.get(gsheet), '$')
+
+# --- READ ------------------------------------------
+def load(source: dict, gsheet: str) -> pd.DataFrame:
+    """Typed frame of a sheet from the SQLite database or the local cache, None if the sheet is not there"""
+    import utils
+    import sheet_cache
+    import sqlite_store
+    if source.get('sqlite'):
+        conn = sqlite_store.connect(source['sqlite'])
+        try:
+            if not sqlite_store.table_columns(conn, gsheet):
+                return None
+            return utils.load_sheet(sqlite_store, conn, 'not_other', gsheet=gsheet, ncols=utils.SHEET_COLS[gsheet])
+        finally:
+            conn.close()
+    data, _ = sheet_cache.load_cache(gsheet)
+    return None if data is None else utils.apply_schema(data.dropna(how='all'), gsheet)
+
+# --- WRITE ------------------------------------------
+def page(path: Path, title: str, sections: list, root='../'):
+    """HTML page with a title and sections of HTML. The charts use plotly.min.js, in the root folder of the reports"""
+    body = '\n'.join(sections)
+    path.write_text(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>'
+                    f'<script src="{root}plotly.min.js"></script></head>\n'
+                    f'<body style="font-family: sans-serif"><h1>{html.escape(title)}</h1>\n{body}\n</body></html>', encoding='utf-8')
+
+def figure(fig, path: Path, png: bool) -> str:
+    """HTML of a figure, saving it also as a PNG next to the page if asked"""
+    if png:
+        fig.write_image(path.with_suffix('.png'), width=1200, height=600)
+    return fig.to_html(full_html=False, include_plotlyjs=False)
+
+def table(frame: pd.DataFrame, title: str) -> str:
+    return f'<h2>{html.escape(title)}</h2>\n' + frame.to_html(float_format='{:,.2f}'.format, na_rep='', border=0)
+
+def links(items: list) -> str:
+    return '<ul>' + ''.join(f'<li><a href="{href}">{html.escape(text)}</a></li>' for href, text in items) + '</ul>'
+
+# --- SHEET REPORTS ------------------------------------------
+def sheet_report(source: dict, gsheet: str, out: Path, png: bool):
+    """Write the full-history report of a sheet. Returns the months of a spending sheet as [(month, rows, averages)]
+    for month_report(), [] for inversiones and None if the sheet could not be read"""
+
+    import utils
+    import monthly_cube
+    data = load(source, gsheet)
+    if data is None:
+        return None
+    folder = out / gsheet
+    folder.mkdir(parents=True, exist_ok=True)
+    currency = currency_of(gsheet)
+
+    if gsheet == 'inversiones':
+        investments = utils.process_investments(data)
+        investments.to_csv(folder / 'investments.csv', index=False)
+        totals = utils.investment_month_totals(data)
+        sections = [f'<p>This month you have invested {currency}{totals["invested"]:,.0f} and received {currency}{totals["received"]:,.0f}</p>',
+                    figure(utils.investments_pie_figure(investments), folder / 'active', png)]
+        values = utils.investment_values(data)  # Marked to market with the local price store, at cost without prices
+        sections += [figure(utils.allocation_figure(data, by, values), folder / f'allocation_{by.lower()}', png) for by in ['Type', 'Platform']]
+        sections += [figure(utils.portfolio_value_figure(data, by), folder / f'value_{by.lower()}', png) for by in ['Type', 'Platform']]
+        sections += [table(investments.drop(columns=['months']), 'Investments'), links([('investments.csv', 'investments.csv')])]
+        page(folder / 'index.html', 'Investments', sections)
+        return []
+
+    cube = monthly_cube.build_cube(data)
+    cells = monthly_cube.cube_slice(cube, include=[True])  # Same movements as the default filters of the pages
+    balance, pivot = utils.monthly_pivots(cells)
+    balance.join(pivot).to_csv(folder / 'monthly.csv')
+    months = pd.DatetimeIndex(cells['month'].unique()).sort_values()
+    expenses = cells[cells['sign'] < 0].pivot_table(index='month', columns='category', values='amount', aggfunc='sum', observed=True).fillna(0)
+    averages = expenses.rolling(AVERAGE_MONTHS, min_periods=1).mean().shift(1)  # Of the months before each one
+    sections = [figure(utils.monthly_spending_figure(cells, [True], currency), folder / 'monthly', png),
+                figure(utils.stacked_bar_figure(monthly_cube.cube_frame(cube), currency), folder / 'categories', png),
+                figure(utils.monthly_heatmap_figure(pivot.iloc[::-1], gsheet), folder / 'heatmap', png),
+                table(balance.join(pivot).iloc[::-1], 'Monthly totals'),
+                '<h2>Months</h2>' + links([(f'{month:%Y-%m}.html', f'{month:%B %Y}') for month in reversed(months)] + [('monthly.csv', 'monthly.csv')])]
+    page(folder / 'index.html', f'Spending {gsheet}', sections)
+
+    data = data[data['date'].notna()]
+    by_month = data.groupby(data['date'].dt.to_period('M').dt.to_timestamp(), sort=True)
+    return [(month, rows, averages.loc[month] if month in averages.index else None) for month, rows in by_month]
+
+def month_report(gsheet: str, month: pd.Timestamp, rows: pd.DataFrame, averages, out: Path, png: bool):
+    """Write the report of one month of a spending sheet: totals, expenses by category against the previous months,
+    largest expenses and the movements as CSV"""
+
+    import plotly.graph_objects as go
+    folder = out / gsheet
+    name = f'{month:%Y-%m}'
+    currency = currency_of(gsheet)
+    rows.to_csv(folder / f'{name}.csv', index=False)
+    included = rows[rows['include']]
+    spent = -included.loc[included['amount'] < 0, 'amount'].sum()
+    outflows = included[included['amount'] < 0]
+    expenses = -outflows['amount'].groupby(outflows['category'].astype(object)).sum()  # Same index type as the averages
+    categories = pd.DataFrame({'This month': expenses})
+    if averages is not None:
+        categories[f'Average of the previous {AVERAGE_MONTHS} months'] = -averages.reindex(categories.index)
+    categories = categories.sort_values('This month', ascending=False)
+
+    fig = go.Figure([go.Bar(x=categories.index, y=categories[column], name=column) for column in categories.columns])
+    fig.update_layout(title=f'Expenses by category ({currency})', barmode='group')
+    largest = included.loc[included['amount'].nsmallest(TOP_MOVEMENTS).index, ['date', 'amount', 'category', 'description']]
+    sections = [f'<p>Spent {currency}{spent:,.0f}, balance {currency}{included["amount"].sum():,.0f} in {len(rows)} movements</p>',
+                figure(fig, folder / f'{name}_categories', png), table(categories, 'Expenses by category'),
+                table(largest.assign(date=largest['date'].dt.strftime('%Y-%m-%d')), 'Largest expenses'),
+                links([('index.html', f'All the months of {gsheet}'), (f'{name}.csv', f'{name}.csv')])]
+    page(folder / f'{name}.html', f'{gsheet} {month:%B %Y}', sections)
+
+# --- RUN ------------------------------------------
+def month_batch(tasks: list, out: Path, png: bool) -> int:
+    """Several month reports in one task, so the rows are sent to the workers in a few large messages"""
+    for gsheet, month, rows, averages in tasks:
+        month_report(gsheet, month, rows, averages, out, png)
+    return len(tasks)
+
+def generate(source: dict, out: Path, sheets=SHEETS, workers=None, png=False) -> dict:
+    """Write the reports of the sheets with a pool of worker processes (one per core by default). Returns {sheet: months}"""
+
+    from plotly.offline import get_plotlyjs
+    out.mkdir(parents=True, exist_ok=True)
+    (out / 'plotly.min.js').write_text(get_plotlyjs(), encoding='utf-8')  # Once for all the pages, they work offline
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=worker_setup) as pool:
+        sheet_results = dict(zip(sheets, pool.map(sheet_report, repeat(source), sheets, repeat(out), repeat(png))))
+        tasks = [(gsheet, month, rows, averages) for gsheet, months in sheet_results.items() for month, rows, averages in (months or [])]
+        size = max(1, -(-len(tasks) // (4 * workers)))  # A few batches per worker to balance the load
+        list(pool.map(month_batch, [tasks[i:i + size] for i in range(0, len(tasks), size)], repeat(out), repeat(png)))
+
+    found = {gsheet: len(months) for gsheet, months in sheet_results.items() if months is not None}
+    page(out / 'index.html', 'Personal finance reports', [links([(f'{gsheet}/index.html', gsheet) for gsheet in found])], root='')
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write static HTML/CSV reports of all the sheets')
+    parser.add_argument('--sqlite', help='SQLite database to read, by default the local cache of the Google Sheets')
+    parser.add_argument('--out', default=str(Path(__file__).parent / 'reports'), help='Folder of the reports')
+    parser.add_argument('--sheets', nargs='+', default=SHEETS, choices=SHEETS)
+    parser.add_argument('--workers', type=int, help='Processes of the pool, one per core by default')
+    parser.add_argument('--png', action='store_true', help='Also save the charts as PNG (needs the kaleido package)')
+    args = parser.parse_args()
+    if args.png:
+        import importlib.util
+        if importlib.util.find_spec('kaleido') is None:
+            parser.error('--png needs the kaleido package: pip install kaleido')
+    start = time.perf_counter()
+    found = generate({'sqlite': args.sqlite}, Path(args.out), sheets=args.sheets, workers=args.workers, png=args.png)
+    for gsheet in args.sheets:
+        print(f'{gsheet}: ' + ('not found' if gsheet not in found else f'{found[gsheet]} monthly reports' if gsheet != 'inversiones' else 'written'))
+    print(f'Reports in {args.out} ({time.perf_counter() - start:.1f} s)')
@@ -0,0 +1,166 @@
+# --- LIBRARIES ------------------------------------------
+import numpy as np
+import pandas as pd
+
+# --- ROLLING STATISTICS ------------------------------------------
+# Daily totals of a spending sheet kept in a dense array [channel, category, day]. Movements with include = False are
+# left out, like in the default filters of the charts. Channels: 'net' (signed amounts), 'spend' (expenses as positive
+# amounts) and 'recurrent' (signed amounts of the recurrent movements). For the windows of the last 7, 30 and 90 days
+# ending 'today' it keeps the sum and the sum of squares of the daily totals of each category, so adding or removing a
+# movement changes one cell of the array and the window sums in O(1), and moving to a new day adds the day entering each
+# window and removes the one leaving it. Means and variances of the daily totals come from those sums.
+
+WINDOWS = (7, 30, 90)
+CHANNELS = ('net', 'spend', 'recurrent')
+NET, SPEND, RECURRENT = range(len(CHANNELS))
+HISTORY_MONTHS = 3  # Full months averaged to expect the recurrent movements of a month
+
+def day_number(dates) -> np.ndarray:
+    """Days since 1970-01-01 of each date"""
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+def movements(rows: pd.DataFrame) -> tuple:
+    """Category, day and the value of each channel for the rows of a spending sheet that count: with date and include"""
+    rows = rows[rows['include'].astype(bool) & rows['date'].notna()]
+    amount = rows['amount'].fillna(0).to_numpy(dtype=float)
+    values = np.stack([amount, np.where(amount < 0, -amount, 0.0), np.where(rows['recurrent'].astype(bool), amount, 0.0)])
+    return rows['category'].astype(object).fillna('').to_numpy(), day_number(rows['date']), values
+
+# --- BUILD ------------------------------------------
+def build(data: pd.DataFrame, today=None) -> dict:
+    """Build the daily array and the windows ending today from all the rows of a spending sheet"""
+
+    categories, days, values = movements(data)
+    today = int(day_number([pd.Timestamp(today or pd.Timestamp.today())])[0])
+    start = int(min(days.min(), today) if len(days) else today) - max(WINDOWS)
+    ndays = int(max(days.max(), today) if len(days) else today) - start + 1 + 366  # Room for a year of new days
+    codes, names = pd.factorize(categories)  # Hashing, much faster than sorting the strings
+    flat = codes * ndays + (days - start)
+    daily = np.stack([np.bincount(flat, weights=channel, minlength=len(names) * ndays).reshape(len(names), ndays) for channel in values])
+    state = {'start': start, 'today': today - start, 'daily': daily, 'rows': {name: i for i, name in enumerate(names)},
+             'sums': {}, 'squares': {}}
+    reset_windows(state)
+    return state
+
+def reset_windows(state: dict):
+    """Sums of the windows ending today computed from the daily array"""
+    t = state['today']
+    for w in WINDOWS:
+        block = state['daily'][:, :, max(t - w + 1, 0):t + 1]
+        state['sums'][w] = block.sum(axis=-1)
+        state['squares'][w] = (block ** 2).sum(axis=-1)
+
+def category_row(state: dict, category: str) -> int:
+    """Row of a category in the arrays, adding it if it is new"""
+    if category not in state['rows']:
+        state['rows'][category] = len(state['rows'])
+        state['daily'] = np.concatenate([state['daily'], np.zeros((len(CHANNELS), 1, state['daily'].shape[2]))], axis=1)
+        for w in WINDOWS:
+            state['sums'][w] = np.concatenate([state['sums'][w], np.zeros((len(CHANNELS), 1))], axis=1)
+            state['squares'][w] = np.concatenate([state['squares'][w], np.zeros((len(CHANNELS), 1))], axis=1)
+    return state['rows'][category]
+
+def day_index(state: dict, day: int) -> int:
+    """Position of a day in the daily array, growing it if the day is outside"""
+    if day < state['start']:  # Older than everything loaded, rare
+        pad = state['start'] - day
+        state['daily'] = np.pad(state['daily'], ((0, 0), (0, 0), (pad, 0)))
+        state['start'] -= pad
+        state['today'] += pad
+    if day - state['start'] >= state['daily'].shape[2]:  # Room for at least another year
+        pad = day - state['start'] - state['daily'].shape[2] + 366
+        state['daily'] = np.pad(state['daily'], ((0, 0), (0, 0), (0, pad)))
+    return day - state['start']
+
+# --- INCREMENTAL UPDATES ------------------------------------------
+def add_movement(state: dict, category: str, day: int, values: np.ndarray, sign=1):
+    """Add (sign=1) or remove (sign=-1) one movement: one cell of the daily array and the windows that contain its day"""
+    r, i = category_row(state, category), day_index(state, day)
+    old = state['daily'][:, r, i].copy()
+    new = old + sign * values
+    state['daily'][:, r, i] = new
+    t = state['today']
+    for w in WINDOWS:
+        if t - w < i <= t:
+            state['sums'][w][:, r] += new - old
+            state['squares'][w][:, r] += new * new - old * old
+
+def update(state: dict, rows: pd.DataFrame, sign=1):
+    """Add or remove rows of a spending sheet. The cost depends on the number of rows, not on the size of the sheet"""
+    categories, days, values = movements(rows)
+    for k in range(len(days)):
+        add_movement(state, categories[k], int(days[k]), values[:, k], sign)
+
+def advance(state: dict, today=None):
+    """Move the windows to end on today: each new day enters the windows and the day leaving them is removed"""
+    day = int(day_number([pd.Timestamp(today or pd.Timestamp.today())])[0])
+    t = day_index(state, day)
+    if t <= state['today']:
+        return
+    if t - state['today'] > max(WINDOWS):  # Nothing of the old windows is left
+        state['today'] = t
+        reset_windows(state)
+        return
+    daily = state['daily']
+    for entering in range(state['today'] + 1, t + 1):
+        for w in WINDOWS:
+            leaving = daily[:, :, entering - w] if entering - w >= 0 else 0.0
+            state['sums'][w] += daily[:, :, entering] - leaving
+            state['squares'][w] += daily[:, :, entering] ** 2 - leaving ** 2
+    state['today'] = t
+
+# --- RESULTS ------------------------------------------
+def window_stats(state: dict, channel='spend') -> pd.DataFrame:
+    """Sum, mean and standard deviation of the daily totals of each category in every window"""
+    c = CHANNELS.index(channel)
+    names = list(state['rows'])
+    table = {}
+    for w in WINDOWS:
+        total = state['sums'][w][c]
+        mean = total / w
+        table[(f'{w} days', 'sum')] = total
+        table[(f'{w} days', 'daily mean')] = mean
+        table[(f'{w} days', 'daily std')] = np.sqrt(np.maximum(state['squares'][w][c] / w - mean ** 2, 0))  # Rounding can go below 0
+    stats = pd.DataFrame(table, index=pd.Index(names, name='category'))
+    return stats[stats.abs().sum(axis=1) > 0]
+
+def rolling_series(state: dict, window=30, days=365, channel='spend') -> pd.Series:
+    """Total of all the categories over the last window days, for each of the last days ending today"""
+    c = CHANNELS.index(channel)
+    t = state['today']
+    total = state['daily'][c, :, max(t - days - window + 1, 0):t + 1].sum(axis=0)
+    rolling = np.convolve(total, np.ones(window))[window - 1:len(total)]
+    dates = (np.arange(t - len(rolling) + 1, t + 1) + state['start']).astype('datetime64[D]')
+    return pd.Series(rolling, index=pd.DatetimeIndex(dates))
+
+def month_bounds(state: dict, months_back=0) -> tuple:
+    """Positions of the first day and of the day after the last one of the month of today, or of months_back months before"""
+    month = (np.datetime64(state['start'] + state['today'], 'D').astype('datetime64[M]') - months_back)
+    first = month.astype('datetime64[D]').astype(np.int64) - state['start']
+    after = (month + 1).astype('datetime64[D]').astype(np.int64) - state['start']
+    return int(first), int(after)
+
+def forecast(state: dict) -> dict:
+    """Projection of the balance of this month and of the next one. The recurrent movements of a month are expected to be the
+    average of the last full months, the ones not booked yet this month are still to come, and the rest of the movements go
+    on at the daily rate of the last 90 days. Every step works on all the categories at once"""
+
+    daily, t = state['daily'], state['today']
+    first, after = month_bounds(state)
+    booked = daily[NET, :, first:t + 1].sum(axis=-1)
+    booked_recurrent = daily[RECURRENT, :, first:t + 1].sum(axis=-1)
+    history = [month_bounds(state, back) for back in range(1, HISTORY_MONTHS + 1)]
+    expected = np.mean([daily[RECURRENT, :, max(a, 0):max(b, 0)].sum(axis=-1) for a, b in history], axis=0)
+    missing = expected - booked_recurrent
+    to_come = np.where(expected < 0, np.minimum(missing, 0), np.maximum(missing, 0))  # Only what moves towards the expected amount
+    rate = (state['sums'][90][NET] - state['sums'][90][RECURRENT]).sum() / 90  # Non-recurrent movements per day
+    days_left = after - t - 1
+    _, next_after = month_bounds({**state, 'today': after})
+    cumulative = daily[NET, :, first:t + 1].sum(axis=0).cumsum()
+    dates = (np.arange(first, t + 1) + state['start']).astype('datetime64[D]')
+    return {'booked': booked.sum(), 'recurrent to come': to_come.sum(), 'daily rate': rate, 'days left': days_left,
+            'this month': booked.sum() + to_come.sum() + rate * days_left,
+            'next month': expected.sum() + rate * (next_after - after),
+            'by category': pd.DataFrame({'booked': booked, 'expected recurrent': expected, 'recurrent to come': to_come},
+                                        index=pd.Index(list(state['rows']), name='category')),
+            'days': pd.Series(cumulative, index=pd.DatetimeIndex(dates))}
@@ -0,0 +1,109 @@
+# --- LIBRARIES ------------------------------------------
+import threading
+import time
+import pandas as pd
+
+# --- SHARED STORE ------------------------------------------
+# One store per server process (utils.get_store() creates it with st.cache_resource) keeps the typed frame of every
+# sheet for all the browser sessions: a session holds references to these frames, it never copies them, so memory
+# grows with the number of sheets and not with the number of sessions. The frames are never modified in place. A
+# write builds a new frame (copy-on-write) and publishes it with the next version of the sheet, so sessions still
+# reading the old frame are not affected, and they pick up the new one on their next rerun by comparing versions.
+# Structures built from the frames (filter index, consolidated view) are shared the same way, kept together with the
+# frames they were built from and rebuilt when those are replaced.
+# Appends don't copy the frame either: the frames published by append() are views of the first rows of a larger
+# buffer, and new rows are written to its free rows, which no published frame includes. When the buffer is full, or
+# the frame was replaced by another kind of write, a buffer with room for as many rows again is allocated, so the cost
+# of adding a row doesn't grow with the sheet (amortized).
+
+def new_store() -> dict:
+    """Empty store. 'lock' guards the frames and versions, 'load_lock' lets one session read the sheets while the others wait"""
+    return {'lock': threading.RLock(), 'load_lock': threading.Lock(), 'sheets': {}, 'versions': {}, 'loaded': None,
+            'tokens': {}, 'derived': {}, 'buffers': {}}
+
+def snapshot(store: dict) -> tuple:
+    """Frames and versions of all the sheets at one point in time"""
+    with store['lock']:
+        return dict(store['sheets']), dict(store['versions'])
+
+def publish(store: dict, gsheet: str, data, base=None, write=None):
+    """Make data the current frame of the sheet with the next version, returned. With base, only if the sheet is still at that
+    version (the one the change was computed from), otherwise returns None. write() runs under the lock before publishing,
+    so the writes reach the journal in the same order as the versions"""
+
+    with store['lock']:
+        version = store['versions'].get(gsheet, 0)
+        if base is not None and base != version:
+            return None
+        if write is not None:
+            write()
+        store['sheets'][gsheet] = data
+        store['versions'][gsheet] = version + 1
+        return version + 1
+
+def fits(buffer, frame, rows, n: int) -> bool:
+    """True if rows can be written in the free rows of the buffer behind frame"""
+    return (buffer is not None and buffer['frame'] is frame and n + len(rows) <= len(buffer['data'])
+            and list(rows.columns) == list(frame.columns) and all(rows.dtypes == frame.dtypes))  # Same categories too
+
+def append(store: dict, gsheet: str, rows, base=None, write=None):
+    """Publish the frame of the sheet with rows added at the end, like publish(). rows must have the columns of the frame and
+    their categorical columns the categories of the frame and any new ones. Their index must follow the last one of the frame"""
+
+    with store['lock']:
+        version = store['versions'].get(gsheet, 0)
+        if base is not None and base != version:
+            return None
+        if write is not None:
+            write()
+        frame = store['sheets'][gsheet]
+        n = len(frame)
+        buffer = store['buffers'].get(gsheet)
+        if fits(buffer, frame, rows, n):
+            for j, col in enumerate(frame.columns):  # In place, the published frames end before these rows
+                buffer['data'].iloc[n:n + len(rows), j] = rows[col].array
+        else:
+            head = frame.copy(deep=False)
+            for col in frame.columns[frame.dtypes == 'category']:  # Same categories, so they stay categorical when combined
+                head[col] = head[col].cat.set_categories(rows[col].cat.categories)
+            spare = rows.iloc[[len(rows) - 1] * (n + len(rows))]  # Free rows, filled with valid values of each type
+            spare.index = pd.RangeIndex(rows.index[-1] + 1, rows.index[-1] + 1 + len(spare))  # The index the next rows will have
+            buffer = {'data': pd.concat([head, rows, spare])}
+            store['buffers'][gsheet] = buffer
+        buffer['frame'] = buffer['data'].iloc[:n + len(rows)]
+        store['sheets'][gsheet] = buffer['frame']
+        store['versions'][gsheet] = version + 1
+        return version + 1
+
+def mark_loaded(store: dict, tokens: dict):
+    """Remember when the sheets were last checked against the storage backend, with the freshness token of each one"""
+    with store['lock']:
+        store['loaded'] = time.monotonic()
+        store['tokens'].update(tokens)
+
+def stale(store: dict, tokens: dict) -> list:
+    """Sheets whose freshness token in the backend is not the one they had when they were read"""
+    with store['lock']:
+        return [gsheet for gsheet, token in tokens.items() if gsheet not in store['sheets'] or store['tokens'].get(gsheet) != token]
+
+def fresh(store: dict, sheets, ttl: float) -> bool:
+    """True if all the sheets are in the store and were read from the backend less than ttl seconds ago"""
+    with store['lock']:
+        return store['loaded'] is not None and time.monotonic() - store['loaded'] < ttl and all(gsheet in store['sheets'] for gsheet in sheets)
+
+def newer(store: dict, versions: dict) -> dict:
+    """{sheet: (frame, version)} of the sheets published after the given versions"""
+    with store['lock']:
+        return {gsheet: (store['sheets'][gsheet], version) for gsheet, version in store['versions'].items() if version > versions.get(gsheet, 0)}
+
+def derived(store: dict, name, sources: tuple, build):
+    """Value built from the given frames, shared by all the sessions while the frames are the same objects. One value per name"""
+
+    with store['lock']:
+        entry = store['derived'].get(name)
+    if entry is not None and len(entry[0]) == len(sources) and all(a is b for a, b in zip(entry[0], sources)):
+        return entry[1]
+    value = build()  # Outside the lock, two sessions may build it at the same time but never wait for each other
+    with store['lock']:
+        store['derived'][name] = (sources, value)
+    return value
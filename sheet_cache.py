@@ -0,0 +1,267 @@
+# --- LIBRARIES ------------------------------------------
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+# --- LOCAL COLUMNAR CACHE ------------------------------------------
+# Each worksheet is mirrored in .cache/<gsheet>.parquet together with a small .json file holding the number of
+# rows and the freshness token of the spreadsheet when it was downloaded (time of its last update in Drive).
+# sync_sheet() returns the cache from disk without any request, so the first paint doesn't wait for the network.
+# check_sheet() runs afterwards (in the background, see utils.refresh_sheets()): it asks for the token and does
+# nothing if it didn't change. The token is the one of the whole spreadsheet, so an append to any sheet (also by the
+# app) changes it for all of them: a changed sheet is first synced by its tail, reading the last synced row and the
+# ones after it in one request. If the last synced row is as it was (hash saved in the .json file) only the new rows
+# are added, otherwise rows above it changed and the whole sheet is downloaded again. Edits made outside the app
+# above the last synced row don't change it, they are picked up by a full download at least every FULL_SYNC_AGE.
+# The script thread and the journal flusher both update the cache: every read-modify-write of a sheet holds its lock
+# and the files are written to a temporary file and then renamed, so a reader never sees a half-written parquet.
+
+CACHE_DIR = Path(__file__).parent / '.cache'
+FULL_SYNC_AGE = 3600        # Seconds after which a changed sheet is downloaded in full instead of by its tail
+LOCKS = {}                  # {gsheet: lock of its cache files}
+LOCKS_GUARD = threading.Lock()
+
+def cache_lock(gsheet: str) -> threading.RLock:
+    """Lock of the cache files of a sheet, shared by the threads of the process"""
+    with LOCKS_GUARD:
+        return LOCKS.setdefault(gsheet, threading.RLock())
+
+def replace_file(path: Path, write):
+    """Write a file with write(temporary path) and move it into place in one step"""
+    temporary = path.with_name(path.name + '.tmp')
+    write(temporary)
+    os.replace(temporary, path)
+
+def cache_path(gsheet: str) -> Path:
+    """Path of the parquet file that mirrors the selected sheet"""
+    return CACHE_DIR / f'{gsheet}.parquet'
+
+def meta_path(gsheet: str) -> Path:
+    """Path of the json file with the sync state of the selected sheet"""
+    return CACHE_DIR / f'{gsheet}.json'
+
+def row_hash(row: list) -> str:
+    """Hash of the raw values of one row of the sheet, used to detect changes in the last synced row"""
+    return hashlib.sha1('\x1f'.join(str(value) for value in row).encode()).hexdigest()
+
+def last_column(ncols: int) -> str:
+    """Letter of the last column to read (ncols is at most 26)"""
+    return chr(ord('A') + ncols - 1)
+
+def get_worksheet(conn, gsheet: str):
+    """Get the gspread worksheet behind the streamlit GSheetsConnection"""
+    return conn.client._select_worksheet(worksheet=gsheet)
+
+def parse_tail(row: list, ncols: int) -> list:
+    """Pad a raw row of the sheet to ncols values, rows come without their trailing empty cells (same hash with or without them)"""
+    return list(row[:ncols]) + [''] * (ncols - len(row))
+
+def parse_rows(header: list, rows: list) -> pd.DataFrame:
+    """Convert raw rows of the sheet into a DataFrame, inferring types the same way GSheetsConnection.read() does"""
+    ncols = len(header)
+    rows = [parse_tail(row, ncols) for row in rows]  # Rows come without the trailing empty cells
+    if len(rows) == 0:
+        return pd.DataFrame(columns=header)
+    return TextParser([header] + rows, header=0, na_values=['']).read()
+
+# --- READ / WRITE CACHE ------------------------------------------
+def load_cache(gsheet: str):
+    """Load the cached DataFrame and its sync state from disk. Returns (None, None) if there is no valid cache"""
+    try:
+        with cache_lock(gsheet):  # The parquet and the sync state of the same save
+            data = pd.read_parquet(cache_path(gsheet))
+            meta = json.loads(meta_path(gsheet).read_text())
+    except (OSError, ValueError):
+        return None, None
+    if meta.get('rows') != len(data):  # Parquet and sync state written by different saves
+        return None, None
+    return data, meta
+
+def save_cache(gsheet: str, data: pd.DataFrame, header: list, token=None, tail_hash=None, full_at=None):
+    """Save the DataFrame with all the synced rows (including empty ones), the freshness token of the download, the hash
+    of the raw values of the last row and the time of the last full download"""
+    CACHE_DIR.mkdir(exist_ok=True)
+    data = data.reset_index(drop=True)
+    meta = {'rows': len(data), 'header': list(header), 'token': token, 'tail_hash': tail_hash, 'full_at': full_at}
+    with cache_lock(gsheet):
+        replace_file(cache_path(gsheet), lambda path: data.to_parquet(path, index=False))
+        replace_file(meta_path(gsheet), lambda path: path.write_text(json.dumps(meta)))  # Written last so a partial save is detected by load_cache()
+
+def full_sync(ws, gsheet: str, ncols: int, token=None) -> pd.DataFrame:
+    """Download the whole sheet (one request) and rebuild its cache"""
+    values = ws.get(f'A1:{last_column(ncols)}')
+    header = list(values[0])[:ncols] if values else []
+    rows = values[1:]
+    data = parse_rows(header, rows)
+    save_cache(gsheet, data, header, token, row_hash(parse_tail(rows[-1], ncols)) if rows else None, time.time())
+    return data
+
+def tail_sync(ws, gsheet: str, ncols: int, token=None):
+    """Add the rows appended after the last synced one, reading from that row to the end of the sheet (one request).
+    Returns the number of rows added, or None without changing the cache if the cache is not a prefix of the sheet anymore"""
+    data, meta = load_cache(gsheet)
+    if data is None or meta['rows'] == 0 or not meta.get('tail_hash') or len(meta['header']) != ncols:
+        return None
+    if time.time() - (meta.get('full_at') or 0) > FULL_SYNC_AGE:
+        return None
+    tail = ws.get(f'A{meta["rows"] + 1}:{last_column(ncols)}')  # Sheet rows are 1-indexed and the first one is the header
+    if len(tail) == 0 or row_hash(parse_tail(tail[0], ncols)) != meta['tail_hash']:  # Rows deleted or edited above
+        return None
+    new_rows = tail[1:]
+    if new_rows:
+        data = pd.concat([data, parse_rows(meta['header'], new_rows)], ignore_index=True)
+    save_cache(gsheet, data, meta['header'], token, row_hash(parse_tail(tail[-1], ncols)), meta['full_at'])
+    return len(new_rows)
+
+def sync_sheet(conn, gsheet: str, ncols: int, full=False) -> pd.DataFrame:
+    """All the rows of the sheet with the index matching their position in the sheet (row 0 is sheet row 2). From the
+    cache on disk without any request when there is one, call check_sheet() afterwards to bring it up to date"""
+
+    data, meta = load_cache(gsheet)
+    if not full and data is not None and len(meta['header']) == ncols:
+        return data
+    token = freshness(conn, gsheet)  # Before downloading: a change made during the download changes it again
+    with cache_lock(gsheet):
+        return full_sync(get_worksheet(conn, gsheet), gsheet, ncols, token)
+
+def check_sheet(conn, gsheet: str, ncols: int) -> tuple:
+    """Bring the cache up to date if the freshness token is not the one of the cache: by its tail if only rows were
+    appended, downloading the whole sheet otherwise. Returns the token and True if rows of the cache changed"""
+
+    token = freshness(conn, gsheet)
+    _, meta = load_cache(gsheet)
+    if meta is not None and meta.get('token') == token and len(meta['header']) == ncols:
+        return token, False
+    with cache_lock(gsheet):
+        ws = get_worksheet(conn, gsheet)
+        added = tail_sync(ws, gsheet, ncols, token)
+        if added is None:
+            full_sync(ws, gsheet, ncols, token)
+    return token, added != 0
+
+def count_rows(conn, gsheet: str) -> int:
+    """Number of rows in the sheet without the header, the first column is always filled"""
+    return len(get_worksheet(conn, gsheet).col_values(1)) - 1
+
+def freshness(conn, gsheet: str):
+    """Token that changes when the sheet changes, to know if it must be read again without downloading it: the time of
+    the last update of the spreadsheet (one Drive API request), or the number of rows with older gspread versions"""
+    spreadsheet = get_worksheet(conn, gsheet).spreadsheet
+    if hasattr(spreadsheet, 'get_lastUpdateTime'):  # gspread >= 5.12, the lastUpdateTime property is only read once
+        return spreadsheet.get_lastUpdateTime()
+    return count_rows(conn, gsheet)
+
+# --- INCREMENTAL WRITES ------------------------------------------
+def to_cell(value):
+    """Convert a python/numpy value into something the Sheets API accepts, empty values become empty cells"""
+    if value is None or pd.isna(value):  # None, NaN or NaT
+        return ''
+    if isinstance(value, (datetime.date, datetime.datetime)):  # Dates are stored as strings to avoid format changing
+        return value.strftime('%Y-%m-%d')
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return value
+
+def append_rows(conn, gsheet: str, rows: list):
+    """Append rows after the last row of the sheet sending only the new values. The cache is brought up to date
+    by the next check_sheet(), the token of the spreadsheet changes with the write"""
+    ws = get_worksheet(conn, gsheet)
+    values = [[to_cell(value) for value in row] for row in rows]
+    ws.append_rows(values, value_input_option='USER_ENTERED', table_range='A1')
+
+# --- DIFF-BASED WRITES ------------------------------------------
+# The DataFrame in the session state is indexed by the position of each row in the sheet (0 is sheet row 2).
+# The editor returns that position in the 'row' column, new rows come with an empty 'row'.
+
+def diff_frames(old: pd.DataFrame, new: pd.DataFrame, key='row') -> dict:
+    """Compare the loaded DataFrame with the edited one and return the edited cells as (position, column, value),
+    the positions of the deleted rows and the values of the inserted rows"""
+
+    columns = list(old.columns)
+    inserted = new[new[key].isna()][columns].dropna(how='all')
+    kept = new[new[key].notna()].set_index(key)[columns]
+    kept.index = kept.index.astype(int)
+    deleted = old.index.difference(kept.index)
+
+    before = old.loc[kept.index, columns]
+    changed = (before != kept) & ~(before.isna() & kept.isna())  # NaN != NaN, but an empty cell that stays empty is not a change
+    rows, cols = changed.to_numpy().nonzero()
+    cells = [(int(kept.index[r]), int(c), kept.iat[r, c]) for r, c in zip(rows, cols)]
+    return {'cells': cells, 'deleted': [int(position) for position in deleted], 'inserted': inserted.values.tolist()}
+
+def cell_ranges(cells: list) -> list:
+    """Group the edited cells of each row in contiguous ranges, ready for a single batch_update() call"""
+    by_row = {}
+    for position, col, value in cells:
+        by_row.setdefault(position, {})[col] = value
+    ranges = []
+    for position, row in sorted(by_row.items()):
+        cols = sorted(row)
+        start = cols[0]
+        for i, col in enumerate(cols):
+            if i + 1 == len(cols) or cols[i + 1] != col + 1:  # End of a contiguous run of columns
+                sheet_row = position + 2
+                ranges.append({'range': f'{last_column(start + 1)}{sheet_row}:{last_column(col + 1)}{sheet_row}',
+                               'values': [[to_cell(row[c]) for c in range(start, col + 1)]]})
+                if i + 1 < len(cols):
+                    start = cols[i + 1]
+    return ranges
+
+def row_blocks(positions: list) -> list:
+    """Group row positions in contiguous (start, end) blocks, last block first so deleting them doesn't shift the others"""
+    blocks = []
+    for position in sorted(positions):
+        if blocks and blocks[-1][1] == position:
+            blocks[-1][1] = position + 1
+        else:
+            blocks.append([position, position + 1])
+    return blocks[::-1]
+
+def write_diff(conn, gsheet: str, diff: dict):
+    """Send only the changes to the sheet: one batch of range updates, one batch of row deletions and one append"""
+
+    ws = get_worksheet(conn, gsheet)
+    if diff['cells']:
+        ws.batch_update(cell_ranges(diff['cells']), value_input_option='USER_ENTERED')
+    if diff['deleted']:
+        requests = [{'deleteDimension': {'range': {'sheetId': ws.id, 'dimension': 'ROWS',
+                                                   'startIndex': start + 1, 'endIndex': end + 1}}}  # +1 for the header
+                    for start, end in row_blocks(diff['deleted'])]
+        ws.spreadsheet.batch_update({'requests': requests})
+    if diff['inserted']:
+        append_rows(conn, gsheet, diff['inserted'])
+
+    # Apply the edits and deletions to the cache so the next paint from disk has them, inserted rows come with the next check_sheet()
+    with cache_lock(gsheet):
+        data, meta = load_cache(gsheet)
+        touched = [cell[0] for cell in diff['cells']] + list(diff['deleted'])
+        if data is not None and touched and max(touched) >= len(data):  # Rows appended after the last sync: download everything next time
+            meta_path(gsheet).unlink(missing_ok=True)
+        elif data is not None and touched:
+            data = apply_diff(data, {'cells': diff['cells'], 'deleted': diff['deleted'], 'inserted': []})
+            # Old token: the next check syncs the sheet as written. If the last row was edited or deleted its hash doesn't match and that is a full download
+            save_cache(gsheet, data, meta['header'], meta.get('token'), meta.get('tail_hash'), meta.get('full_at'))
+
+def apply_diff(data: pd.DataFrame, diff: dict) -> pd.DataFrame:
+    """Apply a diff to a DataFrame indexed by sheet position, keeping the index equal to the new positions in the sheet"""
+
+    data = data.astype(object) if diff['cells'] else data.copy()  # Edited values may not match the column types
+    for position, col, value in diff['cells']:
+        data.iat[data.index.get_loc(position), col] = value
+    if diff['deleted']:
+        deleted = np.sort(np.asarray(diff['deleted']))
+        data = data.drop(index=deleted)
+        data.index = data.index - np.searchsorted(deleted, data.index)  # Rows below a deleted one move up
+    data = data.infer_objects()
+    if diff['inserted']:
+        start = data.index.max() + 1 if len(data.index) > 0 else 0
+        inserted = pd.DataFrame(diff['inserted'], columns=data.columns, index=range(start, start + len(diff['inserted'])))
+        data = pd.concat([data, inserted])
+    return data
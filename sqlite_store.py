@@ -0,0 +1,184 @@
+# --- LIBRARIES ------------------------------------------
+import sqlite3
+import numpy as np
+import pandas as pd
+import sheet_cache
+from sheet_cache import to_cell
+
+# --- SQLITE STORAGE BACKEND ------------------------------------------
+# Local stand-in for Google Sheets with the same functions as sheet_cache (sync_sheet, count_rows, append_rows, write_diff).
+# Each sheet is a table with the columns of the sheet plus 'pos', the position of the row as it would be in the sheet.
+# Values are stored like in Google Sheets: dates as 'YYYY-MM-DD' strings (so they sort and compare as dates) and flags as 0/1.
+# On top of that it can resolve the Visualize filters and the monthly aggregation in SQL (monthly_cells(), filter_rows()), and
+# the reads of Home and of the raw data editor: the totals of the month, the window of rows of the editor (raw_positions())
+# and the first and last date (date_bounds()).
+# The whole table is still read once at login (sync_sheet()), because the raw data editor writes diffs of the frame, and the
+# rolling windows, the auto-categoriser, the de-duplication of bank imports, the version history and the consolidated view
+# work on every row. What is pushed down is what runs again on every rerun of a filter or of the editor.
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open the database, usable from the threads that prefetch the sheets"""
+    return sqlite3.connect(path, check_same_thread=False)
+
+def quote(name: str) -> str:
+    """Quote a table or column name, several columns have spaces"""
+    return '"' + name.replace('"', '""') + '"'
+
+def table_columns(conn, gsheet: str) -> list:
+    """Columns of the sheet in order, without 'pos'"""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({quote(gsheet)})') if row[1] != 'pos']
+
+# --- READ / WRITE ------------------------------------------
+def write_sheet(conn, gsheet: str, data: pd.DataFrame):
+    """Replace the whole table with the DataFrame (dates as strings), used to seed the database"""
+    columns = list(data.columns)
+    with conn:
+        conn.execute(f'DROP TABLE IF EXISTS {quote(gsheet)}')
+        conn.execute(f'CREATE TABLE {quote(gsheet)} (pos INTEGER PRIMARY KEY, {", ".join(quote(col) for col in columns)})')
+        if 'date' in columns:
+            conn.execute(f'CREATE INDEX {quote(gsheet + "_date")} ON {quote(gsheet)} (date)')
+        rows = [[position] + [to_cell(value) for value in row] for position, row in enumerate(data.itertuples(index=False))]
+        conn.executemany(f'INSERT INTO {quote(gsheet)} VALUES ({", ".join("?" * (len(columns) + 1))})', rows)
+
+def sync_sheet(conn, gsheet: str, ncols: int, full=False) -> pd.DataFrame:
+    """Read the whole table, indexed by the position of each row. Empty cells are stored as '' and read as NaN"""
+    data = pd.read_sql_query(f'SELECT * FROM {quote(gsheet)} ORDER BY pos', conn, index_col='pos')
+    data.index.name = None
+    return data.iloc[:, :ncols].replace('', np.nan)
+
+def check_sheet(conn, gsheet: str, ncols: int) -> tuple:
+    """The freshness token, sync_sheet() reads the database itself so there is no cache to bring up to date"""
+    return freshness(conn, gsheet), False
+
+def count_rows(conn, gsheet: str) -> int:
+    """Number of rows in the table"""
+    return conn.execute(f'SELECT COUNT(*) FROM {quote(gsheet)}').fetchone()[0]
+
+def freshness(conn, gsheet: str) -> tuple:
+    """Token that changes when the database changes, to know if a sheet must be read again: commits of other connections
+    (data_version) and of this one (total_changes)"""
+    return (conn.execute('PRAGMA data_version').fetchone()[0], conn.total_changes)
+
+def append_rows(conn, gsheet: str, rows: list):
+    """Insert rows after the last one"""
+    ncols = len(table_columns(conn, gsheet))
+    with conn:
+        start = conn.execute(f'SELECT COALESCE(MAX(pos) + 1, 0) FROM {quote(gsheet)}').fetchone()[0]
+        values = [[start + i] + [to_cell(value) for value in row] for i, row in enumerate(rows)]
+        conn.executemany(f'INSERT INTO {quote(gsheet)} VALUES ({", ".join("?" * (ncols + 1))})', values)
+
+def write_diff(conn, gsheet: str, diff: dict):
+    """Apply a diff from sheet_cache.diff_frames() in one transaction, moving up the rows below the deleted ones like in the sheet"""
+    columns = table_columns(conn, gsheet)
+    table = quote(gsheet)
+    with conn:
+        for position, col, value in diff['cells']:
+            conn.execute(f'UPDATE {table} SET {quote(columns[col])} = ? WHERE pos = ?', (to_cell(value), position))
+        if diff['deleted']:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS deleted (pos INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM deleted')
+            conn.executemany('INSERT INTO deleted VALUES (?)', [(position,) for position in diff['deleted']])
+            conn.execute(f'DELETE FROM {table} WHERE pos IN (SELECT pos FROM deleted)')
+            # Renumber in increasing order so the new positions never collide with rows not moved yet
+            moved = conn.execute(f'SELECT pos, pos - (SELECT COUNT(*) FROM deleted d WHERE d.pos < t.pos) FROM {table} t '
+                                 f'WHERE pos > (SELECT MIN(pos) FROM deleted) ORDER BY pos').fetchall()
+            conn.executemany(f'UPDATE {table} SET pos = ? WHERE pos = ?', [(new, old) for old, new in moved])
+    if diff['inserted']:
+        append_rows(conn, gsheet, diff['inserted'])
+
+# --- FILTER PUSH-DOWN ------------------------------------------
+def filter_clause(categories=None, recurrent=(True, False), include=(True, False), left=None, right=None):
+    """WHERE clause and parameters for the Visualize filters"""
+    clauses, params = [], []
+    if categories is not None:
+        clauses.append(f'category IN ({", ".join("?" * len(categories))})')
+        params += list(categories)
+    clauses.append(f'COALESCE(NULLIF(recurrent, \'\'), 0) IN ({", ".join("?" * len(recurrent))})')
+    params += [int(bool(value)) for value in recurrent]
+    clauses.append(f'COALESCE(NULLIF(include, \'\'), 0) IN ({", ".join("?" * len(include))})')
+    params += [int(bool(value)) for value in include]
+    if left is not None:
+        clauses.append('date >= ?')
+        params.append(pd.Timestamp(left).strftime('%Y-%m-%d'))
+    if right is not None:
+        clauses.append('date <= ?')
+        params.append(pd.Timestamp(right).strftime('%Y-%m-%d'))
+    return ' AND '.join(clauses), params
+
+def filter_rows(conn, gsheet: str, categories=None, recurrent=(True, False), include=(True, False), left=None, right=None) -> pd.DataFrame:
+    """Rows of a spending sheet matching the filters, selected by SQLite"""
+    where, params = filter_clause(categories, recurrent, include, left, right)
+    data = pd.read_sql_query(f'SELECT * FROM {quote(gsheet)} WHERE {where} ORDER BY pos', conn, params=params, index_col='pos')
+    data.index.name = None
+    return data
+
+def monthly_cells(conn, gsheet: str, categories=None, recurrent=(True, False), include=(True, False), left=None, right=None) -> pd.DataFrame:
+    """Same cells as monthly_cube.cube_slice() for the movements matching the filters, aggregated by SQLite"""
+    where, params = filter_clause(categories, recurrent, include, left, right)
+    cells = pd.read_sql_query(
+        f'SELECT substr(date, 1, 7) AS month, COALESCE(category, \'\') AS category, COALESCE(NULLIF(recurrent, \'\'), 0) AS recurrent, '
+        f'COALESCE(NULLIF(include, \'\'), 0) AS include, CASE WHEN amount < 0 THEN -1 ELSE 1 END AS sign, '
+        f'SUM(amount) AS amount, COUNT(*) AS count FROM {quote(gsheet)} '
+        f'WHERE date IS NOT NULL AND date != \'\' AND {where} GROUP BY 1, 2, 3, 4, 5 ORDER BY 1', conn, params=params)
+    cells['month'] = pd.to_datetime(cells['month'], format='%Y-%m')
+    cells['recurrent'] = cells['recurrent'].astype(bool)
+    cells['include'] = cells['include'].astype(bool)
+    return cells
+
+def month_flows(conn, gsheet: str, month) -> dict:
+    """Invested and received in a month in the inversiones sheet, like utils.investment_month_totals()"""
+    month = pd.Timestamp(month).strftime('%Y-%m')
+    invested, received = conn.execute(
+        f'SELECT SUM(CASE WHEN substr("Opening date", 1, 7) = ? THEN "Amount opening" END), '
+        f'SUM(CASE WHEN substr("Closing date", 1, 7) = ? THEN "Amount closing" END) FROM {quote(gsheet)}', (month, month)).fetchone()
+    return {'invested': invested or 0, 'received': received or 0}
+
+def date_bounds(conn, gsheet: str, date_col='date') -> tuple:
+    """First and last date of the sheet, found with the index on the dates. (None, None) if it has no dates"""
+    col = quote(date_col)
+    first, last = conn.execute(f"SELECT MIN({col}), MAX({col}) FROM {quote(gsheet)} WHERE {col} > ''").fetchone()  # '' is an empty cell
+    if first is None:
+        return None, None
+    return pd.Timestamp(first), pd.Timestamp(last)
+
+def contains(text, search) -> bool:
+    """Case-insensitive search of the raw data editor, with the case rules of pandas instead of the ASCII-only ones of LIKE"""
+    return text is not None and search.lower() in str(text).lower()
+
+def raw_positions(conn, gsheet: str, date_col: str, columns: list, search='', left=None, right=None) -> np.ndarray:
+    """Positions of the rows shown in the raw data editor, in the order of utils.raw_window(): most recent first (the last row
+    of a day first), rows without date last and only when there is no date range, searched in the text columns"""
+    col = quote(date_col)
+    dated = f"{col} > ''"
+    clauses, params = [], []
+    if left is not None or right is not None:
+        clauses.append(dated)
+    if left is not None:
+        clauses.append(f'{col} >= ?')
+        params.append(pd.Timestamp(left).strftime('%Y-%m-%d'))
+    if right is not None:
+        clauses.append(f'{col} <= ?')
+        params.append(pd.Timestamp(right).strftime('%Y-%m-%d'))
+    if search:
+        conn.create_function('contains', 2, contains, deterministic=True)
+        clauses.append('(' + ' OR '.join(f'contains({quote(column)}, ?)' for column in columns) + ')')
+        params += [search] * len(columns)
+    where = ' AND '.join(clauses) or '1'
+    rows = conn.execute(f'SELECT pos FROM {quote(gsheet)} WHERE {where} '
+                        f'ORDER BY {dated} DESC, CASE WHEN {dated} THEN {col} END DESC, CASE WHEN {dated} THEN -pos ELSE pos END', params)
+    return np.fromiter((row[0] for row in rows), dtype=np.int64)
+
+# --- SEED FROM THE LOCAL CACHE ------------------------------------------
+def seed_from_cache(conn, sheets=('italia', 'colombia', 'inversiones', 'juanis')):
+    """Copy the sheets mirrored in the local parquet cache into the database"""
+    for gsheet in sheets:
+        data, _ = sheet_cache.load_cache(gsheet)
+        if data is not None:
+            write_sheet(conn, gsheet, data)
+            print(f'{gsheet}: {len(data)} rows')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Create a SQLite database from the local cache of the Google Sheets')
+    parser.add_argument('path', nargs='?', default='finance.db')
+    seed_from_cache(connect(parser.parse_args().path))
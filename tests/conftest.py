@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # The modules of the app live at the top of the repo
+
+import sheet_cache
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Local cache of the sheets in a temporary folder"""
+    monkeypatch.setattr(sheet_cache, 'CACHE_DIR', tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    """Journal of pending writes in a temporary folder"""
+    import journal
+    monkeypatch.setattr(journal, 'JOURNAL_PATH', tmp_path / 'journal.jsonl')
+    monkeypatch.setattr(journal, 'PARKED_PATH', tmp_path / 'journal_parked.jsonl')
+    return tmp_path
+
+class SessionState(dict):
+    """Session state with attribute access, outside of a Streamlit run"""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+@pytest.fixture
+def session(journal_dir, tmp_path, monkeypatch):
+    """Empty session state of utils, with its own shared store and history, writes kept in the journal (no flusher)"""
+    import streamlit as st
+    import history
+    import journal
+    import shared_store
+    import utils
+    monkeypatch.setattr(st, 'session_state', SessionState())
+    for name in ['write', 'error', 'toast']:
+        monkeypatch.setattr(st, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(history, 'HISTORY_DIR', tmp_path / 'history')
+    monkeypatch.setattr(history, 'LOADED', {})
+    monkeypatch.setattr(journal, 'start_flusher', lambda *args, **kwargs: None)
+    monkeypatch.setattr(utils, 'SCRIPT_STORE', shared_store.new_store())
+    monkeypatch.setattr(utils, 'get_storage', lambda: None)
+    monkeypatch.setattr(utils, 'get_conn', lambda: None)
+    return st.session_state
@@ -0,0 +1,39 @@
+import io
+import pandas as pd
+import bank_import
+import utils
+
+STATEMENT = ('Fecha,Importe,Concepto\n'
+             '01/02/2024,-3.50,Cafe\n'
+             '01/02/2024,-3.50,Cafe\n'   # Two coffees the same day
+             '02/02/2024,-40.00,Mercado\n'
+             '03/02/2024,1500.00,Salario\n')
+
+def sheet(rows=None) -> pd.DataFrame:
+    """Typed spending sheet with the given movements"""
+    rows = rows if rows is not None else pd.DataFrame(columns=bank_import.COLUMNS)
+    return utils.apply_schema(rows.assign(category='Mercado', recurrent=False, include=True), 'italia')
+
+def imported(text, existing, **options) -> pd.DataFrame:
+    rows, _ = bank_import.import_statement(io.BytesIO(text.encode()), 'statement.csv', existing, **options)
+    return rows
+
+def test_importing_the_same_statement_again_adds_nothing():
+    first = imported(STATEMENT, sheet())
+    assert len(first) == 4
+    assert len(imported(STATEMENT, sheet(first))) == 0
+    assert len(imported(STATEMENT, sheet(first), chunksize=1)) == 0
+
+def test_rows_repeated_across_a_chunk_boundary():
+    """The two coffees end one chunk and start the next: each copy in the file counts once against the copies in the sheet"""
+    statement = 'Fecha,Importe,Concepto\n02/02/2024,-40.00,Mercado\n01/02/2024,-3.50,Cafe\n01/02/2024,-3.50,Cafe\n'
+    both = imported(statement, sheet())
+    assert len(imported(statement, sheet(both), chunksize=2)) == 0
+    one = imported(statement, sheet(both.iloc[:2]), chunksize=2)  # The sheet has only one of the coffees
+    assert list(one['description']) == ['Cafe']
+
+def test_delimiter_is_sniffed_from_the_header():
+    semicolons = STATEMENT.replace(',', ';').replace('.', ',')
+    rows = imported(semicolons, sheet(), decimal=',')
+    pd.testing.assert_frame_equal(rows, imported(STATEMENT, sheet()))
+    assert bank_import.sniff_delimiter('"Date, booked"\tAmount\tDescription') == '\t'
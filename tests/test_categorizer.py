@@ -0,0 +1,48 @@
+import json
+import pandas as pd
+import pytest
+import categorizer
+
+RULES = [{'category': 'Viajes', 'keywords': ['ita airways', 'ryanair']},
+         {'category': 'Transporte', 'keywords': ['airways', 'taxi'], 'name': 'transport'},
+         {'category': 'Mercado', 'keywords': ['coop', 'taxi']},  # 'taxi' is kept by the rule above
+         {'category': 'Almuerzos', 'regex': r'bar [a-z]+|pizzeria'},
+         {'category': 'Compras varias', 'keywords': ['bar']}]
+
+@pytest.fixture
+def compiled():
+    return categorizer.compile_rules(RULES)
+
+def categorize(compiled, *descriptions):
+    return categorizer.categorize(pd.Series(descriptions), compiled)
+
+def test_first_rule_in_the_list_wins(compiled):
+    labels = categorize(compiled, 'ITA Airways Roma-Milano', 'Volo Ryanair, coop', 'Taxi aeroporto', 'airways cargo')
+    assert list(labels['category']) == ['Viajes', 'Viajes', 'Transporte', 'Transporte']
+    assert list(labels['rule']) == ['Viajes #1', 'Viajes #1', 'transport', 'transport']
+    assert list(labels['match']) == ['ita airways', 'ryanair', 'taxi', 'airways']
+
+def test_regex_and_keyword_precedence(compiled):
+    """A regex rule listed before a keyword rule wins over it, and the other way round"""
+    labels = categorize(compiled, 'Bar Centrale', 'bar', 'Pizzeria da coop', 'cooperativa', None)
+    assert list(labels['category']) == ['Almuerzos', 'Compras varias', 'Mercado', None, None]
+    assert labels['match'].iloc[0] == 'Bar Centrale'
+
+def test_keywords_are_whole_words(compiled):
+    assert categorize(compiled, 'taxiway', 'co-op', 'coop.')['category'].tolist() == [None, None, 'Mercado']
+
+def test_fill_categories_keeps_the_categories_unless_overwrite(compiled):
+    data = pd.DataFrame({'description': ['taxi', 'coop', 'nothing'], 'category': pd.Categorical(['Salidas', None, None])})
+    filled = categorizer.fill_categories(data, compiled)
+    assert filled['category'].tolist()[:2] == ['Salidas', 'Mercado'] and pd.isna(filled['category'].iloc[2])
+    assert filled['rule'].fillna('').tolist() == ['', 'Mercado #3', '']  # Only the changed rows say which rule fired
+    overwritten = categorizer.fill_categories(data, compiled, overwrite=True)
+    assert overwritten['category'].tolist()[:2] == ['Transporte', 'Mercado'] and pd.isna(overwritten['category'].iloc[2])
+    assert isinstance(overwritten['category'].dtype, pd.CategoricalDtype)
+    assert data['category'].iloc[0] == 'Salidas' and data['category'].isna().sum() == 2  # The sheet itself is not changed
+
+def test_rules_of_the_repo_file_load():
+    rules = json.loads(categorizer.RULES_PATH.read_text(encoding='utf-8'))
+    for sheet in rules:
+        compiled = categorizer.load_rules(sheet)
+        assert len(compiled['categories']) == len(rules[sheet])
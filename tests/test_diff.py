@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+import journal
+import sheet_cache
+import utils
+
+STORED = pd.DataFrame({'date': [f'2024-01-{day:02d}' for day in range(1, 9)],
+                       'amount': [-10.0, -20.0, -30.0, 1000.0, -40.0, -50.0, -60.0, -70.0],
+                       'category': ['Mercado', 'Salidas', 'Mercado', 'Trabajo', 'Servicios', 'Salidas', 'Mercado', 'Viajes'],
+                       'description': list('abcdefgh'),
+                       'recurrent': [False, False, True, True, False, False, False, False],
+                       'include': [True] * 8})
+
+@pytest.fixture
+def data(session):
+    """Typed italia sheet published and selected in the session"""
+    data = utils.apply_schema(STORED, 'italia')
+    utils.set_data('italia', data)
+    return data
+
+def editor(data, rows=None):
+    """Frame as returned by the raw data editor for the given rows, with the position of each row in 'row'"""
+    shown = data if rows is None else data.loc[rows]
+    return shown.rename_axis('row').reset_index()
+
+def new_row(edited, date, amount, category, description):
+    row = pd.DataFrame({'row': [np.nan], 'date': [pd.Timestamp(date)], 'amount': [amount], 'category': [category],
+                        'description': [description], 'recurrent': [False], 'include': [True]})
+    row['category'] = row['category'].astype(edited['category'].dtype)
+    return pd.concat([edited, row], ignore_index=True)
+
+def diff(old, edited):
+    return sheet_cache.diff_frames(utils.storage_frame(old, 'italia'), utils.storage_frame(edited, 'italia'))
+
+def test_one_edited_cell(data):
+    edited = editor(data)
+    edited.loc[2, 'amount'] = -35.0
+    assert diff(data, edited) == {'cells': [(2, 1, -35.0)], 'deleted': [], 'inserted': []}
+
+def test_deleted_row(data):
+    edited = editor(data).drop(index=3)
+    assert diff(data, edited) == {'cells': [], 'deleted': [3], 'inserted': []}
+
+def test_inserted_row(data):
+    edited = new_row(editor(data), '2024-02-01', -15.0, 'Salud', 'i')
+    assert diff(data, edited) == {'cells': [], 'deleted': [], 'inserted': [['2024-02-01', -15.0, 'Salud', 'i', False, True]]}
+
+def test_merge_diff_matches_the_stored_frame(data):
+    edited = new_row(editor(data).drop(index=[0, 5]), '2024-02-01', -15.0, 'Salud', 'i')
+    edited.loc[6, 'category'] = 'Viajes'
+    changes = diff(data, edited)
+    merged = utils.merge_diff(data, changes, 'italia')
+    expected = utils.apply_schema(sheet_cache.apply_diff(utils.storage_frame(data, 'italia'), changes), 'italia')
+    pd.testing.assert_frame_equal(merged, expected, check_categorical=False)
+    assert list(merged.index) == list(range(7))  # Positions in the sheet after the deletions
+
+def test_window_matches_the_full_frame(data, session):
+    """Edit, delete and insert in a window of the editor: same diff and same saved sheet as doing it on the whole frame"""
+    window = np.array([5, 4, 3])  # Most recent first, like raw_window()
+    def edit(edited):
+        edited.loc[edited['row'] == 4, 'description'] = 'edited'
+        edited = edited[edited['row'] != 3]
+        return new_row(edited, '2024-02-01', -15.0, 'Salud', 'i')
+
+    on_window = diff(data.loc[window], edit(editor(data, window)))
+    on_full = diff(data, edit(editor(data)))
+    assert on_window == on_full == {'cells': [(4, 3, 'edited')], 'deleted': [3],
+                                    'inserted': [['2024-02-01', -15.0, 'Salud', 'i', False, True]]}
+
+    assert utils.update_data(edit(editor(data, window)), 'italia', rows=window)
+    saved = session['sheets']['italia']
+    assert len(saved) == 8 and session['versions']['italia'] == 2
+    assert list(saved['description']) == ['a', 'b', 'c', 'edited', 'f', 'g', 'h', 'i']  # Rows outside the window are kept
+    steps, _ = journal.pending_steps(journal.read_records())
+    assert [(step['op'], step.get('cells') or step.get('deleted') or step.get('rows')) for step in steps] == [  # What the flusher writes
+        ('cells', [[4, 3, 'edited']]), ('deleted', [3]), ('append', [['2024-02-01', -15.0, 'Salud', 'i', False, True]])]
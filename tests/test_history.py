@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+import history
+import journal
+import sqlite_store
+import utils
+
+STORED = pd.DataFrame({'date': ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05'],
+                       'amount': [-10.0, -20.0, -30.0, 1000.0, -40.0],
+                       'category': ['Mercado', 'Salidas', 'Mercado', 'Trabajo', 'Servicios'],
+                       'description': list('abcde'),
+                       'recurrent': [False, False, True, True, False],
+                       'include': [True] * 5})
+
+def rows(data: pd.DataFrame) -> pd.DataFrame:
+    """Stored values of the rows of a sheet in a fixed order: a rollback brings deleted rows back at the end"""
+    data = utils.storage_frame(data, 'italia')
+    return data.sort_values(list(data.columns)).reset_index(drop=True)
+
+def database(conn) -> pd.DataFrame:
+    return utils.apply_schema(sqlite_store.sync_sheet(conn, 'italia', 6), 'italia')
+
+def edit(session, change):
+    """Save a change made in the raw data editor on the whole sheet"""
+    edited = session['sheets']['italia'].rename_axis('row').reset_index()
+    assert utils.update_data(change(edited), 'italia')
+
+@pytest.fixture
+def saved(session):
+    """Sheet in the session and in SQLite, then three versions: an edit, an appended movement and an edit with a deletion.
+    Returns the SQLite connection and the frames of the original sheet and of each version"""
+    conn = sqlite_store.connect(':memory:')
+    sqlite_store.write_sheet(conn, 'italia', STORED)
+    utils.set_data('italia', utils.apply_schema(STORED, 'italia'))
+    frames = [session['sheets']['italia']]
+
+    def first(edited):
+        edited.loc[1, 'amount'] = -25.0
+        return edited
+    edit(session, first)
+    frames.append(session['sheets']['italia'])
+    utils.append_data([[pd.Timestamp('2024-01-06'), -50.0, 'Salud', 'f', False, True]], 'italia')
+    frames.append(session['sheets']['italia'])
+
+    def third(edited):
+        edited.loc[4, 'description'] = 'changed'
+        return edited.drop(index=[0, 5])
+    edit(session, third)
+    frames.append(session['sheets']['italia'])
+    journal.flush(sqlite_store, conn)
+    return conn, frames
+
+def test_net_changes_across_versions(saved):
+    changes = history.net_changes(history.versions('italia'), 1, 3)
+    assert changes['edited'] == [(3, ['2024-01-05', -40.0, 'Servicios', 'e', False, True], ['2024-01-05', -40.0, 'Servicios', 'changed', False, True])]
+    assert changes['added'] == []  # Appended in version 2 and deleted in version 3
+    assert changes['removed'] == [['2024-01-01', -10.0, 'Mercado', 'a', False, True]]
+
+@pytest.mark.parametrize('version', [1, 0])
+def test_rollback_matches_the_sheet_as_it_was(saved, session, version):
+    conn, frames = saved
+    assert len(history.versions('italia')) == 3
+    pd.testing.assert_frame_equal(rows(database(conn)), rows(frames[3]))
+    assert utils.rollback('italia', version)
+    pd.testing.assert_frame_equal(rows(session['sheets']['italia']), rows(frames[version]))
+    journal.flush(sqlite_store, conn)
+    pd.testing.assert_frame_equal(rows(database(conn)), rows(frames[version]))
+    assert len(history.versions('italia')) == 4  # The rollback is one more version
@@ -0,0 +1,102 @@
+import sqlite3
+import pandas as pd
+import pytest
+import journal
+import sqlite_store
+
+class Backend:
+    """SQLite backend whose first `failures` writes raise error, recording the writes that reach the database"""
+    def __init__(self, error=None, failures=0):
+        self.error, self.failures, self.writes = error, failures, []
+
+    def fail(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error
+
+    def count_rows(self, conn, gsheet):
+        return sqlite_store.count_rows(conn, gsheet)
+
+    def append_rows(self, conn, gsheet, rows):
+        self.fail()
+        sqlite_store.append_rows(conn, gsheet, rows)
+        self.writes.append(('append', gsheet, [row[3] for row in rows]))
+
+    def write_diff(self, conn, gsheet, diff):
+        self.fail()
+        sqlite_store.write_diff(conn, gsheet, diff)
+        self.writes.append(('diff', gsheet, diff['cells'] or diff['deleted']))
+
+def movement(description, amount=-1.0):
+    return ['2024-01-01', 'Mercado', amount, description, 0, 1]
+
+@pytest.fixture
+def conn(journal_dir, monkeypatch):
+    monkeypatch.setitem(journal.FLUSHER, 'rejected', {})
+    conn = sqlite_store.connect(':memory:')
+    for gsheet in ['italia', 'colombia']:
+        sqlite_store.write_sheet(conn, gsheet, pd.DataFrame([movement('a'), movement('b')],
+                                 columns=['date', 'category', 'amount', 'description', 'recurrent', 'include']))
+    return conn
+
+def descriptions(conn, gsheet='italia'):
+    return list(sqlite_store.sync_sheet(conn, gsheet, 6)['description'])
+
+def test_writes_are_replayed_in_order_after_an_error(conn):
+    journal.record('italia', 'append', [movement('c')])
+    journal.record('italia', 'append', [movement('d')])
+    journal.record('italia', 'diff', {'cells': [(0, 3, 'edited')], 'deleted': [1], 'inserted': [movement('e')]})
+    journal.record('italia', 'append', [movement('f')])
+    backend = Backend(ConnectionError('network down'), failures=1)
+    with pytest.raises(ConnectionError):
+        journal.flush(backend, conn)
+    assert descriptions(conn) == ['a', 'b'] and journal.queue_depth() == 4
+
+    assert journal.flush(backend, conn) == 6  # Steps: 2 appends, cells, deleted, inserted, append
+    assert backend.writes == [('append', 'italia', ['c', 'd']), ('diff', 'italia', [[0, 3, 'edited']]), ('diff', 'italia', [1]),
+                              ('append', 'italia', ['e', 'f'])]  # Consecutive appends go in one batch
+    assert descriptions(conn) == ['edited', 'c', 'd', 'e', 'f']
+    assert journal.queue_depth() == 0 and journal.JOURNAL_PATH.read_text() == ''  # Compacted
+    assert journal.flush(backend, conn) == 0 and len(backend.writes) == 4  # Nothing is sent twice
+
+def test_batch_interrupted_before_the_write_is_sent_again(conn):
+    journal.record('italia', 'append', [movement('c')])
+    steps, _ = journal.pending_steps(journal.read_records())
+    journal.write_record({'kind': 'begin', 'steps': [steps[0]['id']], 'rows': 2})  # Crash right after 'begin'
+    journal.flush(Backend(), conn)
+    assert descriptions(conn) == ['a', 'b', 'c']
+
+def test_batch_interrupted_after_the_write_is_not_duplicated(conn):
+    journal.record('italia', 'append', [movement('c')])
+    journal.record('italia', 'diff', {'cells': [(0, 3, 'edited')], 'deleted': [], 'inserted': []})
+    steps, _ = journal.pending_steps(journal.read_records())
+    journal.write_record({'kind': 'begin', 'steps': [steps[0]['id']], 'rows': 2})
+    sqlite_store.append_rows(conn, 'italia', [movement('c')])  # Reached the database, crash before 'done'
+    backend = Backend()
+    journal.flush(backend, conn)
+    assert backend.writes == [('diff', 'italia', [[0, 3, 'edited']])]
+    assert descriptions(conn) == ['edited', 'b', 'c']
+    assert journal.read_records() == []  # Everything done, the journal was emptied
+
+def test_rejected_batch_is_parked_and_the_queue_goes_on(conn):
+    journal.record('italia', 'append', [movement('c')])
+    journal.record('colombia', 'append', [movement('x')])
+    backend = Backend(sqlite3.IntegrityError('rejected'), failures=journal.PARK_AFTER)
+    for _ in range(journal.PARK_AFTER - 1):  # Retried like any other error, the write after it waits
+        with pytest.raises(sqlite3.IntegrityError):
+            journal.flush(backend, conn)
+        assert descriptions(conn, 'colombia') == ['a', 'b']
+    journal.flush(backend, conn)
+    assert descriptions(conn) == ['a', 'b'] and descriptions(conn, 'colombia') == ['a', 'b', 'x']
+    assert journal.status()['pending'] == 0 and journal.parked() == 1
+    assert 'IntegrityError' in journal.PARKED_PATH.read_text()
+
+def test_network_errors_are_never_parked(conn):
+    journal.record('italia', 'append', [movement('c')])
+    backend = Backend(ConnectionError('network down'), failures=journal.PARK_AFTER + 1)
+    for _ in range(journal.PARK_AFTER + 1):
+        with pytest.raises(ConnectionError):
+            journal.flush(backend, conn)
+    assert journal.parked() == 0
+    journal.flush(backend, conn)
+    assert descriptions(conn) == ['a', 'b', 'c']
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+import portfolio
+import price_store
+
+def investments(rows) -> pd.DataFrame:
+    """inversiones sheet from (investment, opening date, amount opening, closing date, amount closing)"""
+    data = pd.DataFrame(rows, columns=['Investment', 'Opening date', 'Amount opening', 'Closing date', 'Amount closing'])
+    data['Opening date'] = pd.to_datetime(data['Opening date'])
+    data['Closing date'] = pd.to_datetime(data['Closing date'])
+    return data.assign(Type='ETF', Platform='Broker').astype({'Amount opening': float, 'Amount closing': float})
+
+def test_xirr_of_two_cash_flows():
+    """-P at 0 and F at t years: (F / P) ** (1 / t) - 1"""
+    amounts = np.array([[-100.0, 121.0], [-1000.0, 1500.0], [-50.0, 40.0], [100.0, 10.0]])
+    times = np.array([[0.0, 2.0], [0.0, 1.5], [0.0, 0.5], [0.0, 1.0]])
+    irr = portfolio.xirr_batch(amounts, times)
+    np.testing.assert_allclose(irr[:3], [0.1, 1.5 ** (1 / 1.5) - 1, 0.8 ** 2 - 1], rtol=1e-9)
+    assert np.isnan(irr[3])  # No sign change, no IRR
+
+def test_position_irr_matches_the_closed_form():
+    data = investments([['A', '2020-01-01', 1000, '2022-01-01', 1210]])
+    returns = portfolio.position_returns(data)
+    years = 731 / portfolio.DAYS_YEAR
+    assert returns['IRR'].iloc[0] == pytest.approx(1.21 ** (1 / years) - 1, rel=1e-9)
+    assert returns['ROI'].iloc[0] == pytest.approx(0.21)
+
+@pytest.fixture
+def store(tmp_path):
+    """One instrument whose price grows 21% in 2023 at a steady daily rate"""
+    days = pd.date_range('2023-01-01', '2023-12-31')
+    prices = 100 * 1.21 ** (np.arange(len(days)) / (len(days) - 1))
+    price_store.append(pd.DataFrame({'date': days, 'instrument': 'X', 'price': prices}), tmp_path)
+    return price_store.load(tmp_path)
+
+def test_twr_with_an_interim_deposit(store):
+    """A large deposit in July doesn't change the TWR, which is the return of the instrument, while the IRR weighs it"""
+    data = investments([['X', '2023-01-01', 1000, None, None], ['X', '2023-07-01', 50000, None, None]])
+    total, annual, exact = portfolio.time_weighted_return(data, asof='2023-12-31', store=store)
+    assert exact
+    assert total == pytest.approx(0.21, rel=1e-9)
+    assert annual == pytest.approx(1.21 ** (portfolio.DAYS_YEAR / 364) - 1, rel=1e-9)
+    values = portfolio.marked_values(data, store, '2023-12-31')
+    assert portfolio.portfolio_xirr(data, asof='2023-12-31', values=values) != pytest.approx(total, rel=1e-3)
+
+def test_twr_with_a_withdrawal(store):
+    """Closing part of the holdings mid-year at the market price doesn't change the TWR either"""
+    mid = price_store.lookup(store, store['codes']['X'], price_store.day_number([pd.Timestamp('2023-07-01')]))[0]
+    data = investments([['X', '2023-01-01', 1000, None, None], ['X', '2023-01-01', 5000, '2023-07-01', 5000 * mid / 100]])
+    total, _, exact = portfolio.time_weighted_return(data, asof='2023-12-31', store=store)
+    assert exact and total == pytest.approx(0.21, rel=1e-9)
+
+def test_twr_without_prices_for_every_position_is_approximate(store):
+    data = investments([['X', '2023-01-01', 1000, None, None], ['Y', '2023-03-01', 100, None, None]])
+    assert not portfolio.time_weighted_return(data, asof='2023-12-31', store=store)[2]
+    assert not portfolio.time_weighted_return(data, asof='2023-12-31')[2]
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+import pandas as pd
+import shared_store
+import sqlite_store
+import utils
+
+MOVEMENTS = pd.DataFrame({'date': ['2024-01-01', '2024-01-02'], 'amount': [-10.0, -20.0], 'category': ['Mercado', 'Salidas'],
+                          'description': ['a', 'b'], 'recurrent': [False, False], 'include': [True, True]})
+
+def test_row_appended_during_the_download_is_not_replaced(journal_dir, monkeypatch):
+    monkeypatch.setattr(utils, 'SHEET_COLS', {'italia': 6})
+    conn = sqlite_store.connect(':memory:')
+    sqlite_store.write_sheet(conn, 'italia', MOVEMENTS)
+    store = shared_store.new_store()
+    shared_store.publish(store, 'italia', utils.load_sheet(sqlite_store, conn, 'not_other', 'italia', 6))
+    downloaded = {}
+
+    def check_sheet(conn, gsheet, ncols):
+        downloaded['data'] = sqlite_store.sync_sheet(conn, gsheet, ncols)  # The download, like the cache of Google Sheets
+        # Meanwhile a session appends a movement, the journal sends it and the new frame is published
+        row = ['2024-01-03', -30.0, 'Mercado', 'c', False, True]
+        sqlite_store.append_rows(conn, gsheet, [row])
+        shared_store.publish(store, gsheet, utils.load_sheet(sqlite_store, conn, 'not_other', gsheet, ncols))
+        return ('changed',), True
+
+    backend = SimpleNamespace(check_sheet=check_sheet, sync_sheet=lambda conn, gsheet, ncols, full=False: downloaded['data'])
+    utils.refresh_sheets(backend, conn, 'not_other', store)
+    assert utils.REFRESH['error'] is None
+    assert list(store['sheets']['italia']['description']) == ['a', 'b', 'c']  # The stale download was refused
+    assert store['versions']['italia'] == 2
+    assert 'italia' not in store['tokens']  # Not marked as loaded with the token of the stale frame
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rolling_stats
+
+TODAY = pd.Timestamp('2024-06-15')
+
+def movements(n: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'date': TODAY - pd.to_timedelta(rng.integers(0, 200, n), unit='D'),
+                         'amount': rng.normal(-30, 60, n).round(2),
+                         'category': rng.choice(['Mercado', 'Salidas', 'Trabajo', 'Transporte'], n),
+                         'recurrent': rng.random(n) < 0.2,
+                         'include': rng.random(n) < 0.9})
+
+def assert_same(incremental: dict, rebuilt: dict):
+    for channel in rolling_stats.CHANNELS:
+        a, b = rolling_stats.window_stats(incremental, channel), rolling_stats.window_stats(rebuilt, channel)
+        pd.testing.assert_frame_equal(a.sort_index(), b.sort_index(), atol=1e-6)
+    pd.testing.assert_series_equal(rolling_stats.rolling_series(incremental), rolling_stats.rolling_series(rebuilt), atol=1e-6)
+    a, b = rolling_stats.forecast(incremental), rolling_stats.forecast(rebuilt)
+    for key in ['booked', 'recurrent to come', 'daily rate', 'days left', 'this month', 'next month']:
+        assert a[key] == pytest.approx(b[key], abs=1e-6)
+    pd.testing.assert_frame_equal(a['by category'].sort_index(), b['by category'].sort_index(), atol=1e-6)
+
+def test_updates_equal_a_full_rebuild():
+    data = movements(600, seed=1)
+    state = rolling_stats.build(data.iloc[:400], today=TODAY)
+    rolling_stats.update(state, data.iloc[400:])                         # Added movements
+    rolling_stats.update(state, data.iloc[100:150], sign=-1)             # Deleted movements
+    edited = data.iloc[200:220].assign(amount=-5.0, category='Viajes')   # Edited: old version out, new one in, a new category
+    rolling_stats.update(state, data.iloc[200:220], sign=-1)
+    rolling_stats.update(state, edited)
+    older = pd.DataFrame({'date': [TODAY - pd.Timedelta(days=800)], 'amount': [-99.0], 'category': ['Salud'],
+                          'recurrent': [False], 'include': [True]})
+    rolling_stats.update(state, older)                                   # Before the start of the daily array
+    final = pd.concat([data.drop(index=data.index[100:150]).drop(index=data.index[200:220]), edited, older])
+    assert_same(state, rolling_stats.build(final, today=TODAY))
+
+@pytest.mark.parametrize('days', [1, 40, 400])
+def test_advancing_the_day_equals_a_rebuild(days):
+    data = movements(500, seed=2)
+    later = TODAY + pd.Timedelta(days=days)
+    state = rolling_stats.build(data, today=TODAY)
+    rolling_stats.advance(state, later)
+    new = data.iloc[:10].assign(date=later)  # Movements of the new day
+    rolling_stats.update(state, new)
+    assert_same(state, rolling_stats.build(pd.concat([data, new]), today=later))
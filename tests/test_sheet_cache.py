@@ -0,0 +1,92 @@
+import re
+import pandas as pd
+import sheet_cache
+
+class Spreadsheet:
+    def __init__(self):
+        self.updated = 0
+
+    def get_lastUpdateTime(self):
+        return self.updated
+
+class Worksheet:
+    """In-memory worksheet answering the A1 ranges used by sheet_cache, and recording them"""
+    def __init__(self, values):
+        self.values = values
+        self.spreadsheet = Spreadsheet()
+        self.requests = []
+
+    def get(self, a1):
+        self.requests.append(a1)
+        first, last = re.fullmatch(r'A(\d+):[A-Z](\d*)', a1).groups()
+        return [list(row) for row in self.values[int(first) - 1:int(last) if last else None]]
+
+    def change(self, values):
+        self.values = values
+        self.spreadsheet.updated += 1  # The token of the whole spreadsheet
+
+class Client:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def _select_worksheet(self, worksheet):
+        return self.ws
+
+class Conn:
+    def __init__(self, ws):
+        self.client = Client(ws)
+
+HEADER = ['date', 'amount', 'description']
+ROWS = [['2024-01-01', '10', 'a'], ['2024-01-02', '20', 'b'], ['2024-01-03', '30', 'c']]
+
+def synced(rows):
+    ws = Worksheet([HEADER] + rows)
+    conn = Conn(ws)
+    sheet_cache.sync_sheet(conn, 'italia', 3)
+    ws.requests.clear()
+    return ws, conn
+
+def test_unchanged_token_downloads_nothing(cache_dir):
+    ws, conn = synced(ROWS)
+    assert sheet_cache.check_sheet(conn, 'italia', 3) == (0, False)
+    assert ws.requests == []
+
+def test_appended_rows_are_read_from_the_last_synced_row(cache_dir):
+    ws, conn = synced(ROWS)
+    ws.change([HEADER] + ROWS + [['2024-01-04', '40', 'd']])
+    assert sheet_cache.check_sheet(conn, 'italia', 3) == (1, True)
+    assert ws.requests == ['A4:C']  # Last synced row and the ones after it, not the whole sheet
+    data, meta = sheet_cache.load_cache('italia')
+    assert list(data['description']) == ['a', 'b', 'c', 'd']
+    assert meta['rows'] == 4 and meta['token'] == 1
+
+def test_change_of_another_sheet_keeps_the_cache(cache_dir):
+    ws, conn = synced(ROWS)
+    ws.change([HEADER] + ROWS)
+    assert sheet_cache.check_sheet(conn, 'italia', 3) == (1, False)
+    assert ws.requests == ['A4:C']
+
+def test_edited_last_row_downloads_the_whole_sheet(cache_dir):
+    ws, conn = synced(ROWS)
+    ws.change([HEADER] + ROWS[:2] + [['2024-01-03', '35', 'c']])
+    assert sheet_cache.check_sheet(conn, 'italia', 3) == (1, True)
+    assert ws.requests == ['A4:C', 'A1:C']
+    data, _ = sheet_cache.load_cache('italia')
+    assert list(data['amount']) == [10, 20, 35]
+
+def test_deleted_rows_download_the_whole_sheet(cache_dir):
+    ws, conn = synced(ROWS)
+    ws.change([HEADER] + ROWS[1:])
+    sheet_cache.check_sheet(conn, 'italia', 3)
+    assert ws.requests[-1] == 'A1:C'
+    data, _ = sheet_cache.load_cache('italia')
+    pd.testing.assert_series_equal(data['description'], pd.Series(['b', 'c'], name='description'))
+
+def test_old_full_download_is_repeated(cache_dir, monkeypatch):
+    ws, conn = synced(ROWS)
+    monkeypatch.setattr(sheet_cache, 'FULL_SYNC_AGE', -1)  # Edits above the last row are only seen by a full download
+    ws.change([HEADER] + [['2024-01-01', '15', 'a']] + ROWS[1:])
+    sheet_cache.check_sheet(conn, 'italia', 3)
+    assert ws.requests == ['A1:C']
+    data, _ = sheet_cache.load_cache('italia')
+    assert list(data['amount']) == [15, 20, 30]
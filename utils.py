@@ -1,41 +1,597 @@
 # --- LIBRARIES ------------------------------------------
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import matplotlib.patches as mpatches
-import plotly.express as px
-import plotly.graph_objects as go
-from datetime import date
+from datetime import date  # Plotly is imported inside the plotting functions so pages without charts don't load it
 from streamlit_option_menu import option_menu
 from streamlit_gsheets import GSheetsConnection
 import numpy as np
-import time
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import sheet_cache
+import sqlite_store
+import journal
+import history
+import bank_import
+import categorizer
+import profiler
+import fx
+import monthly_cube
+import rolling_stats
+import filter_index
+import figure_cache
+import portfolio
+import price_store
+import shared_store
+import connections
 
 # --- READ DATA ------------------------------------------
-# @st.cache_data(ttl=0, show_spinner=False) #Refresh every n seconds
-def read_data(username, gsheet='italia', ncols=6):
-    """Read data from Google Sheets dataset into a dataframe and save it in the session state as 'data'"""
+SHEET_COLS = {'italia': 6, 'colombia': 6, 'inversiones': 8, 'juanis': 6}  # Number of columns to read for each sheet
+SHARED_TTL = 60  # Seconds before a new session checks if the shared sheets changed in the storage backend
 
-    # Delete the existing connection to prevent cached reads
-    if 'conn' in st.session_state:
-        del st.session_state['conn']
+# Storage backends: modules with the same sync_sheet(), check_sheet(), count_rows(), freshness(), append_rows() and write_diff() functions
+BACKENDS = {'gsheets': sheet_cache, 'sqlite': sqlite_store}
 
-    time.sleep(1)  # Allow time for API cache to clear
-    st.session_state['conn'] = st.connection("gsheets", type=GSheetsConnection, ttl=0) # Reset connection / Save connection status to database in session state
-    data = st.session_state['conn'].read(usecols=list(range(ncols)), worksheet=gsheet)
+def storage_config() -> dict:
+    """[storage] section of secrets.toml: backend = 'gsheets' (default) or 'sqlite', path of the SQLite database and
+    max_requests, requests to the backend at the same time (4 for Google Sheets, 1 for SQLite by default)"""
+    return dict(st.secrets.get('storage', {}))
 
-    if gsheet == 'inversiones':
-        data['Opening date'] = pd.to_datetime(data['Opening date'], yearfirst=True).dt.strftime('%Y-%m-%d') # Leave as string to avoid bugs of date format changing
-        data['Closing date'] = pd.to_datetime(data['Closing date'], yearfirst=True).dt.strftime('%Y-%m-%d') # Leave as string to avoid bugs of date format changing
-    else:
-        data.loc[:,'date'] = pd.to_datetime(data['date'], yearfirst=True).dt.strftime('%Y-%m-%d') # Leave as string to avoid bugs of date format changing
+def get_backend():
+    """Module of the configured storage backend"""
+    return BACKENDS[storage_config().get('backend', 'gsheets')]
+
+def connect(backend: str, path: str):
+    """New connection to a storage backend"""
+    if backend == 'sqlite':
+        return sqlite_store.connect(path)
+    return st.connection("gsheets", type=GSheetsConnection, ttl=0) # The pool keeps it, not the Streamlit cache
+
+def make_pool(backend: str, path: str, max_requests: int) -> dict:
+    """Connection pool of a storage backend"""
+    return connections.new_pool(BACKENDS[backend], lambda: connect(backend, path), max_requests=max_requests)
+
+@st.cache_resource(show_spinner=False)
+def server_pool(backend: str, path: str, max_requests: int) -> dict:
+    """Connection pool shared by all the sessions of this server process"""
+    return make_pool(backend, path, max_requests)
+
+SCRIPT_POOLS = {}  # Without a Streamlit server (benchmarks, scripts)
+
+def get_pool() -> dict:
+    """Connection pool of the configured storage backend"""
+    config = storage_config()
+    backend = config.get('backend', 'gsheets')
+    key = (backend, config.get('path', 'finance.db'), int(config.get('max_requests', 1 if backend == 'sqlite' else 4)))
+    if st.runtime.exists():
+        return server_pool(*key)
+    if key not in SCRIPT_POOLS:
+        SCRIPT_POOLS[key] = make_pool(*key)
+    return SCRIPT_POOLS[key]
+
+def get_storage():
+    """The configured backend with its functions running through the pool: limited concurrent requests and retries on quota errors"""
+    return connections.Pooled(get_pool())
+
+def get_conn():
+    """Get the connection to the storage backend, created once and shared by all the sessions"""
+    return connections.connection(get_pool())
+
+def load_sheet(backend, conn, username, gsheet='italia', ncols=6, full=False, trace=None) -> pd.DataFrame:
+    """Read one sheet from the storage backend and format it. Doesn't use the session state so it can run in a thread,
+    the spans are added to the given trace"""
+
+    with profiler.span(trace, 'read', sheet=gsheet):
+        data = backend.sync_sheet(conn, gsheet, ncols, full=full) # Google Sheets: from the cache on disk, checked later by refresh_sheets()
+    with profiler.span(trace, 'parse', sheet=gsheet):
+        data = apply_schema(data.dropna(how='all'), gsheet) # Remove extra rows that are actually empty and parse the columns once
     
     if username == 'other':
         data['amount'] = data['amount']*np.random.rand(len(data)) # Randomize amount for 'other' user
         data.drop(columns=['description'], inplace=True) # Remove description column for 'other' user
+    return data
+
+@st.cache_resource(show_spinner=False)
+def server_store() -> dict:
+    """Store of the sheets shared by all the sessions of this server process"""
+    return shared_store.new_store()
+
+SCRIPT_STORE = shared_store.new_store()  # Without a Streamlit server (benchmarks, scripts) st.cache_resource doesn't keep anything
+
+def get_store() -> dict:
+    """Shared store of the sheets"""
+    return server_store() if st.runtime.exists() else SCRIPT_STORE
+
+def set_data(gsheet: str, data: pd.DataFrame, base=None, write=None) -> bool:
+    """Publish a new frame of a sheet in the shared store and make it the selected data of this session. With base (version the frame
+    was built from) nothing is published if another session changed the sheet first and it returns False. write() saves the change,
+    it is called only if the frame is published"""
+
+    if st.session_state.get('private'):  # Data of the 'other' user is never shared
+        if write is not None:
+            write()
+        version = st.session_state.get('versions', {}).get(gsheet, 0) + 1
+    else:
+        version = shared_store.publish(get_store(), gsheet, data, base=base, write=write)
+        if version is None:
+            return False
+    use_frame(gsheet, data, version)
+    return True
+
+def add_rows(gsheet: str, rows: pd.DataFrame, base=None, write=None) -> bool:
+    """Like set_data() for the frame of the sheet with rows added at the end, without copying the frame (shared_store.append())"""
+
+    if st.session_state.get('private'):
+        data = st.session_state['sheets'][gsheet].copy(deep=False)
+        same_categories(data, rows)
+        return set_data(gsheet, pd.concat([data, rows]), base=base, write=write)
+    version = shared_store.append(get_store(), gsheet, rows, base=base, write=write)
+    if version is None:
+        return False
+    use_frame(gsheet, shared_store.snapshot(get_store())[0][gsheet], version)
+    return True
+
+def use_frame(gsheet: str, data: pd.DataFrame, version: int):
+    """Make a published frame the selected data of this session"""
+    if 'sheets' not in st.session_state:
+        st.session_state['sheets'] = {}
+        st.session_state['versions'] = {}
+    st.session_state['sheets'][gsheet] = data
+    st.session_state['versions'][gsheet] = version
+    figure_cache.invalidate(get_figure_cache(), gsheet)  # Figures of older versions will never be used again
     st.session_state['gsheet'] = gsheet
-    st.session_state['data'] =  data.dropna(how='all') # Remove extra rows that are actually empty
+    st.session_state['data'] = data
+
+def use_sheets(sheets: dict):
+    """Point this session at frames of the shared store {sheet: (frame, version)}, dropping what was built from older versions"""
+
+    st.session_state.setdefault('sheets', {})
+    st.session_state.setdefault('versions', {})
+    for gsheet, (data, version) in sheets.items():
+        st.session_state['sheets'][gsheet] = data
+        st.session_state['versions'][gsheet] = version
+        figure_cache.invalidate(get_figure_cache(), gsheet)
+        drop_aggregates(gsheet)  # Rebuilt from the new data
+    if st.session_state.get('gsheet') in sheets:
+        st.session_state['data'] = st.session_state['sheets'][st.session_state['gsheet']]
+
+def sync_sheets():
+    """Pick up the sheets changed by other sessions (update_data, Add movement) since the last rerun. Call it on every rerun after login"""
+
+    if st.session_state.get('private') or 'sheets' not in st.session_state:
+        return
+    changed = shared_store.newer(get_store(), st.session_state['versions'])
+    if changed:
+        use_sheets(changed)
+        st.toast('Updated: {}'.format(', '.join(changed)))  # By another session or by the check against the backend
+
+# @st.cache_data(ttl=0, show_spinner=False) #Refresh every n seconds
+def read_data(username, gsheet='italia', ncols=6, full=False):
+    """Read data from the local cache of the Google Sheets dataset, syncing only the new rows, and save it in the session state as 'data'"""
+
+    backend, conn = get_storage(), get_conn()
+    flush_journal(backend, conn)
+    set_data(gsheet, load_sheet(backend, conn, username, gsheet=gsheet, ncols=ncols, full=full, trace=get_trace()))
+    drop_aggregates(gsheet)  # Rebuilt from the new data
+
+def prefetch_sheets(username):
+    """Read all the sheets in parallel and keep them in the per-sheet store st.session_state['sheets'], so switching sheets doesn't wait for the network.
+    The sheets are read by the first session and shared with the others: painted from the local cache and then checked in the background
+    by refresh_sheets(), again after SHARED_TTL"""
+
+    if username == 'other':  # Randomised data, kept only in this session
+        st.session_state['private'] = True
+    store = get_store()
+    with store['load_lock']:  # Sessions opened at the same time wait for the first one instead of reading the sheets again
+        if st.session_state.get('private') or not shared_store.fresh(store, SHEET_COLS, SHARED_TTL):
+            backend, conn = get_storage(), get_conn()
+            flush_journal(backend, conn)
+            current, _ = shared_store.snapshot(store)
+            reads = SHEET_COLS if st.session_state.get('private') else [gsheet for gsheet in SHEET_COLS if gsheet not in current]
+            with ThreadPoolExecutor(max_workers=len(SHEET_COLS)) as pool:  # Google Sheets: from the files in .cache/, no request
+                futures = {gsheet: pool.submit(load_sheet, backend, conn, username, gsheet, SHEET_COLS[gsheet], trace=get_trace()) for gsheet in reads}
+            loaded = {gsheet: future.result() for gsheet, future in futures.items()}
+            if st.session_state.get('private'):
+                versions = st.session_state.get('versions', {})
+                use_sheets({gsheet: (data, versions.get(gsheet, 0) + 1) for gsheet, data in loaded.items()})
+                return
+            for gsheet, data in loaded.items():
+                shared_store.publish(store, gsheet, data)
+            start_refresh(backend, conn, username, store)
+    st.session_state.pop('sheets', None)
+    use_sheets(shared_store.newer(store, {}))
+
+REFRESH = {'thread': None, 'error': None}  # Background check of the sheets of this process
+
+def start_refresh(backend, conn, username, store):
+    """Start refresh_sheets() in the background unless it is already running"""
+    if REFRESH['thread'] is None or not REFRESH['thread'].is_alive():
+        REFRESH['thread'] = threading.Thread(target=refresh_sheets, args=(backend, conn, username, store), name='sheet-refresh', daemon=True)
+        REFRESH['thread'].start()
+
+def refresh_sheets(backend, conn, username, store):
+    """Check every sheet against the backend with its freshness token (check_sheet()) and publish in the shared store the ones
+    that changed, where the sessions pick them up on their next rerun. A sheet with writes still in the journal, or changed by
+    a session during the check, keeps the version of the session and its token is not recorded, so it is checked again"""
+
+    try:
+        tokens = {}
+        for gsheet, ncols in SHEET_COLS.items():
+            # Versions taken before the download: a row a session appends (and flushes) while it runs bumps the version,
+            # so the downloaded frame, which may not have the row, is refused by publish() instead of replacing it
+            current, versions = shared_store.snapshot(store)
+            token, changed = backend.check_sheet(conn, gsheet, ncols)
+            if changed or shared_store.stale(store, {gsheet: token}):
+                data = load_sheet(backend, conn, username, gsheet, ncols)
+                if gsheet in journal.pending_sheets():
+                    continue
+                if gsheet not in current or not current[gsheet].equals(data):
+                    if shared_store.publish(store, gsheet, data, base=versions.get(gsheet, 0)) is None:
+                        continue
+                elif shared_store.snapshot(store)[1].get(gsheet, 0) != versions.get(gsheet, 0):  # Same data, but a session changed it since
+                    continue
+            tokens[gsheet] = token
+        shared_store.mark_loaded(store, tokens)
+        REFRESH['error'] = None
+    except Exception as error:  # Network or quota errors: the sessions keep the sheets they have, checked again after SHARED_TTL
+        REFRESH['error'] = repr(error)
+
+def flush_journal(backend, conn):
+    """Send the writes left in the journal by a previous run before reading the sheets, so they are not missing from the data"""
+    if journal.queue_depth() == 0:
+        return
+    try:
+        with span('write', part='journal replay'):
+            journal.flush(backend, conn)
+    except Exception as error:
+        st.warning(f'{journal.queue_depth()} saved movements could not be sent to the database yet: {error!r}')
+
+def select_sheet(username, gsheet='italia', ncols=6):
+    """Make the selected sheet the current data, reading it only if it is not in the per-sheet store yet"""
+
+    if gsheet in st.session_state.get('sheets', {}):
+        st.session_state['gsheet'] = gsheet
+        st.session_state['data'] = st.session_state['sheets'][gsheet]
+    else:
+        read_data(username, gsheet=gsheet, ncols=ncols)
+
+# --- PROFILING ------------------------------------------
+def profiling_config() -> dict:
+    """[profiling] section of secrets.toml: enabled, panel (waterfall in the sidebar) and export (true or path of the JSON lines file)"""
+    return dict(st.secrets.get('profiling', {}))
+
+def start_trace(page: str):
+    """Start timing this rerun of the page, only if profiling is enabled. Call it at the top of every page"""
+    st.session_state['page_running'] = True  # Until profiler_panel(), so fragment() knows the whole page is running
+    if not profiling_config().get('enabled', False):
+        st.session_state['trace'] = None
+        return
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = profiler.session_id()
+    st.session_state['trace'] = profiler.new_trace(page, st.session_state['session_id'])
+
+def get_trace():
+    """Trace of this rerun, None when profiling is off"""
+    return st.session_state.get('trace')
+
+def span(name: str, **attrs):
+    """Time a stage of the rerun: 'with span('filter'):'. Costs a dictionary lookup when profiling is off"""
+    return profiler.span(st.session_state.get('trace'), name, **attrs)
+
+def profiler_panel(draw=True):
+    """Call it at the end of every page: exports the spans of the rerun and shows their waterfall in the sidebar"""
+
+    st.session_state['page_running'] = False
+    trace = get_trace()
+    if trace is None:
+        return
+    config = profiling_config()
+    if config.get('export'):
+        profiler.export(trace, sheet_cache.CACHE_DIR / 'spans.jsonl' if config['export'] is True else config['export'])
+    if not draw or not config.get('panel', True):
+        return
+    import plotly.graph_objects as go
+    spans = sorted(trace['spans'], key=lambda item: item['start_ms'])
+    labels = [' '.join([item['name']] + [str(value) for key, value in item.items()
+                                         if key not in ('name', 'start_ms', 'duration_ms', 'thread')]) for item in spans]
+    fig = go.Figure(go.Bar(y=list(range(len(spans))), x=[item['duration_ms'] for item in spans], base=[item['start_ms'] for item in spans],
+                           orientation='h', text=labels, textposition='auto', hovertext=[item['thread'] for item in spans]))
+    fig.update_yaxes(autorange='reversed', showticklabels=False)
+    fig.update_layout(title=f"{trace['page']}: {profiler.total_ms(trace):.0f} ms", xaxis_title='ms', height=120 + 25 * len(spans),
+                      margin=dict(l=0, r=0, t=40, b=0))
+    with st.sidebar.expander('Profiler'):
+        st.plotly_chart(fig, use_container_width=True)
+
+# --- PARTIAL RERUNS ------------------------------------------
+def fragment(func):
+    """Decorator for a section of a page with its own widgets: changing them reruns only the section, not the login, the loading
+    of the sheets and the rest of the page (st.experimental_fragment, Streamlit >= 1.33). With older versions the whole page
+    reruns as before. When profiling, a rerun of the section alone is exported as its own trace named 'page/section'"""
+
+    decorator = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+    if decorator is None:
+        return func
+
+    @functools.wraps(func)
+    def section(*args, **kwargs):
+        trace = get_trace()
+        if trace is None or st.session_state.get('page_running'):  # Part of a rerun of the whole page
+            with span('fragment', part=func.__name__):
+                return func(*args, **kwargs)
+        start_trace(f"{trace['page']}/{func.__name__}")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler_panel(draw=False)  # A fragment can't draw in the sidebar
+    return decorator(section)
+
+# --- SCHEMA ------------------------------------------
+# In memory every sheet keeps typed columns: datetime dates, categorical categories, boolean flags and float amounts.
+# Dates are converted to strings only when writing to Google Sheets (storage_frame() and sheet_cache.to_cell()).
+
+def with_categories(values: pd.Series, categories: list) -> pd.Categorical:
+    """Categorical with the known categories first, followed by any other value found in the data"""
+    extra = sorted(set(values.dropna().unique()) - set(categories))
+    return pd.Categorical(values, categories=categories + extra)
+
+def apply_schema(data: pd.DataFrame, gsheet: str) -> pd.DataFrame:
+    """Convert the columns of a sheet, as read from Google Sheets, to their in-memory types"""
+
+    data = data.copy()
+    if gsheet == 'inversiones':
+        data['Opening date'] = pd.to_datetime(data['Opening date'], yearfirst=True)
+        data['Closing date'] = pd.to_datetime(data['Closing date'], yearfirst=True)
+        data = data.astype({'Amount opening':float,'Amount closing':float})
+        data['Type'] = with_categories(data['Type'], get_categories(gsheet))
+        data['Platform'] = with_categories(data['Platform'], [])
+    else:
+        data['date'] = pd.to_datetime(data['date'], yearfirst=True)
+        data['amount'] = data['amount'].astype(float)
+        data['category'] = with_categories(data['category'], get_categories(gsheet))
+        data['recurrent'] = data['recurrent'].fillna(False).astype(bool)  # Empty flags don't match the True filters of the charts
+        data['include'] = data['include'].fillna(False).astype(bool)
+    return data
+
+def month_labels(dates: pd.Series) -> pd.Series:
+    """Label each date with its month like 'Jan-24', formatting only the distinct months instead of every row"""
+    months = dates.dt.to_period('M')
+    return months.map({month: month.strftime('%b-%y') for month in months.dropna().unique()})
+
+def memory_report() -> pd.DataFrame:
+    """Memory used by each sheet in the per-sheet store with the typed schema and with the columns as strings like in Google Sheets"""
+
+    report = pd.DataFrame(columns=['Rows','Typed (MB)','As strings (MB)'], dtype=float)
+    for gsheet, data in st.session_state.get('sheets', {}).items():
+        typed = data.memory_usage(deep=True).sum() / 1e6
+        strings = storage_frame(data, gsheet).astype(str).memory_usage(deep=True).sum() / 1e6
+        report.loc[gsheet] = [len(data), typed, strings]
+    report['Saving'] = 1 - report['Typed (MB)'] / report['As strings (MB)']
+    return report
+
+# --- MONTHLY CUBE ------------------------------------------
+def get_cube(gsheet: str) -> dict:
+    """Monthly aggregate cube of a spending sheet, built the first time it is needed after loading the sheet"""
+
+    if 'cubes' not in st.session_state:
+        st.session_state['cubes'] = {}
+    if gsheet not in st.session_state['cubes']:
+        with span('aggregate', part='monthly cube', sheet=gsheet):
+            st.session_state['cubes'][gsheet] = monthly_cube.build_cube(st.session_state['sheets'][gsheet])
+    return st.session_state['cubes'][gsheet]
+
+def drop_aggregates(gsheet: str):
+    """Forget the monthly cube and the rolling windows of a sheet, they are built again from its data when needed"""
+    st.session_state.get('cubes', {}).pop(gsheet, None)
+    st.session_state.get('rolling', {}).pop(gsheet, None)
+
+def update_aggregates(gsheet: str, removed: pd.DataFrame, added: pd.DataFrame):
+    """Remove rows from and add rows to the monthly cube and the rolling windows of a sheet, if they were built"""
+    if gsheet in st.session_state.get('cubes', {}):
+        monthly_cube.update_cube(st.session_state['cubes'][gsheet], removed, sign=-1)
+        monthly_cube.update_cube(st.session_state['cubes'][gsheet], added, sign=1)
+    if gsheet in st.session_state.get('rolling', {}):
+        rolling_stats.update(st.session_state['rolling'][gsheet], removed, sign=-1)
+        rolling_stats.update(st.session_state['rolling'][gsheet], added, sign=1)
+
+def update_aggregates_with_diff(gsheet: str, old: pd.DataFrame, new: pd.DataFrame, diff: dict):
+    """Apply a diff written by update_data() to the aggregates: remove the old version of the touched rows and add the new one"""
+
+    edited = np.array(sorted({cell[0] for cell in diff['cells']}), dtype=int)
+    deleted = np.sort(np.asarray(diff['deleted'], dtype=int))
+    moved = edited - np.searchsorted(deleted, edited)  # Position of the edited rows after removing the deleted ones
+    inserted = new.iloc[len(new) - len(diff['inserted']):] if diff['inserted'] else new.iloc[:0]
+    update_aggregates(gsheet, old.loc[np.concatenate([edited, deleted])], pd.concat([new.loc[moved], inserted]))
+
+def get_index(gsheet: str) -> dict:
+    """Filter index of a spending sheet, rebuilt only when the frame of the sheet changes"""
+
+    data = st.session_state['sheets'][gsheet]
+    def build():
+        with span('filter', part='filter index', sheet=gsheet):
+            return filter_index.build_index(data)
+    return shared_store.derived(get_store(), ('index', gsheet), (data,), build)  # Shared by the sessions with the same frame
+
+def pushdown(gsheet: str) -> bool:
+    """True if the reads of a sheet that run on every rerun (filters, totals, raw data window, date bounds) can be answered by SQLite
+    instead of the frame: the backend is SQLite, the data is not the randomised one of the 'other' user and the database already
+    has all the writes of the session"""
+    return get_backend() is sqlite_store and not st.session_state.get('private') and gsheet not in journal.pending_sheets()
+
+def date_bounds(gsheet: str) -> tuple:
+    """First and last date of a spending sheet, from SQLite or from the date-sorted filter index instead of scanning the dates"""
+    if pushdown(gsheet):
+        return get_storage().date_bounds(get_conn(), gsheet)
+    return filter_index.date_bounds(get_index(gsheet))
+
+def filter_cube(data: pd.DataFrame, gsheet: str, categories: list, recurrent: list, include: list, left_date, right_date) -> pd.DataFrame:
+    """Cells of the monthly cube matching the filters of the Visualize page. With the SQLite backend they come directly from SQL. Otherwise months fully inside the date range come from the cube,
+    the first and last months cut by the range are aggregated from the movements of those days, found with the filter index"""
+
+    if pushdown(gsheet):  # Filters and monthly aggregation resolved by SQLite
+        return get_storage().monthly_cells(get_conn(), gsheet, categories, recurrent, include, left_date, right_date)
+
+    left, right = pd.Timestamp(left_date), pd.Timestamp(right_date)
+    first_full = left.to_period('M').to_timestamp()
+    if first_full != left:
+        first_full += pd.offsets.MonthBegin(1)
+    after_full = (right + pd.Timedelta(days=1)).to_period('M').to_timestamp()  # First month after the last full month
+    full = monthly_cube.cube_slice(get_cube(gsheet), categories, recurrent, include, start=first_full, end=after_full - pd.Timedelta(days=1))
+
+    index = get_index(gsheet)
+    if first_full < after_full:  # Days before the first full month and after the last one
+        ranges = [(left, first_full - pd.Timedelta(days=1)), (after_full, right)]
+    else:  # The whole range is inside one month
+        ranges = [(left, right)]
+    labels = np.concatenate([filter_index.select(index, categories, recurrent, include, start, end) for start, end in ranges])
+    edges = data.loc[labels]
+    if len(edges) == 0:
+        return full
+    partial = monthly_cube.cube_frame(monthly_cube.build_cube(edges))
+    return pd.concat([full, partial]).sort_values(by='month', kind='stable', ignore_index=True)
+
+# --- ROLLING STATISTICS ------------------------------------------
+def get_rolling(gsheet: str) -> dict:
+    """Rolling 7/30/90-day windows of a spending sheet ending today, built the first time they are needed after loading the sheet
+    and then kept up to date by update_aggregates()"""
+
+    if 'rolling' not in st.session_state:
+        st.session_state['rolling'] = {}
+    if gsheet not in st.session_state['rolling']:
+        with span('aggregate', part='rolling windows', sheet=gsheet):
+            st.session_state['rolling'][gsheet] = rolling_stats.build(st.session_state['sheets'][gsheet])
+    state = st.session_state['rolling'][gsheet]
+    rolling_stats.advance(state)  # Only does something on the first rerun of a new day
+    return state
+
+def rolling_key(state: dict, key):
+    """Cache key of a figure of the rolling windows: they change with the version of the sheet and with the day"""
+    return None if key is None else (state['start'] + state['today'],) + tuple(key)
+
+def rolling_table(state: dict, key=None):
+    """Spending of each category in the last 7, 30 and 90 days, with the mean and standard deviation of its daily totals.
+    Pass key=() to reuse the table while the data and the day don't change"""
+    table = cached('rolling_table', rolling_key(state, key), lambda: rolling_stats.window_stats(state).sort_values(('30 days', 'sum'), ascending=False))
+    st.dataframe(table.style.format('{:,.0f}'))
+
+def rolling_chart(state: dict, currency: str, key=None):
+    """Spending of the last 30 days, for every day of the last year"""
+
+    def build():
+        import plotly.express as px
+        series = rolling_stats.rolling_series(state, window=30, days=365)
+        fig = px.line(x=series.index, y=series.to_numpy(), title='Spending of the last 30 days',
+                      labels={'x': 'Date', 'y': f'Amount ({currency})'})
+        return fig
+
+    fig = cached('rolling_chart', rolling_key(state, key), build)
+    with span('chart', part='rolling_chart', step='draw'):
+        st.plotly_chart(fig, use_container_width=True)
+
+def forecast_panel(state: dict, currency: str, key=None):
+    """Projected balance of this month and the next one, with the balance of this month so far and its projection to the end of the month"""
+
+    def build():
+        import plotly.graph_objects as go
+        projection = rolling_stats.forecast(state)
+        days = projection['days']
+        end = days.index[-1] + pd.Timedelta(days=projection['days left'])
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=days.index, y=days.to_numpy(), mode='lines', name='Balance so far', line=dict(color='black', width=2)))
+        fig.add_trace(go.Scatter(x=[days.index[-1], end], y=[days.iloc[-1], projection['this month']], mode='lines',
+                                 name='Projection', line=dict(color='gray', width=2, dash='dash')))
+        fig.update_layout(title='Balance of this month', yaxis_title=f'Amount ({currency})')
+        return projection, fig
+
+    projection, fig = cached('forecast', rolling_key(state, key), build)
+    cols = st.columns(4)
+    cols[0].metric('Projected balance this month', currency + '{:,.0f}'.format(projection['this month']))
+    cols[1].metric('Projected balance next month', currency + '{:,.0f}'.format(projection['next month']))
+    cols[2].metric('Recurrent still to come', currency + '{:,.0f}'.format(projection['recurrent to come']))
+    cols[3].metric('Daily rate (non-recurrent)', currency + '{:,.0f}'.format(projection['daily rate']))
+    with span('chart', part='forecast', step='draw'):
+        st.plotly_chart(fig, use_container_width=True)
+
+# --- CONSOLIDATED VIEW ------------------------------------------
+def get_consolidated(base: str) -> dict:
+    """All the spending sheets converted to the base currency, with their monthly totals by sheet. Rebuilt only when
+    a sheet or the FX table changes. Returns None if there is no FX table"""
+
+    rates_key = fx.rates_key()  # Taken before reading, a write in between only rebuilds once more
+    rates = fx.load_rates()
+    if rates is None:
+        return None
+    sheets = st.session_state['sheets']
+    def build():
+        with span('aggregate', part='consolidate', base=base):
+            data = fx.consolidate(sheets, base, rates)
+            data = data[data['include']]  # Same movements as the default filters of the single-sheet charts
+            flows = pd.DataFrame({'month': data['date'].to_numpy(dtype='datetime64[M]').astype('datetime64[ns]'), 'sheet': data['sheet'],
+                                  'balance': data['amount'], 'expenses': data['amount'].where(data['amount'] < 0, 0.0)})
+            monthly = flows.groupby(['month', 'sheet'], observed=True)[['balance', 'expenses']].sum().reset_index()
+        key = (rates_key,) + tuple(st.session_state['versions'].get(gsheet, 0) for gsheet in fx.SHEET_CURRENCY)  # Figures of these frames
+        return {'key': key, 'data': data, 'monthly': monthly, 'rates': rates}
+    sources = (rates,) + tuple(sheets.get(gsheet) for gsheet in fx.SHEET_CURRENCY)
+    return shared_store.derived(get_store(), ('consolidated', base), sources, build)  # Shared by the sessions with the same frames
+
+def consolidated_summary(consolidated: dict, symbol: str):
+    """Net balance of each sheet and of all of them, and what was spent this month, in the base currency"""
+    data = consolidated['data']
+    totals = data.groupby('sheet', observed=True)['amount'].sum()
+    this_month = data[data['date'].dt.to_period('M') == pd.Timestamp.today().to_period('M')]
+    cols = st.columns(len(totals) + 2)
+    for col, (gsheet, total) in zip(cols, totals.items()):
+        col.metric(f'Balance {gsheet}', symbol + '{:,.0f}'.format(total))
+    cols[-2].metric('Total balance', symbol + '{:,.0f}'.format(totals.sum()))
+    cols[-1].metric('Spent this month', symbol + '{:,.0f}'.format(-this_month.loc[this_month['amount'] < 0, 'amount'].sum()))
+
+def consolidated_chart(consolidated: dict, symbol: str, key=None):
+    """Monthly balance of each sheet stacked, with the cumulative balance of all of them. Pass the base currency as key to reuse the figure"""
+
+    def build():
+        import plotly.express as px
+        import plotly.graph_objects as go
+        monthly = consolidated['monthly']
+        fig = px.bar(monthly, x='month', y='balance', color='sheet', title='Monthly balance by sheet',
+                     labels={'balance': f'Balance ({symbol})', 'month': 'Month'})
+        total = monthly.groupby('month')['balance'].sum().cumsum()
+        fig.add_trace(go.Scatter(x=total.index, y=total.to_numpy(), mode='lines', name='Cumulative balance', line=dict(color='black', width=2)))
+        fig.update_xaxes(dtick="M1", tickformat="%b\n%Y")
+        return fig
+
+    fig = cached('consolidated_chart', None if key is None else (consolidated['key'],) + tuple(key), build)
+    with span('chart', part='consolidated_chart', step='draw'):
+        st.plotly_chart(fig, use_container_width=True)
+
+def consolidated_table(consolidated: dict):
+    """Expenses of every month by sheet, most recent first"""
+    monthly = consolidated['monthly']
+    table = monthly.pivot_table(index='month', columns='sheet', values='expenses', aggfunc='sum', observed=True)
+    table['Total'] = table.sum(axis=1)
+    table.index = month_labels(pd.Series(table.index)).to_numpy()
+    st.dataframe(table.iloc[::-1])
+
+# --- FIGURE CACHE ------------------------------------------
+STAGES = {'filter_cube': 'filter', 'month_cells': 'filter', 'monthly_table': 'aggregate', 'portfolio_summary': 'aggregate', 'rolling_table': 'aggregate', 'forecast': 'aggregate', 'portfolio_value': 'aggregate'}  # Span of each kind of cached value, 'chart' by default
+
+def get_figure_cache() -> dict:
+    """LRU cache of figures and pivot tables of the session"""
+
+    if 'figure_cache' not in st.session_state:
+        st.session_state['figure_cache'] = figure_cache.new_cache(max_entries=64)
+    return st.session_state['figure_cache']
+
+def cached(kind: str, key, build):
+    """Return the figure or table made by build(), reusing it while the version of the selected sheet and the filters in key don't change.
+    With key=None there is no caching"""
+
+    def timed_build():  # Only timed on a miss
+        with span(STAGES.get(kind, 'chart'), part=kind, step='build'):
+            return build()
+
+    if key is None:
+        return timed_build()
+    gsheet = st.session_state['gsheet']
+    return figure_cache.lookup(get_figure_cache(), (kind, gsheet, st.session_state['versions'][gsheet]) + tuple(key), timed_build)
 
 # --- SHEET SELECTION ------------------------------------------
 def get_sheet_and_cols(selection: str):
@@ -65,8 +621,7 @@ def on_change(key):
 
     selection = st.session_state[key]
     gsheet, ncols, _ = get_sheet_and_cols(selection)
-    st.session_state['gsheet'] = gsheet
-    read_data('not_other', gsheet = gsheet, ncols = ncols)
+    select_sheet('not_other', gsheet = gsheet, ncols = ncols)
 
 def sheet_menu(default = 0):
     """Show the menu to select the Google Sheet and return the selected option as a string"""
@@ -90,8 +645,19 @@ def sheet_menu(default = 0):
         key='menu_1',
         on_change=on_change
     )
+    show_journal_status()
     return selected
 
+def show_journal_status():
+    """Queue depth of the write-ahead journal in the sidebar"""
+    status = journal.status()
+    if status['pending'] > 0:
+        st.sidebar.caption(f"{status['pending']} movements waiting to be saved in the database")
+    if status['parked'] > 0:
+        st.sidebar.caption(f"{status['parked']} changes were rejected by the database, see {journal.PARKED_PATH.name}")
+    if status['error'] is not None:
+        st.sidebar.caption(f"Last save failed ({status['retries']} retries): {status['error']}")
+
 # --- BASIC FUNCTIONS ------------------------------------------
 def get_categories(sheet: str) -> list:
     """Get the different possible categories of spending/investments for the selected sheet"""
@@ -110,92 +676,331 @@ def get_categories(sheet: str) -> list:
     return categories
 
 # --- show raw data for italia and colombia --------------------------
-def show_raw_data(df: pd.DataFrame, gsheet: str, currency: str) -> pd.DataFrame:
+RAW_PAGE = 500  # Rows sent to the raw data editor at a time, whatever the length of the sheet
+SEARCH_COLUMNS = {'inversiones': ['Type', 'Platform']}  # Text columns searched in the raw data, description and category by default
+
+def raw_window(data: pd.DataFrame, gsheet: str, search: str = '', left=None, right=None) -> np.ndarray:
+    """Positions in the sheet of the rows shown in the raw data editor, most recent first: the ones with date between left and right
+    and a text column containing search. Rows without date go last and only when there is no date range"""
+
+    date_col = 'Opening date' if gsheet == 'inversiones' else 'date'
+    if pushdown(gsheet):  # Window and search resolved by SQLite
+        rows = get_storage().raw_positions(get_conn(), gsheet, date_col, SEARCH_COLUMNS.get(gsheet, ['description', 'category']), search, left, right)
+        return rows[np.isin(rows, data.index)]  # Rows added by another process are shown once the refresh brings them into the frame
+    if gsheet == 'inversiones':  # Small sheet, sorted directly
+        dates = data[date_col].dropna()
+        dates = dates[dates.between(pd.Timestamp(left or dates.min()), pd.Timestamp(right or dates.max()))] if len(dates) > 0 else dates
+        rows = dates[::-1].sort_values(ascending=False, kind='stable').index.to_numpy()  # The last row of a day first, like the other sheets
+    else:  # Date range found with the date-sorted filter index
+        index = get_index(gsheet)
+        rows = index['labels'][filter_index.date_slice(index, left, right)][::-1]
+    if left is None and right is None:
+        rows = np.concatenate([rows, data.index[data[date_col].isna()].to_numpy()])
+    if search:  # Only the rows inside the date range are searched
+        found = np.zeros(len(rows), dtype=bool)
+        for col in SEARCH_COLUMNS.get(gsheet, ['description', 'category']):
+            found |= data[col].loc[rows].astype(str).str.contains(search, case=False, regex=False).to_numpy()
+        rows = rows[found]
+    return rows
+
+def show_raw_data(df: pd.DataFrame, gsheet: str, currency: str, rows=None, key=None) -> pd.DataFrame:
     """Show the raw data in a table depending on the sheet selected. Pass st.session_state['data'], st.session_state['gsheet'] and currency as inputs
-      and returns the table with the modifications"""
+      and returns the table with the modifications. The hidden column 'row' keeps the position of each row in the sheet.
+      With rows (from raw_window()) only those rows are sent to the editor, in that order, and key should change with the window and the version of the sheet
+      so edits made on another window are dropped instead of being applied to other rows"""
     
+    if rows is not None:
+        df = df.loc[rows].rename_axis('row').reset_index()  # Already most recent first
     if gsheet == 'inversiones':
-        df = df.copy().astype({'Amount opening':float,'Amount closing':float}).sort_values(by='Opening date',ascending=False)
-        df['Opening date'] = pd.to_datetime(df['Opening date'], yearfirst=True)
-        df['Closing date'] = pd.to_datetime(df['Closing date'], yearfirst=True)
-        edited_df = st.data_editor(df, hide_index=True,
+        if rows is None:
+            df = df.rename_axis('row').reset_index().sort_values(by='Opening date',ascending=False,ignore_index=True)
+        edited_df = st.data_editor(df, hide_index=True, column_order=[col for col in df.columns if col != 'row'],
                                     column_config={'Amount opening':st.column_config.NumberColumn("Amount opening", format=f"{currency} %.0f"),
                                                     'Opening date':st.column_config.DateColumn('Opening date'),
                                                     'Amount closing':st.column_config.NumberColumn("Amount closing", format=f"{currency} %.0f"),
                                                     'Closing date':st.column_config.DateColumn('Closing date'),
                                                     'Type':st.column_config.SelectboxColumn('Type', help='Type of investment', required = True, options=get_categories(gsheet))},
-                                    num_rows='dynamic')
+                                    num_rows='dynamic', key=key)
     else:  # sheets colombia and italia
-        df = df.copy().astype({'recurrent':bool,'include':bool}).sort_values(by='date',ascending=False)
-        df['date'] = pd.to_datetime(df['date'], yearfirst=True)
+        if rows is None:
+            df = df.rename_axis('row').reset_index().sort_values(by='date',ascending=False,ignore_index=True)
         categories = get_categories(gsheet)
-        edited_df = st.data_editor(df, hide_index=True,
+        edited_df = st.data_editor(df, hide_index=True, column_order=[col for col in df.columns if col != 'row'],
                                     column_config={'amount':st.column_config.NumberColumn("Amount", format=f"{currency} %.1f"),
                                                     'date':st.column_config.DateColumn('Date'),
                                                     'category':st.column_config.SelectboxColumn('Category', help='Type of spending', required = True, options=categories),
                                                     'recurrent':st.column_config.CheckboxColumn('Recurrent',help='Is it recurrent?',default=True),
                                                     'inclue':st.column_config.CheckboxColumn('Include',help='Include it in monthly averages?',default=True)},
-                                    num_rows='dynamic')
+                                    num_rows='dynamic', key=key)
     return edited_df
 
-def update_data(edited_df: pd.DataFrame, gsheet: str):
-    """After editing the DataFrame shown by show_raw_data(), update the database with the new DataFrame"""
-    
+def storage_frame(df: pd.DataFrame, gsheet: str) -> pd.DataFrame:
+    """Return a copy of the DataFrame with the columns as they are stored in Google Sheets (dates as strings, flags as booleans and no categoricals)"""
+
+    df = df.copy()
+    for col in df.columns[df.dtypes == 'category']:
+        df[col] = df[col].astype(object)
     if gsheet == 'inversiones':
-        new_df = edited_df.sort_values(by='Opening date',ascending=True) # Return to previous ordering
-        new_df['Opening date'] = new_df['Opening date'].dt.strftime('%Y-%m-%d')
-        new_df['Closing date'] = new_df['Closing date'].dt.strftime('%Y-%m-%d')
+        for col in ['Opening date', 'Closing date']:
+            df[col] = pd.to_datetime(df[col], yearfirst=True).dt.strftime('%Y-%m-%d') # Date columns as a string to avoid format changing
     else:
-        new_df = edited_df.sort_values(by='date',ascending=True)    # Return to previous ordering
-        new_df['date'] = new_df['date'].dt.strftime('%Y-%m-%d')     # Date column as a string to avoid format changing
-    st.session_state['data'] = new_df                               # Update the data in session state
-    st.session_state['conn'].update(data=new_df, worksheet=gsheet)  # Update the database
+        df['date'] = pd.to_datetime(df['date'], yearfirst=True).dt.strftime('%Y-%m-%d')
+        df = df.astype({'recurrent':bool,'include':bool})
+    return df
 
-def monthly_total_spending(monthly, currency, recurrent=[True,False], include=[True]):
-    """Print the total amount spent this month and the balance, depending on the sheet selected. Pass the data st.session_state['data'] and the currency as inputs"""
+def same_categories(data: pd.DataFrame, new_data: pd.DataFrame):
+    """Give the categorical columns of both frames the same categories, so they stay categorical when combined"""
+    for col in data.columns[data.dtypes == 'category']:
+        categories = data[col].cat.categories.union(new_data[col].cat.categories, sort=False)
+        data[col] = data[col].cat.set_categories(categories)
+        new_data[col] = new_data[col].cat.set_categories(categories)
 
-    today_m = date.today().month
-    today_y = date.today().year
+def merge_diff(data: pd.DataFrame, diff: dict, gsheet: str) -> pd.DataFrame:
+    """Apply a diff to the typed DataFrame of a sheet, same result as sheet_cache.apply_diff() on its storage_frame() but only the
+    edited and inserted rows are converted, so saving a page of the raw data editor doesn't depend on the length of the sheet"""
 
-    if st.session_state['gsheet'] != 'inversiones':   # If italia or colombia
-        mask = (monthly['recurrent'].isin(recurrent))&(monthly['include'].isin(include))
-        filtered = monthly[mask] # Apply filters
-        filtered.loc[:,'date'] = pd.to_datetime(filtered['date'], yearfirst=True)
-        this_month = filtered[(filtered.date.dt.month == today_m) & (filtered.date.dt.year == today_y)] # Get only data from current month
+    data = data.copy()
+    edited = sorted({cell[0] for cell in diff['cells']})
+    if edited:
+        positions = data.index.get_indexer(edited)
+        rows = storage_frame(data.iloc[positions], gsheet).astype(object)
+        for position, col, value in diff['cells']:
+            rows.iat[rows.index.get_loc(position), col] = value
+        rows = apply_schema(rows.infer_objects(), gsheet)
+        same_categories(data, rows)
+        for i, col in enumerate(rows.columns):
+            data.iloc[positions, i] = rows[col].to_numpy()
+    if diff['deleted']:
+        deleted = np.sort(np.asarray(diff['deleted']))
+        data = data.drop(index=deleted)
+        data.index = data.index - np.searchsorted(deleted, data.index)  # Rows below a deleted one move up
+    if diff['inserted']:
+        start = data.index.max() + 1 if len(data.index) > 0 else 0
+        inserted = apply_schema(pd.DataFrame(diff['inserted'], columns=data.columns, index=range(start, start + len(diff['inserted']))), gsheet)
+        same_categories(data, inserted)
+        data = pd.concat([data, inserted])
+    return data
 
-        this_month_sum = -this_month[this_month['amount'] < 0]['amount'].sum()                      # Total amount spent this month (negative values represent expenses)
-        st.write('This month you have spent ' +currency + '{:,.0f}'.format(this_month_sum))
-        this_month_balance = this_month['amount'].sum()                                             # Total balance for this month (considering expenses and income)
-        st.write('This month your balance is ' +currency + '{:,.0f}'.format(this_month_balance))
-        return filtered                                                                                 # Return the filtered dataframe used for further plotting
+def update_data(edited_df: pd.DataFrame, gsheet: str, rows=None, summary='Edited in the raw data'):
+    """After editing the DataFrame shown by show_raw_data(), journal only the edited cells, deleted rows and inserted rows for the database.
+    rows are the positions shown in the editor when it only had a window of the sheet: rows outside it are not compared nor deleted.
+    Nothing is saved if another session changed the sheet after it was shown, as the positions may not match anymore. Returns True if saved"""
+    
+    old_data = st.session_state['sheets'][gsheet]
+    old_df = storage_frame(old_data if rows is None else old_data.loc[rows], gsheet)
+    new_df = storage_frame(edited_df, gsheet)
+    diff = sheet_cache.diff_frames(old_df, new_df)
+    st.write('{} cells edited in {} rows, {} rows deleted and {} rows inserted'.format(
+        len(diff['cells']), len({cell[0] for cell in diff['cells']}), len(diff['deleted']), len(diff['inserted'])))
+    return save_diff(gsheet, old_data, old_df, diff, summary)
 
-    elif st.session_state['gsheet'] == 'inversiones':
-        monthly['Opening date'] = pd.to_datetime(monthly['Opening date'], yearfirst=True)                                           # Convert to datetime                                       
-        monthly['Closing date'] = pd.to_datetime(monthly['Closing date'], yearfirst=True)
-        this_month_open = monthly[(monthly['Opening date'].dt.month == today_m) & (monthly['Opening date'].dt.year == today_y)]     # Get data in the given date range
-        this_month_close = monthly[(monthly['Closing date'].dt.month == today_m) & (monthly['Closing date'].dt.year == today_y)]
-        this_month_open_sum = this_month_open['Amount opening'].sum()
-        this_month_close_sum = this_month_close['Amount closing'].sum()
-        st.write('This month you have invested ' +currency + '{:,.0f}'.format(this_month_open_sum))
-        st.write('This month you have received ' +currency + '{:,.0f}'.format(this_month_close_sum))
+def save_diff(gsheet: str, old_data: pd.DataFrame, old_df: pd.DataFrame, diff: dict, summary: str) -> bool:
+    """Journal a diff computed on the frame old_data of a sheet, add it to the history and publish the new frame. old_df has the
+    stored values of the touched rows. Returns False if another session changed the sheet first"""
+
+    def write():
+        with span('write', part='diff', sheet=gsheet):
+            journal.record(gsheet, 'diff', diff)  # Saved on disk, the flusher sends only the changed ranges to the database
+            history.record(gsheet, history.delta_from_diff(old_df, diff, len(old_data) - len(diff['deleted'])), summary)
+    if not set_data(gsheet, merge_diff(old_data, diff, gsheet), base=st.session_state['versions'][gsheet], write=write):  # Update the shared data
+        st.error('The sheet was changed in another session, the edits were not saved. Make them again on the new data')
+        sync_sheets()
+        return False
+    journal.start_flusher(get_storage(), get_conn())
+    update_aggregates_with_diff(gsheet, old_data, st.session_state['data'], diff)
+    return True
+
+def history_changes(gsheet: str, a: int, b: int) -> dict:
+    """Changes of a sheet between two versions of its history"""
+    with span('aggregate', part='history', sheet=gsheet):
+        return history.net_changes(history.versions(gsheet), a, b)
+
+def rollback(gsheet: str, version: int) -> bool:
+    """Take the sheet back to a version of its history, writing only the rows changed since then. The rollback is a new version,
+    so it can be undone too. Returns True if saved"""
+
+    latest = len(history.versions(gsheet))
+    changes = history_changes(gsheet, version, latest)
+    old_data = st.session_state['sheets'][gsheet]
+    touched = [position for position, _, _ in changes['edited']] + [position for position, _ in changes['added']]
+    old_df = storage_frame(old_data.loc[old_data.index.intersection(touched)], gsheet)
+    if not history.matches(old_df, changes):
+        st.error('The sheet was changed outside the app since that version, it can\'t be rolled back')
+        return False
+    return save_diff(gsheet, old_data, old_df, history.rollback_diff(changes), f'Rolled back to version {version}')
+
+def append_data(new_rows: list, gsheet: str, summary='Added movement'):
+    """Append new rows to the journal and to the shared DataFrame of the sheet without rewriting the whole sheet"""
+
+    def write():
+        with span('write', part='append', sheet=gsheet):
+            journal.record(gsheet, 'append', new_rows)  # Saved on disk, the flusher sends the new rows to the database
+            history.record(gsheet, {'edited': [], 'deleted': [], 'inserted': [[int(start) + i, history.cells(row)] for i, row in enumerate(new_rows)]}, summary)
+    for _ in range(3):  # Appended to the latest frame, again if another session publishes one in between
+        sync_sheets()
+        data = st.session_state['sheets'][gsheet].copy(deep=False)  # The shared frame is not modified
+        start = data.index.max() + 1 if len(data.index) > 0 else 0  # Index matches the position of the row in the sheet
+        new_data = apply_schema(pd.DataFrame(new_rows, columns=data.columns, index=range(start, start + len(new_rows))), gsheet)
+        same_categories(data, new_data)
+        if add_rows(gsheet, new_data, base=st.session_state['versions'][gsheet], write=write):  # Without copying the sheet
+            break
+    else:
+        st.error('The sheet is being changed by another session, the movements were not saved. Try again')
+        return
+    journal.start_flusher(get_storage(), get_conn())
+    update_aggregates(gsheet, new_data.iloc[:0], new_data)  # Only the new rows are added to the monthly cube and the rolling windows
+
+def import_statement(file, name: str, gsheet: str, **options) -> tuple:
+    """Import a CSV/OFX bank statement into a spending sheet. Only the movements not in the sheet are added, in one batched write,
+    categorised with the rules of the sheet when the file has no category. Returns the number of movements read, added and categorised"""
+
+    with span('read', part='bank statement', sheet=gsheet):
+        rows, read = bank_import.import_statement(file, name, st.session_state['sheets'][gsheet], **options)
+    with span('aggregate', part='categorise', sheet=gsheet):
+        rows = categorizer.fill_categories(rows, categorizer.load_rules(gsheet))
+    categorised = int(rows['rule'].notna().sum())
+    if len(rows) > 0:
+        append_data(rows[bank_import.COLUMNS].values.tolist(), gsheet, summary=f'Imported {name}')
+    return read, len(rows), categorised
+
+def suggest_categories(data: pd.DataFrame, gsheet: str, overwrite=False) -> pd.DataFrame:
+    """Movements whose category would be changed by the rules of the sheet (only the ones without category unless overwrite),
+    with the rule that fired and the text it matched"""
+
+    filled = categorizer.fill_categories(data, categorizer.load_rules(gsheet), overwrite=overwrite)
+    changed = filled['rule'].notna()
+    return pd.DataFrame({'date': data['date'], 'description': data['description'], 'current': data['category'],
+                         'new': filled['category'], 'rule': filled['rule'], 'match': filled['match']})[changed]
+
+def apply_categories(gsheet: str, overwrite=False):
+    """Re-categorise the history of the sheet with its rules, saving only the changed cells. Returns True if saved"""
+    filled = categorizer.fill_categories(st.session_state['data'], categorizer.load_rules(gsheet), overwrite=overwrite)
+    changed = filled.index[filled['rule'].notna()]  # Only the changed rows are compared and saved
+    return update_data(filled.loc[changed].drop(columns=['rule', 'match']).rename_axis('row').reset_index(), gsheet, rows=changed,
+                       summary='Auto-categorised')
+
+def month_totals(filtered: pd.DataFrame, month=None) -> dict:
+    """Spent and balance of a month (the current one by default) from the cells of the monthly cube"""
+    month = pd.Timestamp(month or date.today()).to_period('M').to_timestamp()
+    this_month = filtered[filtered['month'] == month]
+    return {'spent': -this_month.loc[this_month['sign'] < 0, 'amount'].sum(),  # Expenses are negative
+            'balance': this_month['amount'].sum()}                            # Expenses and income
+
+def investment_month_totals(data: pd.DataFrame, month=None) -> dict:
+    """Invested and received in a month (the current one by default) in the inversiones sheet"""
+    month = pd.Timestamp(month or date.today()).to_period('M')
+    opened = data['Opening date'].dt.to_period('M') == month
+    closed = data['Closing date'].dt.to_period('M') == month
+    return {'invested': data.loc[opened, 'Amount opening'].sum(), 'received': data.loc[closed, 'Amount closing'].sum()}
+
+def monthly_total_spending(data: pd.DataFrame, gsheet: str, recurrent=[True,False], include=[True]) -> tuple:
+    """Totals of the current month of a sheet and, for spending sheets, the cells of the monthly cube that match the filters (None for inversiones).
+    Only computes, show the totals with show_month_totals()"""
+
+    if gsheet != 'inversiones':   # If italia or colombia
+        with span('filter', part='monthly totals'):
+            if pushdown(gsheet):  # Aggregated by SQLite, once per version of the sheet and filters
+                filtered = cached('month_cells', (recurrent, include), lambda: get_storage().monthly_cells(get_conn(), gsheet, None, recurrent, include))
+            else:
+                filtered = monthly_cube.cube_slice(get_cube(gsheet), recurrent=recurrent, include=include) # Apply filters
+        return month_totals(filtered), filtered                                                        # Filtered cube used for further plotting
+    if pushdown(gsheet):
+        return get_storage().month_flows(get_conn(), gsheet, date.today()), None
+    return investment_month_totals(data), None
+
+def show_month_totals(totals: dict, currency: str):
+    """Print the totals of the current month returned by monthly_total_spending()"""
+    if 'spent' in totals:
+        st.write('This month you have spent ' +currency + '{:,.0f}'.format(totals['spent']))
+        st.write('This month your balance is ' +currency + '{:,.0f}'.format(totals['balance']))
+    else:
+        st.write('This month you have invested ' +currency + '{:,.0f}'.format(totals['invested']))
+        st.write('This month you have received ' +currency + '{:,.0f}'.format(totals['received']))
+
+def get_prices() -> dict:
+    """Local store of prices of the instruments (price_store.py), mapped again only after an import. None if there are no prices"""
+    with span('read', part='prices'):
+        return price_store.load()
+
+def prices_key(key):
+    """Cache key of a figure of the investments: they change with the version of the sheet, with the imported prices and with the day"""
+    store = get_prices()
+    return None if key is None else (None if store is None else store['key'], date.today()) + tuple(key)
+
+def investment_values(data: pd.DataFrame):
+    """Value today of every position at the prices of its instrument, None (cost) if there are no prices"""
+    with span('aggregate', part='mark to market'):
+        return portfolio.marked_values(data, get_prices())
 
 def process_investments(data):
     """If the selected sheet is 'inversiones', process the data to add new columns and return the new dataframe with the changes. Pass the data st.session_state['data'] as input"""
 
     new_data = data.copy()
-    new_data['Opening date'] = pd.to_datetime(new_data['Opening date'], yearfirst=True)
-    new_data['Closing date'] = pd.to_datetime(new_data['Closing date'], yearfirst=True)
-    new_data['Active'] = new_data['Closing date'].isna()                                                    # If its nan (no closing date yet) then the investment is active
-    new_data['Earnings'] = new_data['Amount closing'] - new_data['Amount opening']                          # Total Earnings
-    new_data['ROI'] = new_data['Earnings'] / new_data['Amount opening']                                     # Return of investment
-    new_data['months'] = (new_data['Closing date'] - new_data['Opening date']).dt.days / 30                 # Months the investment was active
-    new_data['EA'] = (new_data['Amount closing']/new_data['Amount opening'])**(12/new_data['months'])-1     # Equivalent annual rate of return
+    values = investment_values(data)                                                                        # Active positions at the last imported price, or at cost
+    with span('aggregate', part='position returns'):
+        returns = portfolio.position_returns(new_data, values=values)
+    new_data['Active'] = returns['Active']                                                                  # If its nan (no closing date yet) then the investment is active
+    new_data['Value'] = returns['Value']                                                                    # Current value if active, amount at closing otherwise
+    new_data['Earnings'] = returns['Value'] - new_data['Amount opening']                                    # Total Earnings
+    new_data['ROI'] = returns['ROI']                                                                        # Return of investment
+    new_data['months'] = returns['Years'] * 12                                                              # Months the investment was active
+    new_data['IRR'] = returns['IRR']                                                                        # Annual internal rate of return (XIRR)
+    return new_data
 
+def show_investments(new_data):
+    """Table of the investments returned by process_investments()"""
     with st.expander('Show investments'):
         st.dataframe(new_data, column_config={'Opening date':st.column_config.DateColumn('Opening date'),
                                             'Closing date':st.column_config.DateColumn('Closing date'),
                                             'months':st.column_config.NumberColumn('months',format="%.1f"),})
-    return new_data
+
+def allocation_figure(data, by='Type', values=None):
+    """Share of the portfolio of each type or platform over time. values are the current values of the active positions (default: cost)"""
+    import plotly.express as px
+    fig = px.area(portfolio.allocation(data, by=by, values=values), title=f'Allocation by {by.lower()}',
+                  labels={'index':'Month', 'value':'Share', 'variable':by})
+    fig.update_yaxes(tickformat='.0%')
+    return fig
+
+def portfolio_summary(data, key=None):
+    """Show the IRR and time-weighted return of the whole portfolio and its allocation by type and platform over time.
+    Pass the data of the inversiones sheet and key=() to reuse the results while the data doesn't change"""
+
+    def build():
+        values = investment_values(data)
+        twr = portfolio.time_weighted_return(data, values=values, store=get_prices())  # (total, annualised, exact)
+        return portfolio.portfolio_xirr(data, values=values), twr, {by: allocation_figure(data, by, values) for by in ['Type', 'Platform']}
+
+    irr, (twr, twr_annual, exact), figs = cached('portfolio_summary', prices_key(key), build)
+    approximate = None if exact else ('Approximate: the positions without imported prices are valued at their own IRR between '
+                                      'opening and closing, which makes this close to a money-weighted return')
+    col1, col2, col3 = st.columns(3)
+    col1.metric('Portfolio IRR', '{:.2%}'.format(irr))
+    col2.metric('Time-weighted return' + ('' if exact else ' (approx.)'), '{:.2%}'.format(twr), help=approximate)
+    col3.metric('Annualised TWR' + ('' if exact else ' (approx.)'), '{:.2%}'.format(twr_annual), help=approximate)
+    with st.expander('Allocation over time'):
+        for fig in figs.values():
+            with span('chart', part='portfolio_summary', step='draw'):
+                st.plotly_chart(fig, use_container_width=True)
+
+def portfolio_value_figure(data, by='Type'):
+    """Daily value of the portfolio by type or platform, marked to market with the imported prices"""
+    import plotly.express as px
+    fig = px.area(portfolio.daily_values(data, get_prices(), by=by), title=f'Value by {by.lower()}',
+                  labels={'index':'Day', 'value':'Value', 'variable':by})
+    return fig
+
+def portfolio_value_chart(data, key=None):
+    """Daily value of the portfolio grouped by type or platform. Pass key=() to reuse the figure while the data and the prices don't change"""
+    by = st.radio('Value by', ['Type', 'Platform'], horizontal=True)
+    fig = cached('portfolio_value', prices_key(key if key is None else tuple(key) + (by,)), lambda: portfolio_value_figure(data, by))
+    with span('chart', part='portfolio_value', step='draw'):
+        st.plotly_chart(fig, use_container_width=True)
+
+def import_prices(file) -> int:
+    """Import a CSV of prices (date,instrument,price) into the local price store. Returns the number of prices added"""
+    with span('write', part='prices'):
+        return price_store.import_csv(file)
 
 # --- ADDING NEW MOVEMENTS -------------------------------------------------------------------------------
 def show_input_data(gsheet):
@@ -206,7 +1011,7 @@ def show_input_data(gsheet):
         col1, col2 = st.columns(2)
         platform = col1.text_input('Platform')
         type = col2.selectbox('Type', get_categories(gsheet))
-        opening_date = col1.date_input('Opening date').strftime("%Y-%m-%d")
+        opening_date = col1.date_input('Opening date')
         amount_opening = col2.number_input('Amount opening (COP)')
         comments = st.text_input('Comments')
 
@@ -225,10 +1030,12 @@ def show_input_data(gsheet):
 
     else: #elif gsheet == 'colombia':
         col1, col2 = st.columns(2)
-        date = col1.date_input('Date').strftime("%Y-%m-%d")
+        date = col1.date_input('Date')
         amount = col2.number_input('Amount', step=0.1)  # , format='%d'
-        category = st.selectbox('Category', get_categories(gsheet))
         description = st.text_input('Description')
+        categories = get_categories(gsheet)
+        suggested = categorizer.categorize(pd.Series([description]), categorizer.load_rules(gsheet))['category'][0]  # Category given by the rules
+        category = st.selectbox('Category', categories, index=categories.index(suggested) if suggested in categories else 0)
 
         col1, col2, col3 = st.columns(3)
         index_income = 1 if category == 'Trabajo' or category=='Ahorros' else 0
@@ -244,116 +1051,153 @@ def show_input_data(gsheet):
 
 # --- PLOTS ----------------------------------------------------------------------------------------------
 # --- Monthly table with totals ----------------
-def monthly_table(filtered_data: pd.DataFrame):    
-    monthly_pivot = pd.pivot_table(filtered_data, values = 'amount', columns='category', index='Date', aggfunc='sum', sort=False)
+def monthly_pivots(filtered_data: pd.DataFrame) -> tuple:
+    """Monthly balance and expenses, and monthly totals by category, from the cells of the monthly cube matching the filters"""
+
+    data = filtered_data.assign(Date=month_labels(filtered_data['month']))
+    monthly_pivot = pd.pivot_table(data, values = 'amount', columns='category', index='Date', aggfunc='sum', sort=False, observed=True)
+    monthly_balance = monthly_pivot.sum(axis=1)
+    expenses = data[data['sign']<0].pivot_table(values = 'amount', columns='category', index='Date', aggfunc='sum', sort=False, observed=True)
+    monthly_expenses = expenses.sum(axis=1)
+
+    total_monthly_table = pd.DataFrame(index = monthly_pivot.index)
+    total_monthly_table['Balance'] = monthly_balance  # Insert a first column with the totals
+    total_monthly_table['Expenses'] = monthly_expenses  # Insert a first column with the totals
+    return total_monthly_table, monthly_pivot
+
+def monthly_table(filtered_data: pd.DataFrame, key=None):
+    """Show the monthly totals by category. Pass the cells of the monthly cube matching the filters (see filter_cube())
+    and the filters as key to reuse the tables while the data doesn't change"""
+
+    total_monthly_table, monthly_pivot = cached('monthly_table', key, lambda: monthly_pivots(filtered_data))
     with st.expander('Show monthly table by category'):
         st.subheader('Montly data')
         col1, col2 = st.columns([1,3])
-        monthly_balance = monthly_pivot.sum(axis=1)
-        expenses = filtered_data[filtered_data['amount']<0].pivot_table(values = 'amount', columns='category', index='Date', aggfunc='sum', sort=False)
-        monthly_expenses = expenses.sum(axis=1)
-
-        total_monthly_table = pd.DataFrame(index = monthly_pivot.index)
-        total_monthly_table['Balance'] = monthly_balance  # Insert a first column with the totals
-        total_monthly_table['Expenses'] = monthly_expenses  # Insert a first column with the totals
-
         col1.dataframe(total_monthly_table.iloc[::-1]) # See the table with total monthly balance and spending
         col2.dataframe(monthly_pivot.iloc[::-1]) # See the table with total monthly spending for each category, most recent first
     return monthly_pivot
 
 # --- Monthly spending plot for colombia and italia (used in home page) ------------
-def monthly_spending_plot(filtered,include,currency):
-    filtered = filtered.set_index('date')
+def monthly_spending_figure(filtered, include, currency):
+    """Bar chart with the total of each month of the cells of the monthly cube"""
+    import plotly.express as px
+    data = filtered.rename(columns={'month':'date'})
     if False in include: # In order to show different colors
-        monthly_agg = filtered.groupby([pd.Grouper(freq='M'), 'include'])['amount'].sum().reset_index(1)
+        monthly_agg = data.groupby(['date', 'include'])['amount'].sum().reset_index(1)
         fig = px.bar(monthly_agg, title='Total monthly spending', text_auto='.0f',color='include',
                     labels={'date':'Month', 'value':f'Amount {currency}'})
     else:
-        monthly_agg = filtered.groupby(pd.Grouper(freq='M'))['amount'].sum()
+        monthly_agg = data.groupby('date')['amount'].sum()
         monthly_agg.index = monthly_agg.index.strftime("%Y-%m")
         fig = px.bar(monthly_agg, title='Total monthly spending', text_auto='.0f',
                     labels={'date':'Month', 'value':f'Amount {currency}'})
     fig.update_traces(textfont_size=12, textangle=0, textposition="outside", cliponaxis=False) # Annotate data
     fig.update_layout(showlegend=False) # Remove legend
     fig.update_xaxes(dtick="M1",tickformat="%b\n%Y") # Show monthly ticks in x-axis
-    st.plotly_chart(fig) # Show figure
+    return fig
+
+def monthly_spending_plot(filtered,include,currency,key=None):
+    """Bar chart with the total of each month. Pass the cells of the monthly cube returned by monthly_total_spending()
+    and the filters as key to reuse the figure while the data doesn't change"""
+
+    fig = cached('monthly_spending_plot', key, lambda: monthly_spending_figure(filtered, include, currency))
+    with span('chart', part='monthly_spending_plot', step='draw'):
+        st.plotly_chart(fig) # Show figure
 
 # --- Stacked bar chart for italia and colombia -----
-def stacked_bar_chart(base_df: pd.DataFrame, currency: str):
-    
+def stacked_bar_figure(base_df: pd.DataFrame, currency: str):
+    """Stacked bar chart by category with the monthly balance, from all the cells of the monthly cube"""
+    import plotly.express as px
+    import plotly.graph_objects as go
     df_filtered = base_df.copy()
-    df_filtered['month'] = df_filtered['date'].dt.strftime('%Y-%m')
+    df_filtered['month'] = df_filtered['month'].dt.strftime('%Y-%m')
     monthly_expenses = df_filtered.groupby(['month', 'category'])['amount'].sum().reset_index()
 
     # Calculate total balance for each month
     monthly_balance = df_filtered.groupby('month')['amount'].sum().reset_index()
 
-    with st.expander('Show monthly chart by category'):
-        plt.style.use("dark_background")
-        # Plot the stacked bar chart
-        
-        fig = px.bar(monthly_expenses, 
-                        x='month', 
-                        y='amount', 
-                        color='category', 
-                        title='Monthly Expenses and Income by Category', 
-                        labels={'amount': f'Amount ({currency})', 'month': 'Month'},
-                        text_auto=True)
-        
-        # Add the line plot for total balance
-        fig.add_trace(go.Scatter(x=monthly_balance['month'], 
-                                 y=monthly_balance['amount'], 
-                                 mode='lines+markers', 
-                                 name='Total Balance',
-                                 line=dict(color='black', width=2)))
-        
-        # Add a thicker horizontal line at y=0 that spans the entire chart
-        fig.add_shape(type='line',
-                      x0=0, 
-                      x1=1, 
-                      y0=0, y1=0,
-                      line=dict(color='gray', width=2, dash='dash'),  # Customize color, width, and dash style
-                      xref='paper',  # xref is set to paper to span the full width of the chart
-                      yref='y')
+    # Plot the stacked bar chart
+    fig = px.bar(monthly_expenses, 
+                    x='month', 
+                    y='amount', 
+                    color='category', 
+                    title='Monthly Expenses and Income by Category', 
+                    labels={'amount': f'Amount ({currency})', 'month': 'Month'},
+                    text_auto=True)
+    
+    # Add the line plot for total balance
+    fig.add_trace(go.Scatter(x=monthly_balance['month'], 
+                             y=monthly_balance['amount'], 
+                             mode='lines+markers', 
+                             name='Total Balance',
+                             line=dict(color='black', width=2)))
+    
+    # Add a thicker horizontal line at y=0 that spans the entire chart
+    fig.add_shape(type='line',
+                  x0=0, 
+                  x1=1, 
+                  y0=0, y1=0,
+                  line=dict(color='gray', width=2, dash='dash'),  # Customize color, width, and dash style
+                  xref='paper',  # xref is set to paper to span the full width of the chart
+                  yref='y')
+    return fig
+
+def stacked_bar_chart(base_df: pd.DataFrame, currency: str, key=None):
+    """Stacked bar chart by category with the monthly balance. Pass all the cells of the monthly cube (monthly_cube.cube_frame())
+    and key=() to reuse the figure while the data doesn't change"""
 
+    with st.expander('Show monthly chart by category'):
         # Display the plot in Streamlit
         #st.pyplot(plot.figure, clear_figure=True)
-        st.plotly_chart(fig, use_container_width=True)
+        fig = cached('stacked_bar_chart', key, lambda: stacked_bar_figure(base_df, currency))
+        with span('chart', part='stacked_bar_chart', step='draw'):
+            st.plotly_chart(fig, use_container_width=True)
         st.text('\n')  # Add extra space
 
 # --- Heatmap ------------
-def get_monthly_heatmap(monthly_spend: pd.DataFrame, gsheet='italia'):
+def monthly_heatmap_figure(monthly_spend: pd.DataFrame, gsheet='italia'):
+    """Heatmap of the monthly table by category returned by monthly_pivots()"""
+    import plotly.express as px
     if gsheet == 'colombia' or gsheet == 'italia':
         cmap = 'RdYlGn'  # Red for negative, Yellow for neutral, Green for positive
     else:
         cmap = None
 
+    # Use a divergent color scale with green for positive and red for negative values
+    fig = px.imshow(
+        monthly_spend,
+        text_auto=True,
+        aspect="auto",
+        color_continuous_scale=cmap  # Red for negative, Yellow for neutral, Green for positive
+    )
+    fig.update_xaxes(side="top")
+    fig.update_layout(xaxis_title=None,
+                      coloraxis_colorbar=dict(title="Value"))
+    return fig
+
+def get_monthly_heatmap(monthly_spend: pd.DataFrame, gsheet='italia', key=None):
+    """Heatmap of the monthly table by category. Pass the same key used for monthly_table() to reuse the figure"""
     with st.expander('Show heatmap'):
-        # Use a divergent color scale with green for positive and red for negative values
-        fig = px.imshow(
-            monthly_spend,
-            text_auto=True,
-            aspect="auto",
-            color_continuous_scale=cmap  # Red for negative, Yellow for neutral, Green for positive
-        )
-        fig.update_xaxes(side="top")
-        fig.update_layout(xaxis_title=None,
-                          coloraxis_colorbar=dict(title="Value"))
-        st.plotly_chart(fig, theme=None)  # , theme="streamlit"
-
-def pie_plot_invs(new_data):
-    active_invs = new_data[new_data['Active']][['Investment', 'Platform', 'Type','Amount opening','Opening date']]
+        fig = cached('monthly_heatmap', key, lambda: monthly_heatmap_figure(monthly_spend, gsheet))
+        with span('chart', part='monthly_heatmap', step='draw'):
+            st.plotly_chart(fig, theme=None)  # , theme="streamlit"
+
+def investments_pie_figure(new_data):
+    """Pie chart of the active investments colored by type, from the investments returned by process_investments()"""
+    import plotly.express as px
+    active_invs = new_data[new_data['Active']][['Investment', 'Platform', 'Type','Amount opening','Value','Opening date']]
     total_inv = active_invs['Amount opening'].sum()
-    title = 'Total investment: $ {:,.0f}'.format(total_inv)
-
-    types = active_invs['Type'].unique()
-    colors = sns.color_palette('Set2')[0:len(types)]
-    color_dict = dict(zip(types, colors))
-    active_invs['color'] = active_invs['Type'].map(color_dict)
-
-    pie_plot = active_invs.plot.pie(y='Amount opening', labels=active_invs['Investment'],
-                                    autopct='%1.1f%%', legend=False, ylabel='', colors=active_invs['color'], textprops={'fontsize': 8})
-    plt.title(title, fontsize=16, fontweight='bold')
-    legend_patches = [mpatches.Patch(color=color_dict[inv_type], label=inv_type) for inv_type in types]
-    plt.legend(handles=legend_patches, loc='center left', bbox_to_anchor=(1, 0.7))
-    st.pyplot(pie_plot.figure)
+    title = 'Total value: $ {:,.0f} (invested $ {:,.0f})'.format(active_invs['Value'].sum(), total_inv)
+
+    fig = px.pie(active_invs, values='Value', names='Investment', color='Type',
+                 color_discrete_sequence=px.colors.qualitative.Set2, title=title)
+    fig.update_traces(textinfo='percent', textfont_size=12, sort=False)
+    fig.update_layout(title_font=dict(size=20), legend_title_text='Investment')
+    return fig
+
+def pie_plot_invs(new_data, key=None):
+    """Pie chart of the active investments colored by type. Pass key=() to reuse the figure while the data doesn't change"""
+
+    fig = cached('pie_plot_invs', prices_key(key), lambda: investments_pie_figure(new_data))
+    with span('chart', part='pie_plot_invs', step='draw'):
+        st.plotly_chart(fig)